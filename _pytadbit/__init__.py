@@ -99,7 +99,7 @@ def get_dependencies_version(dico=False):
                           sorted(versions.keys())])
 
 
-from pytadbit.hic_data                   import HiC_data
+from pytadbit.hic_data                   import HiC_data, HiC_data_array
 from pytadbit.tadbit                     import tadbit, batch_tadbit
 from pytadbit.chromosome                 import Chromosome
 from pytadbit.experiment                 import Experiment, load_experiment_from_reads
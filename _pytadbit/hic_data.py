@@ -7,6 +7,7 @@ from __future__ import print_function
 from future import standard_library
 standard_library.install_aliases()
 import os
+import multiprocessing as mu
 from sys                            import stderr, modules
 from collections                    import OrderedDict
 from warnings                       import warn
@@ -18,6 +19,12 @@ from numpy                          import corrcoef, nansum, array, isnan, mean
 from numpy                          import meshgrid, asarray, exp, linspace, std
 from numpy                          import nanpercentile as npperc, log as nplog
 from numpy                          import nanmax, ma, zeros_like
+from numpy                          import zeros, ones, int32, int64, float64
+from numpy                          import concatenate, searchsorted, fromiter
+from numpy                          import arange, lexsort, iinfo, result_type
+from numpy                          import where, maximum, add as npadd
+from numpy                          import triu, dot, diag, sqrt, clip, full
+from numpy                          import ix_, float32
 from scipy.stats                    import ttest_ind, spearmanr
 from scipy.special                  import gammaincc
 from scipy.cluster.hierarchy        import linkage, fcluster, dendrogram
@@ -27,11 +34,12 @@ from scipy.sparse                   import csr_matrix
 from pytadbit.utils.extraviews      import plot_compartments
 from pytadbit.utils.extraviews      import plot_compartments_summary
 from pytadbit.utils.hic_filtering   import filter_by_mean, filter_by_zero_count
-from pytadbit.utils.normalize_hic   import iterative, expected
+from pytadbit.utils.normalize_hic   import iterative, iterative_sparse
+from pytadbit.utils.normalize_hic   import expected
 from pytadbit.parsers.genome_parser import parse_fasta
 from pytadbit.parsers.bed_parser    import parse_bed
 from pytadbit.utils.file_handling   import mkdir
-from pytadbit.utils.hmm             import gaussian_prob, best_path, train
+from pytadbit.utils.hmm             import log_gaussian_prob, log_best_path, train
 from pytadbit.utils.tadmaths        import calinski_harabasz
 try:
     from pytadbit.parsers.cooler_parser import cooler_file
@@ -56,6 +64,7 @@ class HiC_data(dict):
     """
     def __init__(self, items, size, chromosomes=None, dict_sec=None,
                  resolution=1, masked=None, symmetricized=False):
+        self._expected_cache = {}
         super(HiC_data, self).__init__(items)
         self.__size = size
         self._size2 = size**2
@@ -161,6 +170,41 @@ class HiC_data(dict):
                     'ERROR: position %d larger than %s^2' % (row_col,
                                                              self.__size))
             super(HiC_data, self).__setitem__(row_col, val)
+        self._modified()
+
+    def _modified(self):
+        """
+        Drops the values computed from the matrix (expected interactions),
+        to be called each time the matrix is modified.
+        """
+        # not yet set while unpickling
+        cache = getattr(self, '_expected_cache', None)
+        if cache:
+            cache.clear()
+
+    def update(self, *args, **kwargs):
+        super(HiC_data, self).update(*args, **kwargs)
+        self._modified()
+
+    def __delitem__(self, pos):
+        super(HiC_data, self).__delitem__(pos)
+        self._modified()
+
+    def pop(self, pos, *default):
+        self._modified()
+        return super(HiC_data, self).pop(pos, *default)
+
+    def popitem(self):
+        self._modified()
+        return super(HiC_data, self).popitem()
+
+    def setdefault(self, pos, default=None):
+        self._modified()
+        return super(HiC_data, self).setdefault(pos, default)
+
+    def clear(self):
+        super(HiC_data, self).clear()
+        self._modified()
 
     def get_hic_data_as_csr(self):
         """
@@ -168,15 +212,10 @@ class HiC_data(dict):
 
         :returns: scipy sparse matrix in Compressed Sparse Row format
         """
-        values = []
-        cols = []
-        rows = []
-        for key, value in self.items():
-            row, col = round(key // self.__size), key % self.__size
-            values.append(float(value))
-            cols.append(col)
-            rows.append(row)
-
+        ncells = super(HiC_data, self).__len__()
+        keys   = fromiter(self.keys(), dtype=int64, count=ncells)
+        values = fromiter(self.values(), dtype=float64, count=ncells)
+        rows, cols = divmod(keys, self.__size)
         return csr_matrix((values, (rows, cols)), shape=(self.__size,self.__size))
 
     def add_sections_from_fasta(self, fasta):
@@ -186,12 +225,12 @@ class HiC_data(dict):
 
         :param fasta: path to a FASTA file
         """
-        genome = parse_fasta(fasta, verbose=False)
+        genome = parse_fasta(fasta, verbose=False, mapped=True)
         sections = []
         genome_seq = OrderedDict()
         size = 0
         for crm in  genome:
-            genome_seq[crm] = int(len(genome[crm])) // self.resolution + 1
+            genome_seq[crm] = int(genome.length(crm)) // self.resolution + 1
             size += genome_seq[crm]
         section_sizes = {}
         for crm in genome_seq:
@@ -377,7 +416,7 @@ class HiC_data(dict):
         self.expected = expected(self, bads=self.bads, **kwargs)
 
     def normalize_hic(self, iterations=0, max_dev=0.1, silent=False,
-                      sqrt=False, factor=1):
+                      sqrt=False, factor=1, engine='python'):
         """
         Normalize the Hi-C data.
 
@@ -391,10 +430,21 @@ class HiC_data(dict):
         :param False sqrt: uses the square root of the computed biases
         :param 1 factor: final mean number of normalized interactions wanted
            per cell (excludes filtered, or bad, out columns)
+        :param 'python' engine: implementation of the iterative correction,
+           'python' (:func:`pytadbit.utils.normalize_hic.iterative`) or
+           'sparse' (:func:`pytadbit.utils.normalize_hic.iterative_sparse`),
+           much faster and lighter in memory
         """
-        bias = iterative(self, iterations=iterations,
-                         max_dev=max_dev, bads=self.bads,
-                         verbose=not silent)
+        if engine == 'python':
+            ice = iterative
+        elif engine == 'sparse':
+            ice = iterative_sparse
+        else:
+            raise NotImplementedError('ERROR: ICE engine "%s" not implemented'
+                                      % engine)
+        bias = ice(self, iterations=iterations,
+                   max_dev=max_dev, bads=self.bads,
+                   verbose=not silent)
         if sqrt:
             bias = dict((b, bias[b]**0.5) for b in bias)
         if factor:
@@ -410,6 +460,7 @@ class HiC_data(dict):
             target = (norm_sum / float(len(self) * len(self) * factor))**0.5
             bias = dict([(b, bias[b] * target) for b in bias])
         self.bias = bias
+        self._modified()
 
     def save_biases(self, fnam, protocol=None):
         """
@@ -441,6 +492,7 @@ class HiC_data(dict):
         self.bias     = biases['biases']
         self.expected = biases['decay']
         self.bads     = biases['badcol']
+        self._modified()
 
     def get_as_tuple(self):
         return tuple([self[i, j]
@@ -550,7 +602,8 @@ class HiC_data(dict):
                             'you need to install h5py\n')
         if normalized and not self.bias:
             raise Exception('ERROR: data not normalized yet')
-        if not all(isinstance(val, int) for _, val in self.items()):
+        values = list(self.values())
+        if not all(isinstance(val, int) for val in values):
             raise Exception('ERROR: raw hic data (integer values) is needed for cooler format')
         if self.chromosomes:
             if len(self.chromosomes) > 1:
@@ -564,11 +617,11 @@ class HiC_data(dict):
         out = cooler_file(fname, self.resolution, sections, list(sections.keys()))
         out.create_bins()
         out.prepare_matrix()
-        for key, value in self.items():
-            row, col = key // self.__size, key % self.__size
-            if row > col: # only upper triangular
-                continue
-            out.write_iter(0, row, col, value)
+        keys = fromiter(self.keys(), dtype=int64, count=len(values))
+        values = array(values, dtype=int64)
+        rows, cols = keys // self.__size, keys % self.__size
+        upper = rows <= cols # only upper triangular
+        out.write_pixels(rows[upper], cols[upper], values[upper])
         out.close()
         if normalized:
             weights = [self.bias[i] if not i in self.bads else 0. for i in range(self.__size)]
@@ -734,7 +787,8 @@ class HiC_data(dict):
     def find_compartments(self, crms=None, savefig=None, savedata=None,
                           savecorr=None, show=False, suffix='', ev_index=None,
                           rich_in_A=None, format='png', savedir=None,
-                          max_ev=3, show_compartment_labels=False, **kwargs):
+                          max_ev=3, show_compartment_labels=False, n_cpus=1,
+                          single_precision=False, **kwargs):
         """
         Search for A/B compartments in each chromosome of the Hi-C matrix.
         Hi-C matrix is normalized by the number interaction expected at a given
@@ -785,8 +839,10 @@ class HiC_data(dict):
            active epigenetic marks can be passed, and used instead of the mean
            interactions.
         :param False show_compartment_labels: if True draw A and B compartment blocks.
-
-        TODO: this is really slow...
+        :param 1 n_cpus: number of chromosomes to process in parallel
+        :param False single_precision: compute correlation matrices and
+           eigenvectors in single precision (float32), halving the memory
+           needed for large chromosomes
 
         Notes: building the distance matrix using the amount of interactions
                instead of the mean correlation, gives generally worse results.
@@ -835,49 +891,53 @@ class HiC_data(dict):
         count = 0
         richA_stats = dict((sec, None) for sec in self.section_pos)
 
+        # O/E correlation matrices and eigenvectors are computed chromosome by
+        # chromosome, from the rows of the sparse matrix, and in parallel if
+        # asked
+        csr = self.get_hic_data_as_csr()
+        keep_matrix = bool(savecorr or savefig or show)
+        pool = mu.Pool(n_cpus) if n_cpus > 1 else None
+        jobs = {}
         for sec in self.section_pos:
             if crms and sec not in crms:
                 continue
-            if kwargs.get('verbose', False):
-                print('Processing chromosome', sec)
-            # get chromosomal matrix
+            beg, end = self.section_pos[sec]
+            good = array([i for i in range(beg, end) if not i in self.bads],
+                         dtype=int64)
             try:
-                matrix = [[(float(self[i,j]) / self.expected[sec][abs(j-i)]
-                            / self.bias[i] / self.bias[j])
-                        for i in range(*self.section_pos[sec])
-                        if not i in self.bads]
-                        for j in range(*self.section_pos[sec])
-                        if not j in self.bads]
+                sec_expected = self.expected[sec]
             except KeyError:
-                if sec in self.expected and not self.expected[sec]:
-                    matrix = []
-                else:
-                    matrix = [[(float(self[i,j]) / self.expected[abs(j-i)]
-                                / self.bias[i] / self.bias[j])
-                            for i in range(*self.section_pos[sec])
-                            if not i in self.bads]
-                            for j in range(*self.section_pos[sec])
-                            if not j in self.bads]
-            if not matrix: # MT chromosome will fall there
-                warn('Chromosome %s is probably MT :)' % (sec))
-                cmprts[sec] = []
-                count += 1
+                sec_expected = self.expected
+            # MT or very small chromosomes
+            if len(good) < 2 or (sec in self.expected and not len(sec_expected)):
+                jobs[sec] = None
                 continue
-            # enforce symmetry
-            for i in range(len(matrix)):
-                for j in range(i+1, len(matrix)):
-                    matrix[i][j] = matrix[j][i]
-            # compute correlation coefficient
-            try:
-                matrix = [list(m) for m in corrcoef(matrix)]
-            except TypeError:
-                # very small chromosome?
+            args = (csr[good][:, good], good - beg,
+                    array([sec_expected[d] for d in
+                           range(min(end - beg, len(sec_expected)))],
+                          dtype=float64),
+                    array([self.bias[i] for i in good], dtype=float64),
+                    max_ev, single_precision, keep_matrix)
+            jobs[sec] = (pool.apply_async(_compartment_eigenvectors, args)
+                         if pool else args)
+        if pool:
+            pool.close()
+
+        for sec in self.section_pos:
+            if crms and sec not in crms:
+                continue
+            if kwargs.get('verbose', False):
+                print('Processing chromosome', sec)
+            if jobs[sec] is None: # MT chromosome will fall there
                 warn('Chromosome %s is probably MT :)' % (sec))
                 cmprts[sec] = []
                 count += 1
                 continue
-            # replace nan in correlation matrix
-            matrix = [[0. if isnan(v) else v for v in l] for l in matrix]
+            if pool:
+                matrix, evals, evect = jobs[sec].get()
+            else:
+                matrix, evals, evect = _compartment_eigenvectors(*jobs[sec])
+            jobs[sec] = None
             # write correlation matrix to file. replaces filtered row/columns by NaN
             if savecorr:
                 out = open(os.path.join(savecorr, '%s_corr-matrix%s.tsv' % (sec, suffix)),
@@ -903,22 +963,18 @@ class HiC_data(dict):
                         continue
                     vals = []
                     badcols = 0
+                    values = matrix[row - badrows].tolist()
                     for col, posy in enumerate(range(self.section_pos[sec][0],
                                                       self.section_pos[sec][1])):
                         if posy in self.bads:
                             vals.append('NaN')
                             badcols += 1
                             continue
-                        vals.append(str(matrix[row-badrows][col-badcols]))
+                        vals.append(str(values[col - badcols]))
                     out.write(rownam.pop(0) + '\t' +'\t'.join(vals) + '\n')
                 out.close()
 
-            # get eigenvectors
-            try:
-                # This eighs is very very fast, only ask for one eigenvector
-                evals, evect = eigsh(array(matrix),
-                                     k=max_ev if max_ev else (len(matrix) - 1))
-            except (LinAlgError, ValueError):
+            if evals is None:
                 warn('Chromosome %s too small to compute PC1' % (sec))
                 cmprts[sec] = [] # Y chromosome, or so...
                 count += 1
@@ -926,7 +982,7 @@ class HiC_data(dict):
             # define breakpoints, and store first EVs
             n_first = [list(evect[:, -i])
                        for i in range(1, (max_ev + 1)
-                                       if max_ev else len(matrix))]
+                                       if max_ev else len(evect))]
             ev_num = (ev_index[count] - 1) if ev_index else 0
             breaks = [i for i, (a, b) in
                       enumerate(zip(n_first[ev_num][1:], n_first[ev_num][:-1]))
@@ -939,10 +995,13 @@ class HiC_data(dict):
             bads = [k - beg for k in sorted(self.bads) if beg <= k <= end]
             for evect in n_first:
                 _ = [evect.insert(b, float('nan')) for b in bads]
-            _ = [matrix.insert(b, [float('nan')] * len(matrix[0]))
-                 for b in bads]
-            _ = [matrix[i].insert(b, float('nan'))
-                 for b in bads for i in range(len(n_first[0]))]
+            if keep_matrix:
+                valid = ones(len(n_first[0]), dtype=bool)
+                valid[bads] = False
+                padded = full((len(valid), len(valid)), float('nan'),
+                              dtype=matrix.dtype)
+                padded[ix_(valid, valid)] = matrix
+                matrix = padded
             for b in bads:  # they are sorted
                 for brk in breaks:
                     if brk['start'] >= b:
@@ -1019,6 +1078,8 @@ class HiC_data(dict):
                     warn(('WARNING: chromosome %s too small for plotting.'
                           'Skipping image creation.') % sec)
 
+        if pool:
+            pool.join()
         self.compartments = cmprts
         if savedata:
             self.write_compartments(savedata, chroms=list(self.compartments.keys()),
@@ -1045,7 +1106,8 @@ class HiC_data(dict):
     def find_compartments_beta(self, crms=None, savefig=None, savedata=None,
                           savecorr=None, show=False, suffix='', how='',
                           label_compartments='hmm', log=None, max_mean_size=10000,
-                          ev_index=None, rich_in_A=None, max_ev=3,show_compartment_labels=False, **kwargs):
+                          ev_index=None, rich_in_A=None, max_ev=3,show_compartment_labels=False,
+                          n_cpus=1, **kwargs):
         """
         Search for A/B compartments in each chromosome of the Hi-C matrix.
         Hi-C matrix is normalized by the number interaction expected at a given
@@ -1097,6 +1159,8 @@ class HiC_data(dict):
         :param 'ratio' how: ratio divide by column, subratio divide by
            compartment, diagonal only uses diagonal
         :param False'show_compartment_labels': if True draw A and B compartment blocks.
+        :param 1 n_cpus: number of chromosomes on which to apply the HMM models
+           in parallel
 
 
         TODO: this is really slow...
@@ -1331,17 +1395,29 @@ class HiC_data(dict):
                 models[n] = _training(x, n, kwargs.get('verbose', False))
 
             # apply HMM models on each chromosome
-            results = {}
+            pool = mu.Pool(n_cpus) if n_cpus > 1 else None
+            jobs = {}
             for sec in self.section_pos:
                 if not sec in x:
                     continue
                 beg, end = self.section_pos[sec]
                 bads = [k - beg for k in self.bads if beg <= k <= end]
+                args = (x[sec], models, bads, kwargs.get('verbose', False))
+                jobs[sec] = (pool.apply_async(_hmm_refine_compartments, args)
+                             if pool else args)
+            if pool:
+                pool.close()
+            results = {}
+            for sec in self.section_pos:
+                if not sec in x:
+                    continue
                 if kwargs.get('verbose', False):
                     print('Chromosome', sec)
                 # print 'CMPRTS before   ', sec, cmprts[sec]
-                n_states, breaks = _hmm_refine_compartments(
-                    x[sec], models, bads, kwargs.get('verbose', False))
+                if pool:
+                    n_states, breaks = jobs[sec].get()
+                else:
+                    n_states, breaks = _hmm_refine_compartments(*jobs[sec])
                 results[sec] = n_states, breaks
                 cmprts[sec] = breaks
                 # print 'CMPRTS after hmm', sec, cmprts[sec]
@@ -1392,6 +1468,8 @@ class HiC_data(dict):
                         comp['type'] = 'NA'
                     else:
                         comp['type'] = 'I'
+            if pool:
+                pool.join()
         self.compartments = cmprts
         if savedata:
             self.write_compartments(savedata, chroms=list(self.compartments.keys()),
@@ -1538,6 +1616,16 @@ class HiC_data(dict):
         else:
             start1 = start2 = 0
             end1   = end2   = siz
+        for line in self._yield_matrix_rows(start1, end1, start2, end2,
+                                            diagonal, normalized):
+            yield line
+
+    def _yield_matrix_rows(self, start1, end1, start2, end2, diagonal,
+                           normalized):
+        """
+        Yields rows of the matrix between start2 and end2, each row
+        containing the columns from start1 to end1.
+        """
         if normalized:
             for i in range(start2, end2):
                 # if bad column:
@@ -1571,14 +1659,422 @@ class HiC_data(dict):
                            [self[i, j] for j in range(i + 1, end1)])
 
 
+class HiC_data_array(HiC_data):
+    """
+    Array-backed storage of Hi-C interactions, with the same interface as
+    HiC_data.
+
+    Interactions are stored as a sorted array of linear positions
+    (row * size + col, int64) and an aligned array of values (int32 for raw
+    counts, float64 otherwise). This uses about 16 bytes per non-zero cell,
+    instead of the ~100 bytes of the dictionary storage, and allows
+    vectorized bulk operations (sum, symmetrization, CSR conversion, matrix
+    writing).
+
+    Cells set one by one (e.g. hic_data[i, j] = v) are kept in a small
+    buffer dictionary, merged into the arrays before bulk operations or when
+    it grows above buffer_size.
+
+    :param None dtype: numpy type of the stored values. By default int32 is
+       used if all values are integers, float64 otherwise.
+    :param 1000000 buffer_size: maximum number of cells kept in the buffer
+       dictionary before merging them into the arrays
+    """
+    def __init__(self, items, size, chromosomes=None, dict_sec=None,
+                 resolution=1, masked=None, symmetricized=False, dtype=None,
+                 buffer_size=1000000):
+        self._keys        = zeros(0, dtype=int64)
+        self._values      = zeros(0, dtype=dtype or int32)
+        self._dtype       = dtype
+        self._buffer      = {}
+        self._buffer_size = buffer_size
+        super(HiC_data_array, self).__init__(
+            (), size, chromosomes=chromosomes, dict_sec=dict_sec,
+            resolution=resolution, masked=masked, symmetricized=symmetricized)
+        if items:
+            if isinstance(items, dict):
+                items = items.items()
+            for pos, val in items:
+                self[pos] = val
+            self._symmetricize()
+
+    def __reduce__(self):
+        self._consolidate()
+        return (self.__class__.__new__, (self.__class__, ), self.__dict__)
+
+    def _consolidate(self):
+        """
+        Merge the buffer of cells into the sorted arrays. Buffered values
+        replace the ones already stored.
+        """
+        if not self._buffer:
+            return
+        keys = fromiter(self._buffer.keys(), dtype=int64,
+                        count=len(self._buffer))
+        values = array(list(self._buffer.values()))
+        self._buffer = {}
+        self._update_from_arrays(keys, values)
+
+    def _cast_values(self, values):
+        values = asarray(values)
+        if self._dtype:
+            return values.astype(self._dtype, copy=False)
+        if values.dtype.kind in 'iub':
+            if len(values) and abs(values).max() > iinfo(int32).max:
+                values = values.astype(int64, copy=False)
+            else:
+                values = values.astype(int32, copy=False)
+        else:
+            values = values.astype(float64, copy=False)
+        return values.astype(result_type(self._values, values), copy=False)
+
+    def _update_from_arrays(self, keys, values, add=False):
+        """
+        Bulk insertion of cells.
+
+        :param keys: array of linear positions (row * size + col)
+        :param values: array of values
+        :param False add: if True values are summed to the ones already
+           stored (and duplicated keys are summed), otherwise they replace
+           them (last one wins).
+        """
+        if not len(keys):
+            return
+        self._modified()
+        self._consolidate()
+        keys   = concatenate((self._keys, asarray(keys, dtype=int64)))
+        values = self._cast_values(values)
+        values = concatenate((self._values.astype(values.dtype, copy=False),
+                              values))
+        # stable sort, so that the last duplicated key is the newest value
+        order  = keys.argsort(kind='mergesort')
+        keys   = keys[order]
+        values = values[order]
+        del order
+        if not len(keys):
+            return
+        starts = ones(len(keys), dtype=bool)
+        starts[1:] = keys[1:] != keys[:-1]
+        if add:
+            idx = starts.nonzero()[0]
+            values = npadd.reduceat(values, idx)
+            keys = keys[idx]
+        else:
+            lasts = ones(len(keys), dtype=bool)
+            lasts[:-1] = starts[1:]
+            keys = keys[lasts]
+            values = values[lasts]
+        self._keys = keys
+        self._values = values
+
+    def _bads_mask(self, bads):
+        mask = zeros(len(self), dtype=bool)
+        if bads:
+            mask[list(bads)] = True
+        return mask
+
+    def _bias_array(self, bias):
+        biases = ones(len(self), dtype=float64)
+        for k, v in bias.items():
+            biases[k] = v
+        return biases
+
+    def _iter_arrays(self, chunk=100000):
+        self._consolidate()
+        for beg in range(0, len(self._keys), chunk):
+            yield (self._keys[beg:beg + chunk].tolist(),
+                   self._values[beg:beg + chunk].tolist())
+
+    def __setitem__(self, row_col, val):
+        try:
+            row, col = row_col
+            pos = row * len(self) + col
+            if pos > self._size2:
+                raise IndexError(
+                    'ERROR: row or column larger than %s' % len(self))
+        except TypeError:
+            pos = row_col
+            if pos > self._size2:
+                raise IndexError(
+                    'ERROR: position %d larger than %s^2' % (pos, len(self)))
+        self._buffer[pos] = val
+        self._modified()
+        if len(self._buffer) > self._buffer_size:
+            self._consolidate()
+
+    def get(self, pos, default=None):
+        try:
+            return self._buffer[pos]
+        except KeyError:
+            pass
+        idx = searchsorted(self._keys, pos)
+        if idx < len(self._keys) and self._keys[idx] == pos:
+            return self._values[idx].item()
+        return default
+
+    def __contains__(self, pos):
+        return self.get(pos) is not None
+
+    def __iter__(self):
+        return self.keys()
+
+    def keys(self):
+        for keys, _ in self._iter_arrays():
+            for key in keys:
+                yield key
+
+    def values(self):
+        for _, values in self._iter_arrays():
+            for value in values:
+                yield value
+
+    def items(self):
+        for keys, values in self._iter_arrays():
+            for item in zip(keys, values):
+                yield item
+
+    # the dictionary underneath is always empty, all the dictionary methods
+    # have to go through the arrays
+
+    def copy(self):
+        """
+        :returns: a dictionary of the stored cells (as dict.copy would for
+           HiC_data)
+        """
+        return dict(self.items())
+
+    def update(self, other=(), **kwargs):
+        if isinstance(other, HiC_data_array):
+            other._consolidate()
+            self._update_from_arrays(other._keys, other._values)
+            other = ()
+        elif hasattr(other, 'keys'):
+            other = [(k, other[k]) for k in other.keys()]
+        for pos, val in other:
+            self[pos] = val
+        for pos, val in kwargs.items():
+            self[pos] = val
+
+    def __delitem__(self, pos):
+        self._consolidate()
+        idx = searchsorted(self._keys, pos)
+        if idx >= len(self._keys) or self._keys[idx] != pos:
+            raise KeyError(pos)
+        self._keys   = concatenate((self._keys[:idx]  , self._keys[idx + 1:]))
+        self._values = concatenate((self._values[:idx], self._values[idx + 1:]))
+        self._modified()
+
+    def pop(self, pos, *default):
+        val = self.get(pos)
+        if val is None:
+            if default:
+                return default[0]
+            raise KeyError(pos)
+        del self[pos]
+        return val
+
+    def popitem(self):
+        self._consolidate()
+        if not len(self._keys):
+            raise KeyError('popitem(): dictionary is empty')
+        pos = self._keys[-1].item()
+        return pos, self.pop(pos)
+
+    def setdefault(self, pos, default=None):
+        val = self.get(pos)
+        if val is None:
+            self[pos] = val = default
+        return val
+
+    def clear(self):
+        self._buffer = {}
+        self._keys   = zeros(0, dtype=int64)
+        self._values = zeros(0, dtype=self._dtype or int32)
+        self._modified()
+
+    def __eq__(self, other):
+        if isinstance(other, HiC_data_array):
+            self._consolidate()
+            other._consolidate()
+            return bool(len(self._keys) == len(other._keys) and
+                        (self._keys == other._keys).all() and
+                        (self._values == other._values).all())
+        if isinstance(other, dict):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self.copy())
+
+    def _symmetricize(self):
+        """
+        Check if matrix is symmetric and, if not, make it symmetric
+         - if matrix is half empty, copy values on one side to the other side
+         - if matrix is asymmetric, sum non-diagonal values
+        """
+        self._consolidate()
+        size = len(self)
+        keys = self._keys
+        values = self._values
+        rows, cols = divmod(keys, size)
+        offdiag = (rows != cols) & (values != 0)
+        trans = cols[offdiag] * size + rows[offdiag]
+        vals = values[offdiag]
+        # values at the transposed positions (0 if not stored)
+        idx = searchsorted(keys, trans).clip(max=max(0, len(keys) - 1))
+        found = keys[idx] == trans if len(keys) else zeros(0, dtype=bool)
+        tvals = zeros(len(trans), dtype=values.dtype)
+        tvals[found] = values[idx[found]]
+        asym = abs(vals - tvals) > 1e-09 * maximum(abs(vals), abs(tvals))
+        if not asym.any():
+            return
+        first = asym.nonzero()[0][0]
+        to_sum = vals[first] != 0 and tvals[first] != 0
+        del asym, idx, found, tvals, vals
+        if to_sum:
+            # each off-diagonal cell receives its value plus the transposed
+            self._keys   = zeros(0, dtype=int64)
+            self._values = zeros(0, dtype=values.dtype)
+            offdiag = rows != cols
+            self._update_from_arrays(
+                concatenate((keys, cols[offdiag] * size + rows[offdiag])),
+                concatenate((values, values[offdiag])), add=True)
+        else:
+            # copy each cell to its transposed position, on conflict the
+            # upper triangle wins
+            upper = rows <= cols
+            canon = where(upper, keys, cols * size + rows)
+            order = lexsort((~upper, canon))
+            canon = canon[order]
+            vals = values[order]
+            del order, upper
+            firsts = ones(len(canon), dtype=bool)
+            firsts[1:] = canon[1:] != canon[:-1]
+            canon = canon[firsts]
+            vals = vals[firsts]
+            rows, cols = divmod(canon, size)
+            offdiag = rows != cols
+            self._keys   = zeros(0, dtype=int64)
+            self._values = zeros(0, dtype=values.dtype)
+            self._update_from_arrays(
+                concatenate((canon, cols[offdiag] * size + rows[offdiag])),
+                concatenate((vals, vals[offdiag])))
+
+    def sum(self, bias=None, bads=None):
+        """
+        Sum Hi-C data matrix
+        WARNING: parameters are not meant to be used by external users
+
+        :params None bias: expects a dictionary of biases to use normalized matrix
+        :params None bads: extends computed bad columns
+
+        :returns: the sum of the Hi-C matrix skipping bad columns
+        """
+        self._consolidate()
+        rows, cols = divmod(self._keys, len(self))
+        bads = self._bads_mask(bads or self.bads)
+        valid = ~(bads[rows] | bads[cols])
+        values = self._values[valid]
+        if bias:
+            bias = self._bias_array(bias)
+            return float((values / (bias[rows[valid]] *
+                                    bias[cols[valid]])).sum())
+        return values.sum().item()
+
+    def get_hic_data_as_csr(self):
+        """
+        Returns a scipy sparse matrix in Compressed Sparse Row format of the Hi-C data in the dictionary
+
+        :returns: scipy sparse matrix in Compressed Sparse Row format
+        """
+        self._consolidate()
+        size = len(self)
+        rows, cols = divmod(self._keys, size)
+        indptr = searchsorted(rows, arange(size + 1))
+        return csr_matrix((self._values.astype(float), cols, indptr),
+                          shape=(size, size))
+
+    def _yield_matrix_rows(self, start1, end1, start2, end2, diagonal,
+                           normalized):
+        self._consolidate()
+        size = len(self)
+        bads = self._bads_mask(self.bads)
+        if normalized:
+            bias = self._bias_array(self.bias)
+            bias1 = bias[start1:end1]
+        for i in range(start2, end2):
+            if bads[i]:
+                yield [0.0 if normalized else 0] * (end1 - start1)
+                continue
+            beg = searchsorted(self._keys, i * size + start1)
+            end = searchsorted(self._keys, i * size + end1)
+            row = zeros(end1 - start1, dtype=float64 if normalized
+                        else self._values.dtype)
+            row[self._keys[beg:end] - i * size - start1] = self._values[beg:end]
+            if normalized:
+                row = row / bias[i] / bias1
+            if not diagonal and start1 == start2:
+                row[i - start1] = 0
+            yield row.tolist()
+
+
+def _compartment_eigenvectors(block, pos, expc, bias, max_ev,
+                              single_precision=False, keep_matrix=True):
+    """
+    Correlation matrix of the observed/expected interactions of a chromosome,
+    and its first eigenvectors.
+
+    :param block: sparse matrix of interactions between the valid bins of the
+       chromosome
+    :param pos: position of each valid bin in the chromosome
+    :param expc: expected interactions at each distance (in bins)
+    :param bias: bias of each valid bin
+    :param max_ev: number of eigenvectors to compute (all if 0 or None)
+    :param False single_precision: work in float32
+    :param True keep_matrix: also return the correlation matrix
+
+    :returns: the correlation matrix (None if not kept), the eigenvalues and
+       the eigenvectors (both None if the chromosome is too small)
+    """
+    matrix = block.toarray()
+    # normalize the upper triangle and mirror it
+    matrix /= expc[abs(pos[:, None] - pos[None, :])]
+    matrix /= bias[:, None]
+    matrix /= bias[None, :]
+    matrix = triu(matrix) + triu(matrix, 1).T
+    if single_precision:
+        # numpy's corrcoef would upcast to float64
+        matrix = matrix.astype(float32)
+        matrix -= matrix.mean(axis=1)[:, None]
+        matrix = dot(matrix, matrix.T)
+        dev = sqrt(diag(matrix))
+        matrix /= dev[:, None]
+        matrix /= dev[None, :]
+        clip(matrix, -1, 1, out=matrix)
+    else:
+        matrix = corrcoef(matrix)
+    matrix[isnan(matrix)] = 0.
+    try:
+        evals, evect = eigsh(matrix, k=max_ev if max_ev else (len(matrix) - 1))
+    except (LinAlgError, ValueError):
+        evals = evect = None
+    return (matrix if keep_matrix else None), evals, evect
+
+
 def _hmm_refine_compartments(xsec, models, bads, verbose):
     prevll = float('-inf')
     prevdf = 0
     results = {}
     for n in range(2, 6):
         E, pi, T = models[n]
-        probs = gaussian_prob(xsec, E)
-        pathm, llm = best_path(probs, pi, T)
+        # in log space: far from all the states, emissions underflow
+        pathm, llm = log_best_path(log_gaussian_prob(xsec, E), pi, T)
         pathm = asarray(list(map(float, pathm)))
         df = n**2 - n + n * 2 + n - 1
         len_seq = len(pathm)
@@ -6,8 +6,10 @@ from collections                  import OrderedDict
 from multiprocessing              import cpu_count
 from distutils.version            import LooseVersion
 from subprocess                   import Popen, PIPE
+import multiprocessing as mu
 
 from pytadbit.utils.file_handling import mkdir, magic_open, which
+from pytadbit.mapping.binary_pairs import BinaryPairsWriter
 
 
 def eq_reads(rd1, rd2):
@@ -127,7 +129,8 @@ def merge_bams(bam1, bam2, output_bam, cpus = cpu_count(), samtools = 'samtools'
         system(samtools  + ' index %s' % (output_bam))
 
 
-def get_intersection(fname1, fname2, out_path, verbose=False, compress=False):
+def get_intersection(fname1, fname2, out_path, verbose=False, compress=False,
+                     binary=False, ncpus=1, buffer_size=1000000):
     """
     Merges the two files corresponding to each reads sides. Reads found in both
        files are merged and written in an output file.
@@ -150,6 +153,16 @@ def get_intersection(fname1, fname2, out_path, verbose=False, compress=False):
        the inputs
     :param False compress: compress (gzip) input files. This is done in the
        background while next input files are parsed.
+    :param False binary: write out_path in binary pairs format (see
+       :mod:`pytadbit.mapping.binary_pairs`) instead of tab separated values.
+       This file can be passed directly to
+       :func:`pytadbit.mapping.filter.filter_reads` and
+       :func:`pytadbit.mapping.filter.apply_filter`, and converted back with
+       :func:`pytadbit.mapping.binary_pairs.binary_to_tsv`
+    :param 1 ncpus: number of CPUs used to sort the temporary files (sorted
+       chunks are written in genomic order)
+    :param 1000000 buffer_size: number of reads parsed before writing them to
+       the temporary files
 
     :returns: final number of pair of interacting fragments, and a dictionary with
        the number of multiple contacts (keys of the dictionary being the number of
@@ -217,7 +230,7 @@ def get_intersection(fname1, fname2, out_path, verbose=False, compress=False):
                     stdout.write('.')
                     stdout.flush()
                 count_dots += 1
-            for _ in range(1000000): # iterate 1 million times, write to files
+            for _ in range(buffer_size): # iterate, then write to files
                 # same read id in both lianes, we store put the more upstream
                 # before and store them
                 if eq_reads(read1, read2):
@@ -254,17 +267,40 @@ def get_intersection(fname1, fname2, out_path, verbose=False, compress=False):
     if verbose:
         print('Sorting each temporary file by genomic coordinate')
 
-    out = open(out_path, 'w')
-    out.write(header1)
-    for b in buf:
+    if binary:
+        chromosomes = OrderedDict()
+        for line in header1.split('\n'):
+            if line.startswith('# CRM'):
+                _, _, crm, val = line.split()
+                chromosomes[crm] = val
+        out = BinaryPairsWriter(out_path, chromosomes)
+    else:
+        out = open(out_path, 'w')
+        out.write(header1)
+    tmp_names = [path.join(tmp_dir, 'rep_%03d' % (b // int(nchunks**0.5)),
+                           'tmp_%05d.tsv' % b) for b in buf]
+    if ncpus > 1:
+        pool = mu.Pool(ncpus)
+        jobs = []
+    for b, tmp_name in enumerate(tmp_names):
+        if ncpus > 1:
+            # keep a few chunks ahead, results are written in order
+            while len(jobs) < 2 * ncpus and b + len(jobs) < len(tmp_names):
+                jobs.append(pool.apply_async(
+                    _sort_chunk, args=(tmp_names[b + len(jobs)], binary)))
+            lines = jobs.pop(0).get()
+        else:
+            lines = _sort_chunk(tmp_name, binary)
         if verbose:
             stdout.write('\r    %4d/%d sorted files' % (b + 1, len(buf)))
             stdout.flush()
-        with open(path.join(tmp_dir, 'rep_%03d' % (b // int(nchunks**0.5)),
-                            'tmp_%05d.tsv' % b)) as f_tmp:
-            out.write(''.join(['\t'.join(l[1:]) for l in sorted(
-                [l.split('\t') for l in f_tmp],
-                key=lambda x: (x[0], x[8], x[9], x[6]))]))
+        if binary:
+            out.write_lines(lines)
+        else:
+            out.write(lines)
+    if ncpus > 1:
+        pool.close()
+        pool.join()
     out.close()
 
     if compress:
@@ -278,6 +314,21 @@ def get_intersection(fname1, fname2, out_path, verbose=False, compress=False):
     return count, multiples
 
 
+def _sort_chunk(tmp_name, binary):
+    """
+    Sort the pairs of reads of a temporary file of get_intersection, and
+    remove the index column.
+
+    :returns: the sorted lines as text, or, if binary, as lists of fields
+    """
+    with open(tmp_name) as f_tmp:
+        lines = sorted([l.split('\t') for l in f_tmp],
+                       key=lambda x: (x[0], x[8], x[9], x[6]))
+    if binary:
+        return [l[1:] for l in lines]
+    return ''.join(['\t'.join(l[1:]) for l in lines])
+
+
 def _loc_reads(r1, r2):
     """
     Put upstream read before, get position in buf
@@ -0,0 +1,252 @@
+"""
+Binary columnar storage of read pairs.
+
+Same content as the 13 column tab separated file produced by
+:func:`pytadbit.mapping.get_intersection`, but with fixed-width columns that
+can be memory-mapped and filtered with numpy instead of being parsed line by
+line.
+
+Layout of the file:
+   - text header, each line starting with '#', with the magic line, the
+     chromosome names and lengths (as in the tsv files), and the number of
+     records
+   - the records (see PAIR_DTYPE), chromosomes being stored as their index in
+     the header
+   - the read names, one per line, in the same order as the records
+"""
+from __future__ import print_function
+
+from collections import OrderedDict
+from zlib        import crc32, adler32
+from os          import remove
+
+from numpy import dtype, fromiter, memmap, empty, array
+from numpy import int32, int64, uint32, uint64, int8
+
+
+MAGIC = b'# TADbit binary pairs v1\n'
+
+PAIR_DTYPE = dtype([('read', uint64),
+                    ('cr1' , int32 ), ('pos1', uint32), ('sd1', int8),
+                    ('l1'  , uint32), ('rs1' , uint32), ('re1', uint32),
+                    ('cr2' , int32 ), ('pos2', uint32), ('sd2', int8),
+                    ('l2'  , uint32), ('rs2' , uint32), ('re2', uint32),
+                    ('multi', bool)])
+
+_COLUMNS = (('pos1', 2), ('sd1', 3), ('l1', 4), ('rs1', 5), ('re1', 6),
+            ('pos2', 8), ('sd2', 9), ('l2', 10), ('rs2', 11), ('re2', 12))
+
+
+def read_hash(read):
+    """
+    64 bits hash of a read name (two 32 bits checksums)
+    """
+    read = read.encode()
+    return ((crc32(read) & 0xffffffff) << 32) | (adler32(read) & 0xffffffff)
+
+
+def is_binary_pairs(fnam):
+    """
+    :param fnam: path to a file of read pairs
+
+    :returns: True if the file is in TADbit binary pairs format
+    """
+    try:
+        with open(fnam, 'rb') as fhandler:
+            return fhandler.read(len(MAGIC)) == MAGIC
+    except IOError:
+        return False
+
+
+def read_header(fnam):
+    """
+    :param fnam: path to a file in TADbit binary pairs format
+
+    :returns: an ordered dictionary of chromosome lengths, the number of
+       records, the position in the file of the first record and the position
+       of the first read name
+    """
+    chromosomes = OrderedDict()
+    nrecords = None
+    with open(fnam, 'rb') as fhandler:
+        if fhandler.readline() != MAGIC:
+            raise Exception('ERROR: %s is not a TADbit binary pairs file' % (
+                fnam))
+        while nrecords is None:
+            line = fhandler.readline().decode()
+            if line.startswith('# CRM'):
+                _, _, crm, val = line.split()
+                chromosomes[crm] = int(val)
+            elif line.startswith('# RECORDS'):
+                nrecords = int(line.split()[2])
+            elif not line.startswith('#'):
+                raise Exception('ERROR: truncated header in %s' % (fnam))
+        offset = fhandler.tell()
+    return chromosomes, nrecords, offset, offset + nrecords * PAIR_DTYPE.itemsize
+
+
+def load_pairs(fnam):
+    """
+    Memory-map the records of a binary pairs file.
+
+    :param fnam: path to a file in TADbit binary pairs format
+
+    :returns: an ordered dictionary of chromosome lengths, and a read-only
+       numpy structured array (PAIR_DTYPE)
+    """
+    chromosomes, nrecords, offset, _ = read_header(fnam)
+    if not nrecords:
+        return chromosomes, empty(0, dtype=PAIR_DTYPE)
+    return chromosomes, memmap(fnam, dtype=PAIR_DTYPE, mode='r',
+                               offset=offset, shape=(nrecords,))
+
+
+def iter_read_names(fnam):
+    """
+    Iterate over the read names of a binary pairs file, in the same order as
+    the records.
+
+    :param fnam: path to a file in TADbit binary pairs format
+    """
+    _, _, _, names_offset = read_header(fnam)
+    with open(fnam, 'rb') as fhandler:
+        fhandler.seek(names_offset)
+        for line in fhandler:
+            yield line.rstrip(b'\n').decode()
+
+
+class BinaryPairsWriter(object):
+    """
+    Write read pairs in TADbit binary pairs format.
+
+    Records are appended with :func:`write_lines` or :func:`write_records`,
+    the number of records in the header being updated on :func:`close`. Read
+    names are kept in a temporary file and appended after the records.
+
+    :param outfile: path to the output file
+    :param chromosomes: ordered dictionary of chromosome lengths
+    """
+
+    def __init__(self, outfile, chromosomes):
+        self.outfile = outfile
+        self.crm_index = dict((crm, i) for i, crm in enumerate(chromosomes))
+        self.nrecords = 0
+        self._out = open(outfile, 'wb')
+        self._out.write(MAGIC)
+        for crm in chromosomes:
+            self._out.write(('# CRM %s\t%s\n' % (crm, chromosomes[crm])).encode())
+        self._count_pos = self._out.tell()
+        self._out.write(('# RECORDS %020d\n' % 0).encode())
+        self._names_fnam = outfile + '_names.tmp'
+        self._names = open(self._names_fnam, 'wb')
+
+    def write_lines(self, lines):
+        """
+        :param lines: list of read pairs, each as the list of 13 (string)
+           fields of the tab separated format
+        """
+        if not lines:
+            return
+        nlines = len(lines)
+        records = empty(nlines, dtype=PAIR_DTYPE)
+        records['read'] = fromiter((read_hash(l[0]) for l in lines), uint64,
+                                   count=nlines)
+        records['multi'] = fromiter(('~' in l[0] for l in lines), bool,
+                                    count=nlines)
+        records['cr1'] = fromiter((self.crm_index[l[1]] for l in lines), int32,
+                                  count=nlines)
+        records['cr2'] = fromiter((self.crm_index[l[7]] for l in lines), int32,
+                                  count=nlines)
+        for col, idx in _COLUMNS:
+            records[col] = fromiter((int(l[idx]) for l in lines), int64,
+                                    count=nlines)
+        self._out.write(records.tobytes())
+        self._names.write(''.join(l[0] + '\n' for l in lines).encode())
+        self.nrecords += nlines
+
+    def write_records(self, records, names):
+        """
+        :param records: numpy structured array (PAIR_DTYPE) with chromosome
+           indexes corresponding to the ones of this writer
+        :param names: list of read names corresponding to the records
+        """
+        self._out.write(array(records, dtype=PAIR_DTYPE).tobytes())
+        self._names.write(''.join(n + '\n' for n in names).encode())
+        self.nrecords += len(records)
+
+    def close(self):
+        self._names.close()
+        with open(self._names_fnam, 'rb') as names:
+            while True:
+                block = names.read(1 << 24)
+                if not block:
+                    break
+                self._out.write(block)
+        remove(self._names_fnam)
+        self._out.seek(self._count_pos)
+        self._out.write(('# RECORDS %020d\n' % self.nrecords).encode())
+        self._out.close()
+
+
+def tsv_to_binary(fnam, outfile, chunk=100000):
+    """
+    Convert a tab separated file of read pairs (as generated by
+    :func:`pytadbit.mapping.get_intersection`) into binary pairs format.
+
+    :param fnam: path to the tab separated file
+    :param outfile: path to the output file
+    :param 100000 chunk: number of lines converted at once
+
+    :returns: number of read pairs written
+    """
+    chromosomes = OrderedDict()
+    fhandler = open(fnam)
+    line = next(fhandler, '')
+    while line.startswith('#'):
+        if line.startswith('# CRM'):
+            _, _, crm, val = line.split()
+            chromosomes[crm] = val
+        line = next(fhandler, '')
+    writer = BinaryPairsWriter(outfile, chromosomes)
+    lines = [line.split('\t')] if line else []
+    for line in fhandler:
+        lines.append(line.split('\t'))
+        if len(lines) >= chunk:
+            writer.write_lines(lines)
+            lines = []
+    writer.write_lines(lines)
+    fhandler.close()
+    writer.close()
+    return writer.nrecords
+
+
+def binary_to_tsv(fnam, outfile, chunk=100000):
+    """
+    Export a binary pairs file to the tab separated format generated by
+    :func:`pytadbit.mapping.get_intersection`.
+
+    :param fnam: path to the binary pairs file
+    :param outfile: path to the tab separated output file
+    :param 100000 chunk: number of records converted at once
+
+    :returns: number of read pairs written
+    """
+    chromosomes, pairs = load_pairs(fnam)
+    crms = list(chromosomes.keys())
+    out = open(outfile, 'w')
+    for crm in chromosomes:
+        out.write('# CRM %s\t%s\n' % (crm, chromosomes[crm]))
+    names = iter_read_names(fnam)
+    for beg in range(0, len(pairs), chunk):
+        records = pairs[beg:beg + chunk]
+        cols = [records[c].tolist() for c in ('cr1', 'pos1', 'sd1', 'l1',
+                                              'rs1', 're1', 'cr2', 'pos2',
+                                              'sd2', 'l2', 'rs2', 're2')]
+        out.write(''.join(
+            '%s\t%s\t%d\t%d\t%d\t%d\t%d\t%s\t%d\t%d\t%d\t%d\t%d\n' % (
+                next(names), crms[cr1], ps1, sd1, l1, rs1, re1,
+                crms[cr2], ps2, sd2, l2, rs2, re2)
+            for (cr1, ps1, sd1, l1, rs1, re1,
+                 cr2, ps2, sd2, l2, rs2, re2) in zip(*cols)))
+    out.close()
+    return len(pairs)
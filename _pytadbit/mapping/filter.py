@@ -5,9 +5,19 @@
 """
 from __future__ import print_function
 from builtins   import next
+from os         import path, remove
+from shutil     import copyfileobj
+from itertools  import islice
+from array      import array
 import multiprocessing as mu
 
+from numpy import zeros, ones, int64, uint16, unique, concatenate, flatnonzero
+from numpy import sort, frombuffer, save as npsave, load as npload
+
 from pytadbit.mapping.restriction_enzymes import count_re_fragments
+from pytadbit.mapping.binary_pairs        import is_binary_pairs, load_pairs
+from pytadbit.mapping.binary_pairs        import iter_read_names
+from pytadbit.mapping.binary_pairs        import BinaryPairsWriter
 
 
 MASKED = {1 : {'name': 'self-circle'       , 'reads': 0},
@@ -39,79 +49,168 @@ def apply_filter(fnam, outfile, masked, filters=None, reverse=False,
     :param False verbose:
 
     :returns: number of reads kept
+
+    *Note: if fnam is in binary pairs format (see*
+    :func:`pytadbit.mapping.get_intersection` *) outfile is written in the same
+    format.*
+
+    *Note: filters are applied in a single vectorized pass over the bitmask
+    of the filters (see* :func:`pytadbit.mapping.filter.get_bitmask` *), built
+    from the filter files the first time it is needed and reused afterwards.*
     """
     filters = filters or list(masked.keys())
-    filter_handlers = {}
+    flags = npload(get_bitmask(fnam, masked), mmap_mode='r')
+    selected = 0
     for k in filters:
-        try:
-            fh = open(masked[k]['fnam'])
-            val = next(fh).strip()
-            filter_handlers[k] = [val, fh]
-        except StopIteration:
-            pass
-
-    out = open(outfile, 'w')
-    fhandler = open(fnam)
-    # get the header
-    pos = 0
-    while True:
-        line = next(fhandler)
-        if not line.startswith('#'):
-            break
-        pos += len(line)
-        out.write(line)
-    fhandler.seek(pos)
-
-    current = set([v for v, _ in list(filter_handlers.values())])
-    count = 0
-    if reverse:
-        for line in fhandler:
-            read = line.split('\t', 1)[0]
-            if read in current:
-                count += 1
-                out.write(line)
-            else:
-                continue
-            # iterate over different filters to update current filters
-            for k in list(filter_handlers.keys()):
-                if read != filter_handlers[k][0]:
-                    continue
-                try: # get next line from filter file
-                    filter_handlers[k][0] = next(filter_handlers[k][1]).strip()
-                except StopIteration:
-                    filter_handlers[k][1].close()
-                    del filter_handlers[k]
-            current = set([v for v, _ in list(filter_handlers.values())])
+        selected |= 1 << k
+    keep = (flags & selected) != 0
+    if not reverse:
+        keep = ~keep
+    if is_binary_pairs(fnam):
+        count = _write_binary_subset(fnam, outfile, keep)
     else:
-        for line in fhandler:
-            read = line.split('\t', 1)[0]
-            if read not in current:
-                count += 1
-                out.write(line)
-                continue
-            # iterate over different filters to update current filters
-            for k in list(filter_handlers.keys()):
-                if read != filter_handlers[k][0]:
-                    continue
-                try: # get next line from filter file
-                    filter_handlers[k][0] = next(filter_handlers[k][1]).strip()
-                except StopIteration:
-                    filter_handlers[k][1].close()
-                    del filter_handlers[k]
-            current = set([v for v, _ in list(filter_handlers.values())])
+        count = _write_tsv_subset(fnam, outfile, keep)
     if verbose:
         print('    saving to file {:,} reads {}.'.format(
             count, 'with' if reverse else 'without'))
-    out.close()
-    fhandler.close()
     return count
 
 
+def bitmask_path(fnam):
+    """
+    :param fnam: path to a file of read pairs
+
+    :returns: default path of the bitmask of its filters
+    """
+    return fnam + '_filters.npy'
+
+
+def get_bitmask(fnam, masked, bitmask=None):
+    """
+    Bitmask of the filters of a file of read pairs: one uint16 per pair of
+    reads, aligned with fnam, with bit k set if the pair is filtered by
+    filter k.
+
+    The bitmask saved by :func:`pytadbit.mapping.filter.filter_reads` (or by a
+    previous call) is reused if neither fnam nor the filter files changed
+    since it was saved. Otherwise it is built from the filter files, in a
+    single pass over fnam, and saved next to fnam.
+
+    :param fnam: path to the file of read pairs
+    :param masked: dictionary given by the
+       :func:`pytadbit.mapping.filter.filter_reads`, the path to the bitmask
+       is added to it
+    :param None bitmask: path where to save the bitmask if it has to be
+       built (by default next to fnam, see
+       :func:`pytadbit.mapping.filter.bitmask_path`)
+
+    :returns: path to the bitmask (a numpy .npy file)
+    """
+    candidates = [masked[k]['bitmask'] for k in masked
+                  if masked[k].get('bitmask')] + [bitmask_path(fnam)]
+    for found in candidates:
+        if _valid_bitmask(fnam, masked, found):
+            bitmask = found
+            break
+    else:
+        bitmask = bitmask or bitmask_path(fnam)
+        _save_bitmask(_bitmask_from_filter_files(fnam, masked), masked, fnam,
+                      bitmask)
+    for k in masked:
+        masked[k]['bitmask'] = bitmask
+    return bitmask
+
+
+def _bitmask_stamp(fnam, masked):
+    """
+    size and modification time of the file of read pairs and of the filter
+    files
+    """
+    fnams = [fnam] + [masked[k]['fnam'] for k in sorted(masked)
+                      if 'fnam' in masked[k]]
+    return ''.join('%s\t%d\t%d\n' % (f, path.getsize(f), int(path.getmtime(f)))
+                   for f in fnams)
+
+
+def _valid_bitmask(fnam, masked, bitmask):
+    try:
+        with open(bitmask + '.stamp') as fhandler:
+            return fhandler.read() == _bitmask_stamp(fnam, masked)
+    except (IOError, OSError):
+        return False
+
+
+def _save_bitmask(flags, masked, fnam, bitmask):
+    npsave(bitmask, flags)
+    with open(bitmask + '.stamp', 'w') as out:
+        out.write(_bitmask_stamp(fnam, masked))
+    for k in masked:
+        masked[k]['bitmask'] = bitmask
+
+
+def _bitmask_from_filter_files(fnam, masked):
+    """
+    Bitmask of the filters from the filter files, the read IDs in filter files
+    being in the same order as in fnam
+    """
+    filter_handlers = {}
+    for k in masked:
+        if not 'fnam' in masked[k]:
+            continue
+        fh = open(masked[k]['fnam'])
+        val = next(fh, None)
+        if val is None:
+            fh.close()
+            continue
+        filter_handlers[k] = [val.strip(), fh]
+
+    def _current():
+        current = {}
+        for k, (val, _) in filter_handlers.items():
+            current[val] = current.get(val, 0) | (1 << k)
+        return current
+
+    if is_binary_pairs(fnam):
+        reads = iter_read_names(fnam)
+        fhandler = None
+    else:
+        fhandler = open(fnam)
+        reads = (line.split('\t', 1)[0] for line in fhandler)
+    flags = array('H')
+    current = _current()
+    header = fhandler is not None
+    for read in reads:
+        if header:
+            if read.startswith('#'):
+                continue
+            header = False
+        bits = current.get(read, 0)
+        flags.append(bits)
+        if not bits:
+            continue
+        # iterate over different filters to update current filters
+        for k in list(filter_handlers.keys()):
+            if read != filter_handlers[k][0]:
+                continue
+            val = next(filter_handlers[k][1], None)
+            if val is None:
+                filter_handlers[k][1].close()
+                del filter_handlers[k]
+            else:
+                filter_handlers[k][0] = val.strip()
+        current = _current()
+    if fhandler is not None:
+        fhandler.close()
+    for _, fh in filter_handlers.values():
+        fh.close()
+    return frombuffer(flags, dtype=uint16)
+
+
 def filter_reads(fnam, output=None, max_molecule_length=500,
                  over_represented=0.005, max_frag_size=100000,
                  min_frag_size=100, re_proximity=5, verbose=True,
                  savedata=None, min_dist_to_re=750, strict_duplicates=False,
-                 fast=True):
+                 fast=True, ncpus=4, bitmask=False):
     """
     Filter mapped pair of reads in order to remove experimental artifacts (e.g.
     dangling-ends, self-circle, PCR artifacts...)
@@ -143,8 +242,9 @@ def filter_reads(fnam, output=None, max_molecule_length=500,
           more than min_dist_to_re) from RE cutting site. Non-canonical
           enzyme activity or random physical breakage of the chromatin.
 
-    :param fnam: path to file containing the pair of reads in tsv format, file
-       generated by :func:`pytadbit.mapping.mapper.get_intersection`
+    :param fnam: path to file containing the pair of reads in tsv or in binary
+       pairs format, file generated by
+       :func:`pytadbit.mapping.get_intersection`
     :param None output: PATH where to write files containing IDs of filtered
        reads. Uses fnam by default.
     :param 500 max_molecule_length: facing reads that are within
@@ -161,7 +261,20 @@ def filter_reads(fnam, output=None, max_molecule_length=500,
        from a RE site (usually 1.5 times the insert size). Applied in filter 10
     :param None savedata: PATH where to write the number of reads retained by
        each filter
-    :param True fast: parallel version, requires 4 CPUs and more RAM memory
+    :param True fast: parallel version, all filters are computed in a single
+       pass over the input file (plus a first pass to count reads per
+       restriction fragment), splitting the file in ncpus chunks
+    :param 4 ncpus: number of CPUs used by the fast version
+    :param False bitmask: also store the result of all filters as a single
+       array with one uint16 per pair of reads (bit k set if the pair is
+       filtered by filter k), aligned with fnam, in output + '_filters.npy'.
+       The path of this file is stored under the key 'bitmask' of each filter
+       in the returned dictionary, and is used by
+       :func:`pytadbit.mapping.filter.apply_filter` and
+       :func:`pytadbit.parsers.hic_bam_parser.bed2D_to_BAMhic` as long as
+       fnam and the filter files do not change (see
+       :func:`pytadbit.mapping.filter.get_bitmask`). Only available with the
+       fast version, or with binary pairs input.
     :param False strict_duplicates: by default reads are considered duplicates if
        they coincide in genomic coordinates and strand; with strict_duplicates
        enabled, we also ask to consider read length (WARNING: this option is
@@ -181,7 +294,13 @@ def filter_reads(fnam, output=None, max_molecule_length=500,
     else:
         _filter_duplicates = _filter_duplicates_loose
 
-    if not fast: # mainly for debugging
+    if is_binary_pairs(fnam):
+        sub_mask, total = _filter_binary(
+            fnam, max_molecule_length, over_represented, max_frag_size,
+            min_frag_size, re_proximity, min_dist_to_re, strict_duplicates,
+            output, bitmask)
+        MASKED.update(sub_mask)
+    elif not fast: # mainly for debugging
         if verbose:
             print('filtering duplicates')
         sub_mask, total = _filter_duplicates(fnam, output)
@@ -197,23 +316,11 @@ def filter_reads(fnam, output=None, max_molecule_length=500,
             print('filtering over represented')
         MASKED.update(_filter_over_represented(fnam, over_represented, output))
     else:
-        pool = mu.Pool(4)
-        a = pool.apply_async(_filter_same_frag,
-                             args=(fnam, max_molecule_length, output))
-        b = pool.apply_async(_filter_from_res,
-                             args=(fnam, max_frag_size, min_dist_to_re,
-                                   re_proximity, min_frag_size, output))
-        c = pool.apply_async(_filter_over_represented,
-                             args=(fnam, over_represented, output))
-        d = pool.apply_async(_filter_duplicates,
-                             args=(fnam, output))
-        pool.close()
-        pool.join()
-        sub_mask, total = d.get()
+        sub_mask, total = _filter_fused(
+            fnam, max_molecule_length, over_represented, max_frag_size,
+            min_frag_size, re_proximity, min_dist_to_re, strict_duplicates,
+            output, ncpus, bitmask)
         MASKED.update(sub_mask)
-        MASKED.update(b.get())
-        MASKED.update(c.get())
-        MASKED.update(a.get())
 
     # if savedata or verbose:
     #     bads = len(frozenset().union(*[masked[k]['reads'] for k in masked]))
@@ -235,6 +342,260 @@ def filter_reads(fnam, output=None, max_molecule_length=500,
     return MASKED
 
 
+def _write_binary_subset(fnam, outfile, keep, chunk=100000):
+    """
+    Write the pairs of a binary pairs file for which keep is True
+    """
+    chromosomes, pairs = load_pairs(fnam)
+    out = BinaryPairsWriter(outfile, chromosomes)
+    names = iter_read_names(fnam)
+    for beg in range(0, len(pairs), chunk):
+        sub_keep = keep[beg:beg + chunk]
+        out.write_records(pairs[beg:beg + chunk][sub_keep],
+                          [n for n, k in zip(islice(names, len(sub_keep)),
+                                             sub_keep) if k])
+    out.close()
+    return out.nrecords
+
+
+def _write_tsv_subset(fnam, outfile, keep, chunk=100000):
+    """
+    Write the pairs of a tab separated file for which keep is True
+    """
+    out = open(outfile, 'w')
+    fhandler = open(fnam)
+    line = next(fhandler)
+    while line.startswith('#'):
+        out.write(line)
+        line = next(fhandler)
+    lines = [line]
+    lines.extend(islice(fhandler, chunk - 1))
+    beg = 0
+    while lines:
+        out.write(''.join(l for l, k in zip(lines,
+                                            keep[beg:beg + chunk].tolist())
+                          if k))
+        beg += chunk
+        lines = list(islice(fhandler, chunk))
+    fhandler.close()
+    out.close()
+    return int(keep.sum())
+
+
+def _split_by_offsets(fnam, nchunks):
+    """
+    Split the body of a tab separated file in chunks of similar size, at line
+    boundaries.
+
+    :returns: a list of tuples with the offset of the line preceding the chunk
+       (None for the first chunk), the offset of the first line of the chunk,
+       and the offset of the end of the chunk
+    """
+    fsize = path.getsize(fnam)
+    fhandler = open(fnam, 'rb')
+    # skip header
+    beg = 0
+    line = fhandler.readline()
+    while line.startswith(b'#'):
+        beg += len(line)
+        line = fhandler.readline()
+    bounds = [(None, beg)]
+    step = (fsize - beg) // nchunks
+    for i in range(1, nchunks):
+        fhandler.seek(beg + i * step)
+        fhandler.readline()  # most probably in the middle of a line
+        prev = fhandler.tell()
+        fhandler.readline()
+        pos = fhandler.tell()
+        if pos >= fsize or pos <= bounds[-1][1]:
+            continue
+        bounds.append((prev, pos))
+    fhandler.close()
+    return [(prev, pos, bounds[i + 1][1] if i + 1 < len(bounds) else fsize)
+            for i, (prev, pos) in enumerate(bounds)]
+
+
+def _count_frags_chunk(fnam, beg, end):
+    frag_count = {}
+    fhandler = open(fnam, 'rb')
+    fhandler.seek(beg)
+    pos = beg
+    for line in fhandler:
+        if pos >= end:
+            break
+        pos += len(line)
+        _, cr1, _, _, _, rs1, _, cr2, _, _, _, rs2, _ = line.split(b'\t')
+        try:
+            frag_count[(cr1, rs1)] += 1
+        except KeyError:
+            frag_count[(cr1, rs1)] = 1
+        try:
+            frag_count[(cr2, rs2)] += 1
+        except KeyError:
+            frag_count[(cr2, rs2)] = 1
+    fhandler.close()
+    return frag_count
+
+
+def _filter_chunk(fnam, prev, beg, end, over_frags, max_molecule_length,
+                  max_frag_size, min_frag_size, re_proximity, min_dist_to_re,
+                  strict_duplicates, outfiles, bitmask):
+    """
+    Classify each pair of reads of a chunk of fnam against filters 1 to 10.
+    The classification of each pair is stored as a bitmask (bit k set if
+    filtered by filter k), and the read ID is written to the file of each
+    filter matched.
+    """
+    all_flags = array('H')
+    counts = dict((k, 0) for k in outfiles)
+    outfil = dict((k, open(outfiles[k], 'wb')) for k in outfiles)
+    if strict_duplicates:
+        dup_cols = (1, 2, 7, 8, 3, 9, 4, 10)
+    else:
+        dup_cols = (1, 2, 7, 8, 3, 9)
+    fhandler = open(fnam, 'rb')
+    if prev is None:
+        fhandler.seek(beg)
+        prev_elts = None
+    else:  # the previous pair is needed to find duplicates
+        fhandler.seek(prev)
+        elts = fhandler.readline().split(b'\t')
+        prev_elts = tuple(elts[i] for i in dup_cols)
+    nlines = 0
+    pos = beg
+    for line in fhandler:
+        if pos >= end:
+            break
+        pos += len(line)
+        nlines += 1
+        elts = line.split(b'\t')
+        (read,
+         cr1, pos1, sd1, _, rs1, re1,
+         cr2, pos2, sd2, _, rs2, re2) = elts
+        ps1, ps2, sd1, sd2, rs1, re1, rs2, re2 = list(map(int, (
+            pos1, pos2, sd1, sd2, rs1, re1, rs2, re2)))
+        flags = 0
+        # same fragments
+        if cr1 == cr2:
+            if re1 == re2:
+                if sd1 != sd2:
+                    if (ps2 > ps1) == sd2:
+                        flags |= 1 << 1  # self-circle
+                    else:
+                        flags |= 1 << 2  # dangling-end
+                else:
+                    flags |= 1 << 3      # error
+            elif (abs(ps1 - ps2) < max_molecule_length
+                  and sd2 != sd1
+                  and (ps2 > ps1) != sd2):
+                flags |= 1 << 4          # extra dangling-end
+        # distance to RE sites
+        diff11 = re1 - ps1
+        diff12 = ps1 - rs1
+        diff21 = re2 - ps2
+        diff22 = ps2 - rs2
+        if ((diff11 < re_proximity) or
+            (diff12 < re_proximity) or
+            (diff21 < re_proximity) or
+            (diff22 < re_proximity)):
+            # multicontacts excluded if fragment is internal (not the first)
+            if not b'~' in read:
+                flags |= 1 << 5
+        if (((diff11 > min_dist_to_re) and
+             (diff12 > min_dist_to_re)) or
+            ((diff21 > min_dist_to_re) and
+             (diff22 > min_dist_to_re))):
+            flags |= 1 << 10             # random breaks
+        dif1 = re1 - rs1
+        dif2 = re2 - rs2
+        if (dif1 < min_frag_size) or (dif2 < min_frag_size):
+            flags |= 1 << 6
+        if (dif1 > max_frag_size) or (dif2 > max_frag_size):
+            flags |= 1 << 7
+        # over-represented
+        if (cr1, elts[5]) in over_frags or (cr2, elts[11]) in over_frags:
+            flags |= 1 << 8
+        # duplicates
+        new_elts = tuple(elts[i] for i in dup_cols)
+        if new_elts == prev_elts:
+            flags |= 1 << 9
+        prev_elts = new_elts
+        if bitmask:
+            all_flags.append(flags)
+        if not flags:
+            continue
+        for k in outfil:
+            if flags & (1 << k):
+                counts[k] += 1
+                outfil[k].write(read + b'\n')
+    fhandler.close()
+    for k in outfil:
+        outfil[k].close()
+    return counts, nlines, all_flags
+
+
+def _filter_fused(fnam, max_molecule_length, over_represented, max_frag_size,
+                  min_frag_size, re_proximity, min_dist_to_re,
+                  strict_duplicates, output, ncpus, bitmask):
+    """
+    Filters 1 to 10 computed in a single pass over the tab separated file of
+    pairs, split in ncpus chunks. Results are the same as with the individual
+    filter functions.
+    """
+    masked = dict((k, {'name': MASKED[k]['name'], 'reads': 0})
+                  for k in range(1, 11))
+    for k in masked:
+        masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
+    chunks = _split_by_offsets(fnam, ncpus)
+    pool = mu.Pool(ncpus)
+    # count reads per RE fragment to find over-represented ones
+    procs = [pool.apply_async(_count_frags_chunk, args=(fnam, beg, end))
+             for _, beg, end in chunks]
+    frag_count = procs[0].get()
+    for proc in procs[1:]:
+        for frag, val in proc.get().items():
+            try:
+                frag_count[frag] += val
+            except KeyError:
+                frag_count[frag] = val
+    num_frags = len(frag_count)
+    cut = int((1 - over_represented) * num_frags + 0.5)
+    # use cut-1 because it represents the length of the list
+    cut = sorted([frag_count[crm] for crm in frag_count])[cut - 1]
+    over_frags = set(frag for frag in frag_count if frag_count[frag] > cut)
+    del frag_count
+    # classify pairs
+    procs = []
+    for i, (prev, beg, end) in enumerate(chunks):
+        outfiles = dict((k, '%s_%03d' % (masked[k]['fnam'], i)) for k in masked)
+        procs.append((outfiles, pool.apply_async(
+            _filter_chunk, args=(fnam, prev, beg, end, over_frags,
+                                 max_molecule_length, max_frag_size,
+                                 min_frag_size, re_proximity, min_dist_to_re,
+                                 strict_duplicates, outfiles, bitmask))))
+    pool.close()
+    pool.join()
+    nlines = 0
+    flags = array('H')
+    outfil = dict((k, open(masked[k]['fnam'], 'wb')) for k in masked)
+    for outfiles, proc in procs:
+        counts, sub_lines, sub_flags = proc.get()
+        nlines += sub_lines
+        flags.extend(sub_flags)
+        for k in masked:
+            masked[k]['reads'] += counts[k]
+            with open(outfiles[k], 'rb') as fhandler:
+                copyfileobj(fhandler, outfil[k])
+            remove(outfiles[k])
+    for k in masked:
+        outfil[k].close()
+    if bitmask:
+        _save_bitmask(frombuffer(flags, dtype=uint16), masked, fnam,
+                      output + '_filters.npy')
+    # as in _filter_duplicates, the first pair is not counted
+    return masked, nlines - 1
+
+
 def _filter_same_frag(fnam, max_molecule_length, output):
     # t0 = time()
     masked = {1 : {'name': 'self-circle'       , 'reads': 0},
@@ -446,6 +807,99 @@ def _filter_over_represented(fnam, over_represented, output):
     return masked
 
 
+def _filter_binary(fnam, max_molecule_length, over_represented, max_frag_size,
+                   min_frag_size, re_proximity, min_dist_to_re,
+                   strict_duplicates, output, bitmask=False):
+    """
+    Vectorized version of filters 1 to 10 on a binary pairs file. Results are
+    the same as with the filters on the tab separated file (same counts and
+    same read ID files).
+    """
+    masked = dict((k, {'name': MASKED[k]['name'], 'reads': 0})
+                  for k in range(1, 11))
+    _, pairs = load_pairs(fnam)
+    nreads = len(pairs)
+    flags = zeros(nreads, dtype=uint16)
+    if not nreads:
+        total = 0
+    else:
+        get = lambda col: pairs[col].astype(int64)
+        ps1, ps2 = get('pos1'), get('pos2')
+        sd1, sd2 = get('sd1'), get('sd2')
+        rs1, re1 = get('rs1'), get('re1')
+        rs2, re2 = get('rs2'), get('re2')
+        same_crm = pairs['cr1'] == pairs['cr2']
+        # same fragment (1 to 4)
+        same_frag = same_crm & (re1 == re2)
+        diff_strand = sd1 != sd2
+        inward = (ps2 > ps1) != sd2
+        flags[same_frag & diff_strand & ~inward] |= 1 << 1
+        flags[same_frag & diff_strand &  inward] |= 1 << 2
+        flags[same_frag & ~diff_strand] |= 1 << 3
+        flags[same_crm & ~same_frag & diff_strand & inward &
+              (abs(ps1 - ps2) < max_molecule_length)] |= 1 << 4
+        # distance to RE sites (5, 6, 7, 10)
+        diff11 = re1 - ps1
+        diff12 = ps1 - rs1
+        diff21 = re2 - ps2
+        diff22 = ps2 - rs2
+        # multicontacts excluded if fragment is internal (not the first)
+        flags[((diff11 < re_proximity) | (diff12 < re_proximity) |
+               (diff21 < re_proximity) | (diff22 < re_proximity)) &
+              ~pairs['multi']] |= 1 << 5
+        flags[((diff11 > min_dist_to_re) & (diff12 > min_dist_to_re)) |
+              ((diff21 > min_dist_to_re) & (diff22 > min_dist_to_re))] |= 1 << 10
+        dif1 = re1 - rs1
+        dif2 = re2 - rs2
+        flags[(dif1 < min_frag_size) | (dif2 < min_frag_size)] |= 1 << 6
+        flags[(dif1 > max_frag_size) | (dif2 > max_frag_size)] |= 1 << 7
+        del diff11, diff12, diff21, diff22, dif1, dif2, inward, same_frag
+        # over-represented (8)
+        frags = concatenate(((pairs['cr1'].astype(int64) << 32) | rs1,
+                             (pairs['cr2'].astype(int64) << 32) | rs2))
+        _, frag_idx, frag_count = unique(frags, return_inverse=True,
+                                         return_counts=True)
+        cut = int((1 - over_represented) * len(frag_count) + 0.5)
+        # use cut-1 because it represents the length of the list
+        cut = sort(frag_count)[cut - 1]
+        frag_count = frag_count[frag_idx]
+        flags[(frag_count[:nreads] > cut) | (frag_count[nreads:] > cut)] |= 1 << 8
+        del frags, frag_idx, frag_count
+        # duplicates (9), consecutive pairs
+        dups = ones(nreads - 1, dtype=bool)
+        cols = ['cr1', 'pos1', 'cr2', 'pos2', 'sd1', 'sd2']
+        if strict_duplicates:
+            cols += ['l1', 'l2']
+        for col in cols:
+            dups &= pairs[col][1:] == pairs[col][:-1]
+        flags[1:][dups] |= 1 << 9
+        # as in the tsv version, the first pair is not counted
+        total = nreads - 1
+
+    outfil = {}
+    for k in masked:
+        masked[k]['reads'] = int(((flags >> k) & 1).sum())
+        masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
+        outfil[k] = open(masked[k]['fnam'], 'w')
+    bad = iter(flatnonzero(flags).tolist())
+    next_bad = next(bad, None)
+    for pos, read in enumerate(iter_read_names(fnam)):
+        if pos != next_bad:
+            continue
+        flag = int(flags[pos])
+        for k in masked:
+            if flag & (1 << k):
+                outfil[k].write(read + '\n')
+        next_bad = next(bad, None)
+        if next_bad is None:
+            break
+    for k in masked:
+        outfil[k].close()
+    if bitmask:
+        _save_bitmask(flags, masked, fnam, output + '_filters.npy')
+    return masked, total
+
+
 def _filter_yannick(fnam, maxlen, de_left, de_right, output):
     # t0 = time()
     masked = {11: {'name': 'Y Dangling L', 'reads': 0},
@@ -18,7 +18,7 @@ from pytadbit.utils.file_handling import magic_open, get_free_space_mb
 from pytadbit.parsers.sam_parser import parse_gem_3c, merge_sort
 from pytadbit.mapping.restriction_enzymes import religateds
 from pytadbit.mapping.restriction_enzymes import RESTRICTION_ENZYMES
-from pytadbit.mapping.restriction_enzymes import map_re_sites
+from pytadbit.mapping.restriction_enzymes import map_re_sites_array
 from pytadbit.mapping.restriction_enzymes import iupac2regex
 
 try:
@@ -851,8 +851,7 @@ def fast_fragment_mapping(mapper_index_path, fastq_path1, fastq_path2, r_enz,
     os.system(samtools + ' sort -n -O SAM -@ %d -T %s -o %s %s'
                       % (nthreads, out_map_path, out_map_path, out_map_path))
     genome_lengths = dict((crm, len(genome_seq[crm])) for crm in genome_seq)
-    frag_chunk = kwargs.get('frag_chunk', 100000)
-    frags = map_re_sites(r_enz, genome_seq, frag_chunk=frag_chunk)
+    frags = map_re_sites_array(r_enz, genome_seq)
     if samtools and nthreads > 1:
         print('Splitting sam file')
         # headers
@@ -891,30 +890,20 @@ def fast_fragment_mapping(mapper_index_path, fastq_path1, fastq_path2, r_enz,
                 os.system('rm -f %s_%d' % (out_map_path,(i+1)))
 
         #Final sort and merge
-        nround = 0
-        while len(results) > 1:
-            nround += 1
-            num_procs = min(nthreads,int(len(results)/2))
-            pool = mu.Pool(num_procs)
-            procs = [pool.apply_async(
-                merge_sort,
-                (results.pop(0), results.pop(0), out_map_path+'_%d' % nround, i, True)
-            ) for i in range(num_procs)]
-            pool.close()
-            pool.join()
-            results = [proc.get() for proc in procs if proc.get()]
+        merged = merge_sort(results, out_map_path, 0, paired=True)
 
         map_out = open(out_map, 'w')
-        tmp_reads_fh = open(results[0],'r')
+        tmp_reads_fh = open(merged,'r')
         for crm in genome_seq:
             map_out.write('# CRM %s\t%d\n' % (crm, len(genome_seq[crm])))
         for read_line in tmp_reads_fh:
             read = read_line.split('\t')
             map_out.write('\t'.join([read[0]]+read[2:8]+read[9:]))
         map_out.close()
+        tmp_reads_fh.close()
         if clean:
-            print('   x removing tmp mapped %s' % results[0])
-            os.system('rm -f %s' % (results[0]))
+            print('   x removing tmp mapped %s' % merged)
+            os.remove(merged)
 
     else:
         print('Parsing result...')
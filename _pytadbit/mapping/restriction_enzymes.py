@@ -7,9 +7,13 @@ from __future__ import print_function
 
 from re import compile
 from warnings import warn
+from hashlib import md5
+from os import path
 
 from collections import OrderedDict
 from scipy.stats import binom_test
+from numpy import array, int64, searchsorted, maximum, where, asarray
+from numpy import savez, load as npload
 
 from pytadbit.utils.file_handling import magic_open
 
@@ -199,6 +203,115 @@ def map_re_sites(enzyme_name, genome_seq, frag_chunk=100000, verbose=False):
     return frags
 
 
+def map_re_sites_array(enzyme_name, genome_seq, cache_dir=None,
+                       genome_path=None, verbose=False):
+    """
+    map all restriction enzyme (RE) sites of a given enzyme in a genome (see
+    :func:`pytadbit.mapping.restriction_enzymes.map_re_sites` for the
+    definition of the position of a RE site).
+
+    :param enzyme_name: name of the enzyme to map (upper/lower case are
+       important), or list of names
+    :param genome_seq: a dictionary containing the genomic sequence by
+       chromosome
+    :param None cache_dir: directory where to store the RE sites found. The
+       cache file is named after the enzymes, the chromosomes (names and
+       lengths) and the path, size and modification time of the FASTA
+       file(s), and is loaded instead of searching the genome if it exists
+    :param None genome_path: path, or list of paths, to the FASTA file(s) from
+       which genome_seq was parsed. Needed to use the cache
+
+    :returns: a dictionary with, for each chromosome, a sorted numpy array of
+       RE sites, starting with 1 and ending with the length of the chromosome.
+       To be used with :func:`pytadbit.mapping.restriction_enzymes.find_re_sites`
+    """
+    if isinstance(enzyme_name, basestring):
+        enzyme_names = [enzyme_name]
+    else:
+        enzyme_names = enzyme_name
+    enzymes = OrderedDict()
+    for name in sorted(enzyme_names):
+        enzymes[name] = RESTRICTION_ENZYMES[name]
+
+    if cache_dir and not genome_path:
+        warn('WARNING: RE sites not cached, path to the genome needed')
+        cache_dir = None
+    if cache_dir:
+        if isinstance(genome_path, basestring):
+            genome_path = [genome_path]
+        digest = md5(' '.join('%s:%s' % (n, enzymes[n]) for n in enzymes).encode())
+        for fnam in genome_path:
+            digest.update(('%s\t%d\t%d\n' % (
+                path.abspath(fnam), path.getsize(fnam),
+                int(path.getmtime(fnam)))).encode())
+        for crm in genome_seq:
+            digest.update(('%s\t%d\n' % (crm, len(genome_seq[crm]))).encode())
+        cache_path = path.join(cache_dir, '_RE_sites_%s.npz' % (
+            digest.hexdigest()[:10]))
+        if path.exists(cache_path):
+            if verbose:
+                print('Loading cached RE sites')
+            cached = npload(cache_path)
+            return OrderedDict((crm, cached[crm]) for crm in genome_seq)
+
+    # we match the full cut-site but report the position after the cut site
+    # (third group of the regexp)
+    restring = ('%s') % ('|'.join(['(?<=%s(?=%s))' % tuple(enzymes[n].split('|'))
+                                   for n in enzymes]))
+    # IUPAC conventions
+    restring = iupac2regex(restring)
+
+    enz_pattern = compile(restring)
+
+    frags = OrderedDict()
+    count = 0
+    for crm in genome_seq:
+        seq = genome_seq[crm]
+        sites = [1]
+        sites.extend(match.end() + 1 for match in enz_pattern.finditer(seq))
+        count += len(sites) - 1
+        # at the end we add the chromosome length
+        sites.append(len(seq))
+        frags[crm] = array(sites, dtype=int64)
+    if verbose:
+        print('Found %d RE sites' % count)
+    if cache_dir:
+        try:
+            savez(cache_path, **frags)
+        except IOError:
+            warn('WARNING: could not write RE sites cache in %s' % cache_dir)
+    return frags
+
+
+def find_re_sites(re_sites, positions, lengths=None):
+    """
+    Find the RE sites surrounding a batch of read positions.
+
+    :param re_sites: sorted array of RE sites of one chromosome, as returned by
+       :func:`pytadbit.mapping.restriction_enzymes.map_re_sites_array`
+    :param positions: array of read positions in this chromosome
+    :param None lengths: array of mapped lengths of the reads. Reads beyond the
+       end of the chromosome are moved to its last nucleotide, unless they are
+       farther than their mapped length.
+
+    :returns: positions (corrected for reads beyond the end of the chromosome),
+       position of the RE sites upstream, and position of the RE sites
+       downstream
+    """
+    positions = asarray(positions, dtype=int64)
+    last = re_sites[-1]
+    outside = positions >= last
+    if outside.any():
+        # case where part of the read is mapped outside chromosome
+        if lengths is not None and (
+                positions - last + 1 >= asarray(lengths))[outside].any():
+            raise Exception('Read mapped mostly outside ' +
+                            'chromosome\n(also reference genome can be truncated)')
+        positions = where(outside, last - 1, positions)
+    idx = searchsorted(re_sites, positions, side='right')
+    return positions, re_sites[maximum(idx - 1, 0)], re_sites[idx]
+
+
 def complementary(seq):
     trs = dict([(nt1, nt2) for nt1, nt2 in zip('ATGCN', 'TACGN')])
     return ''.join([trs[s] for s in seq[::-1]])
@@ -195,6 +195,10 @@ def generate_3d_models(zscores, resolution, nloci, start=1, n_models=5000,
     HiCRestraints = HiCBasedRestraints(nloci, RADIUS, CONFIG, resolution,
                                        zscores, chromosomes=coords,
                                        close_bins=close_bins, first=first)
+    if use_HiC:
+        # restraints computed once here, and found in cache by the processes
+        # (forked afterwards) generating each model
+        HiCRestraints.get_hicbased_restraints()
 
     models, bad_models = multi_process_model_generation(
         n_cpus, n_models, n_keep, keep_all, HiCRestraints,
@@ -252,24 +256,23 @@ def multi_process_model_generation(n_cpus, n_models, n_keep, keep_all,HiCRestrai
     Parallelize the
     :func:`pytadbit.modelling.imp_model.StructuralModels.generate_IMPmodel`.
 
+    Restraints and parameters are given once to each worker process (see
+    :func:`_init_model_worker`), each worker then generating models until
+    all are done.
+
     :param n_cpus: number of CPUs to use
     :param n_models: number of models to generate
     """
 
-    pool = mu.Pool(n_cpus, maxtasksperchild=1)
-    jobs = {}
-    for rand_init in range(START, n_models + START):
-        jobs[rand_init] = pool.apply_async(generate_IMPmodel,
-                                           args=(rand_init,HiCRestraints, use_HiC,
-                                                 use_confining_environment, use_excluded_volume,
-                                                 single_particle_restraints))
-
+    pool = mu.Pool(n_cpus, initializer=_init_model_worker,
+                   initargs=(HiCRestraints, use_HiC, use_confining_environment,
+                             use_excluded_volume, single_particle_restraints))
+    # models collected as soon as they are generated
+    results = list(pool.imap_unordered(_generate_IMPmodel_job,
+                                       range(START, n_models + START)))
     pool.close()
     pool.join()
-
-    results = []
-    for rand_init in range(START, n_models + START):
-        results.append((rand_init, jobs[rand_init].get()))
+    results.sort(key=lambda x: x[0])
 
     models = {}
     bad_models = {}
@@ -283,6 +286,27 @@ def multi_process_model_generation(n_cpus, n_models, n_keep, keep_all,HiCRestrai
     return models, bad_models
 
 
+# restraints and parameters shared by all the models generated in a worker
+# process
+_WORKER_ARGS = {}
+
+def _init_model_worker(HiCRestraints, use_HiC, use_confining_environment,
+                       use_excluded_volume, single_particle_restraints):
+    """
+    Initializer of the worker processes of
+    :func:`multi_process_model_generation`: keeps the arguments of
+    :func:`generate_IMPmodel`, passed only once to each worker.
+    """
+    _WORKER_ARGS.update(
+        HiCRestraints=HiCRestraints, use_HiC=use_HiC,
+        use_confining_environment=use_confining_environment,
+        use_excluded_volume=use_excluded_volume,
+        single_particle_restraints=single_particle_restraints)
+
+
+def _generate_IMPmodel_job(rand_init):
+    return rand_init, generate_IMPmodel(rand_init, **_WORKER_ARGS)
+
 
 def generate_IMPmodel(rand_init, HiCRestraints,use_HiC=True, use_confining_environment=True,
                       use_excluded_volume=True, single_particle_restraints=None):
@@ -333,9 +357,10 @@ def generate_IMPmodel(rand_init, HiCRestraints,use_HiC=True, use_confining_envir
 
     # Add restraints on single particles
     if single_particle_restraints:
-        for ap in single_particle_restraints:
-            ap[1] = [(c / SCALE) for c in ap[1]]
-            ap[4] /= SCALE
+        # scaled copy, the same restraints being used for all models
+        single_particle_restraints = [
+            [ap[0], [(c / SCALE) for c in ap[1]]] + list(ap[2:4]) +
+            [ap[4] / SCALE] + list(ap[5:]) for ap in single_particle_restraints]
         # This function is specific for IMP
         add_single_particle_restraints(model, single_particle_restraints)
 
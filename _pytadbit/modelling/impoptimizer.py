@@ -8,8 +8,10 @@ from pytadbit.modelling.imp_modelling    import generate_3d_models
 from pytadbit.utils.extraviews     import plot_2d_optimization_result
 from pytadbit.utils.extraviews     import plot_3d_optimization_result
 from pytadbit.modelling.structuralmodels import StructuralModels
-from pickle                        import dump, load
+from pickle                        import dump, load, UnpicklingError
 from sys                           import stderr
+from os.path                       import exists, getsize
+from hashlib                       import md5
 import itertools
 import numpy           as np
 import multiprocessing as mu
@@ -19,6 +21,11 @@ try:
 except NameError:
     basestring = str
 
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
 class IMPoptimizer(object):
     """
     This class optimizes a set of parameters (scale, kbending, maxdist, lowfreq, and
@@ -114,7 +121,7 @@ class IMPoptimizer(object):
                         upfreq_range=(0, 1, 0.1),
                         dcutoff_range=2,
                         corr='spearman', off_diag=1,
-                        savedata=None, n_cpus=1, verbose=True,
+                        savedata=None, n_cpus=1, n_jobs=1, verbose=True,
                         use_HiC=True, use_confining_environment=True,
                         use_excluded_volume=True):
         """
@@ -124,6 +131,8 @@ class IMPoptimizer(object):
         The range can be expressed as a list.
 
         :param n_cpus: number of CPUs to use
+        :param 1 n_jobs: number of sets of parameters to model at the same time,
+           each using its share of the n_cpus to generate its models
         :param 0.01 scale_range: upper and lower bounds used to search for
            the optimal scale parameter (unit nm per nucleotide). The last value of
            the input tuple is the incremental step for scale parameter values
@@ -145,7 +154,13 @@ class IMPoptimizer(object):
            from which to consider 2 beads as being close). The last value of the
            input tuple is the incremental step for scale parameter values.
         :param None savedata: concatenate all generated models into a dictionary
-           and save it into a file named by this argument
+           and save it into a file named by this argument. The models of each
+           set of parameters are appended to this file as soon as generated,
+           with their correlations. If the file already exists, the sets of
+           parameters it contains are not modelled again (to resume an
+           interrupted optimization). The file starts with a header
+           identifying the z-scores, number of particles and resolution
+           optimized, and cannot be resumed with other ones
         :param True verbose: print the results to the standard output
         """
         if verbose:
@@ -259,7 +274,6 @@ class IMPoptimizer(object):
                                         self.dcutoff_range)
 
         # These commands perform the grid search of the best parameters
-        models = {}
         count = 0
         if verbose:
             stderr.write('  %-4s%-5s\t%-8s\t%-7s\t%-7s\t%-6s\t%-7s\t%-11s\n' % (
@@ -270,17 +284,50 @@ class IMPoptimizer(object):
                                             [my_round(i) for i in lowfreq_arange ],
                                             [my_round(i) for i in upfreq_arange  ])
 
+        # optimizations already done, indexed by set of parameters
+        done = {}
+        for k in self.results:
+            done.setdefault(tuple(k[:5]), k)
+
+        # models saved by a previous (possibly interrupted) run of the same
+        # optimization are not generated again, new models are appended to
+        # them
+        saved = {}
+        if savedata:
+            header = self._savedata_header()
+            if exists(savedata) and getsize(savedata):
+                if _load_header(savedata) != header:
+                    raise Exception(
+                        'ERROR: %s does not hold models of this optimization '
+                        '(different z-scores, number of particles or '
+                        'resolution)\n' % savedata)
+                for k, svd in _load_models(savedata, repair=True).items():
+                    saved[tuple(k[:5])] = svd
+            else:
+                out = open(savedata, 'wb')
+                dump({'header': header}, out)
+                out.close()
 
-        #for (scale, maxdist, upfreq, lowfreq, kbending) in zip([my_round(i) for i in scale_arange  ],
+        pending = []
+        queued = set()
         for (scale, kbending, maxdist, lowfreq, upfreq) in parameters_sets:
-            #print (scale, kbending, maxdist, lowfreq, upfreq)
+            params = (scale, kbending, maxdist, lowfreq, upfreq)
+            if not params in done and params in saved:
+                try:
+                    for cutoff, result in _saved_correlations(
+                            saved[params], self.values, scale,
+                            self.resolution, dcutoff_arange, corr, off_diag):
+                        self.results[params + (float(cutoff), )] = result
+                        done.setdefault(params, params + (float(cutoff), ))
+                except Exception as e:
+                    # not modelled again, not to append the models twice
+                    print('  SKIPPING: %s' % e)
+                    continue
 
             # This check whether this optimization has been already done for this set of parameters
-            if (scale, kbending, maxdist, lowfreq, upfreq) in [tuple(k[:5]) for k in self.results]:
-                k = [k for k in self.results
-                     if (scale, kbending, maxdist, lowfreq, upfreq) == tuple(k[:5])
-                ][0]
-                result = self.results[(scale, kbending, maxdist, lowfreq, upfreq, k[-1])]
+            if params in done:
+                k = done[params]
+                result = self.results[k]
                 if verbose:
                     verb = '  %-5s\t%-5s\t%-8s\t%-7s\t%-7s\t%-6s\t%-7s\t' % (
                         'xx', scale, kbending, maxdist, lowfreq, upfreq, k[-1])
@@ -289,63 +336,46 @@ class IMPoptimizer(object):
                     else:
                         print(verb + str(round(result, 4)))
                 continue
+            if not params in queued:
+                queued.add(params)
+                pending.append(params)
+
+        # sets of parameters are modelled in parallel, the CPUs left being used
+        # to generate the models of each set
+        n_jobs = max(1, min(n_jobs, n_cpus, len(pending)))
+        kwargs = dict(zscores=self.zscores, resolution=self.resolution,
+                      nloci=self.nloci, n_models=self.n_models,
+                      n_keep=self.n_keep, n_cpus=max(1, n_cpus // n_jobs),
+                      first=0, values=self.values, container=self.container,
+                      coords=self.coords, close_bins=self.close_bins,
+                      zeros=self.zeros, use_HiC=use_HiC,
+                      use_confining_environment=use_confining_environment,
+                      use_excluded_volume=use_excluded_volume,
+                      single_particle_restraints=self.single_particle_restraints)
+        for params, results, svd, error in _run_parameter_sets(
+                pending, n_jobs, kwargs, dcutoff_arange, corr, off_diag,
+                savedata):
+            count += 1
+            scale, kbending, maxdist, lowfreq, upfreq = params
+            for cutoff, result in results:
+                if verbose:
+                    verb = '  %-4s%-5s\t%-8s\t%-7s\t%-7s\t%-6s\t%-7s' % (
+                        count, scale, kbending, maxdist, lowfreq, upfreq, cutoff)
+                    if verbose == 2:
+                        stderr.write(verb + str(round(result, 4)) + '\n')
+                    else:
+                        print(verb + str(round(result, 4)))
 
-            config_tmp = {'kforce'   : 5,
-                          'scale'    : float(scale),
-                          'kbending' : float(kbending),
-                          'lowrdist' : 100, # This parameters is fixed to XXX
-                          'maxdist'  : float(maxdist),
-                          'lowfreq'  : float(lowfreq),
-                          'upfreq'   : float(upfreq)}
-
-            try:
-                count += 1
-                tdm = generate_3d_models(
-                    self.zscores, self.resolution,
-                    self.nloci, n_models=self.n_models,
-                    n_keep=self.n_keep, config=config_tmp,
-                    n_cpus=n_cpus, first=0,
-                    values=self.values, container=self.container,
-                    coords = self.coords, close_bins=self.close_bins,
-                    zeros=self.zeros, use_HiC=use_HiC,
-                    use_confining_environment=use_confining_environment,
-                    use_excluded_volume=use_excluded_volume,
-                    single_particle_restraints=self.single_particle_restraints)
-                result = 0
-                cutoff = my_round(dcutoff_arange[0])
-
-                matrices = tdm.get_contact_matrix(
-                    cutoff=[i * self.resolution * float(scale) for i in dcutoff_arange])
-                for m in matrices:
-                    cut = m**0.5
-                    result = tdm.correlate_with_real_data(cutoff=cut, corr=corr,
-                                                          off_diag=off_diag,
-                                                          contact_matrix=matrices[m])[0]
-
-                    cutoff = my_round(float(cut) / self.resolution / float(scale))
-                    if verbose:
-                        verb = '  %-4s%-5s\t%-8s\t%-7s\t%-7s\t%-6s\t%-7s' % (
-                            count, scale, kbending, maxdist, lowfreq, upfreq, cutoff)
-                        if verbose == 2:
-                            stderr.write(verb + str(round(result, 4)) + '\n')
-                        else:
-                            print(verb + str(round(result, 4)))
-
-                    # Store the correlation for the TADbit parameters set
-                    self.results[(scale, kbending, maxdist, lowfreq, upfreq, float(cutoff))] = result
-            except Exception as e:
-                print('  SKIPPING: %s' % e)
-                result = 0
-                cutoff = my_round(dcutoff_arange[0])
-
-            if savedata and result:
-                models[(scale, kbending, maxdist, lowfreq, upfreq, cutoff)] = \
-                    tdm._reduce_models(minimal=["restraints", "zscores", "original_data"])
+                # Store the correlation for the TADbit parameters set
+                self.results[params + (float(cutoff), )] = result
+            if error:
+                print('  SKIPPING: %s' % error)
 
-        if savedata:
-            out = open(savedata, 'wb')
-            dump(models, out)
-            out.close()
+            # checkpoint, models are appended to savedata as soon as generated
+            if svd is not None:
+                out = open(savedata, 'ab')
+                dump({params + (results[-1][0], ): svd}, out)
+                out.close()
 
         self.kbending_range.sort( key=float)
         self.scale_range.sort(  key=float)
@@ -354,6 +384,19 @@ class IMPoptimizer(object):
         self.upfreq_range.sort( key=float)
         self.dcutoff_range.sort(key=float)
 
+    def _savedata_header(self):
+        """
+        :returns: the header of the file of models saved by run_grid_search,
+           identifying the z-scores, number of particles and resolution
+           optimized
+        """
+        zscores = ';'.join('%s,%s,%r' % (i, j, float(self.zscores[i][j]))
+                           for i in sorted(self.zscores or {})
+                           for j in sorted(self.zscores[i]))
+        return {'zscores'   : md5(zscores.encode()).hexdigest(),
+                'nloci'     : self.nloci,
+                'resolution': self.resolution}
+
     def load_grid_search_OLD(self, filenames, corr='spearman', off_diag=1,
                          verbose=True, n_cpus=1):
         """
@@ -372,9 +415,7 @@ class IMPoptimizer(object):
             filenames = [filenames]
         models = {}
         for filename in filenames:
-            inf = open(filename)
-            models.update(load(inf))
-            inf.close()
+            models.update(_load_models(filename))
         count = 0
         pool = mu.Pool(n_cpus, maxtasksperchild=1)
         jobs = {}
@@ -414,6 +455,9 @@ class IMPoptimizer(object):
         with real data. Useful to run different correlation on the same data
         avoiding to re-calculate each time the models.
 
+        The correlations saved by run_grid_search with the same corr and
+        off_diag are used as they are.
+
         :param filenames: either a path to a file or a list of paths.
         :param spearman corr: correlation coefficient to use
         'param 1 off_diag:
@@ -424,14 +468,22 @@ class IMPoptimizer(object):
             filenames = [filenames]
         models = {}
         for filename in filenames:
-            inf = open(filename)
-            models.update(load(inf))
-            inf.close()
+            models.update(_load_models(filename))
         count = 0
         pool = mu.Pool(n_cpus, maxtasksperchild=1)
         jobs = {}
+        results = {}
         for scale, kbending, maxdist, lowfreq, upfreq, dcutoff in models:
             svd = models[(scale, kbending, maxdist, lowfreq, upfreq, dcutoff)]
+            grid = svd.get('grid_search')
+            if grid and (grid['corr'], grid['off_diag']) == (corr, off_diag):
+                for cutoff, result in grid['correlations']:
+                    results[(scale, kbending, maxdist, lowfreq, upfreq,
+                             float(cutoff))] = result
+                continue
+            # the models saved by run_grid_search do not keep the Hi-C data
+            if svd['original_data'] is None:
+                svd['original_data'] = self.values
             jobs[(scale, kbending, maxdist, lowfreq, upfreq, dcutoff)] = pool.apply_async(
                 _mu_correlate, args=(svd, corr, off_diag,
                                      scale, kbending, maxdist, lowfreq, upfreq, dcutoff,
@@ -439,9 +491,11 @@ class IMPoptimizer(object):
             count += 1
         pool.close()
         pool.join()
-        for scale, kbending, maxdist, lowfreq, upfreq, dcutoff in models:
+        for key in jobs:
+            results[key] = jobs[key].get()
+        for scale, kbending, maxdist, lowfreq, upfreq, dcutoff in results:
             self.results[(scale, kbending, maxdist, lowfreq, upfreq, dcutoff)] = \
-                                 jobs[(scale, kbending, maxdist, lowfreq, upfreq, dcutoff)].get()
+                                 results[(scale, kbending, maxdist, lowfreq, upfreq, dcutoff)]
             if not scale in self.scale_range:
                 self.scale_range.append(scale)
             if not kbending in self.kbending_range:
@@ -737,3 +791,178 @@ def _mu_correlate(svd, corr, off_diag, scale, kbending, maxdist, lowfreq, upfreq
     except Exception as e:
         print('ERROR %s' % e)
     return result
+
+
+def _load_models(filename, repair=False):
+    """
+    Loads the models saved by IMPoptimizer.run_grid_search, one dictionary
+    being appended to the file for each set of parameters (after the header,
+    not returned).
+
+    :param False repair: truncate the file after the last complete
+       dictionary (i.e. if the optimization was interrupted while writing)
+    """
+    models = {}
+    inf = open(filename, 'rb')
+    good = 0
+    while True:
+        try:
+            record = load(inf)
+        except EOFError:
+            break
+        except UnpicklingError:
+            break
+        record.pop('header', None)
+        models.update(record)
+        good = inf.tell()
+    inf.seek(0, 2)
+    size = inf.tell()
+    inf.close()
+    if repair and good < size:
+        out = open(filename, 'r+b')
+        out.truncate(good)
+        out.close()
+    return models
+
+
+def _load_header(filename):
+    """
+    :returns: the header written at the beginning of the file of models by
+       IMPoptimizer.run_grid_search (None if there is none)
+    """
+    inf = open(filename, 'rb')
+    try:
+        record = load(inf)
+    except (EOFError, UnpicklingError):
+        record = None
+    inf.close()
+    if isinstance(record, dict):
+        return record.get('header')
+
+
+def _saved_correlations(svd, values, scale, resolution, dcutoff_arange, corr,
+                        off_diag):
+    """
+    :returns: the list of distance cutoffs and corresponding correlations of
+       the models saved by IMPoptimizer.run_grid_search, as saved if computed
+       the same way, otherwise computed from the saved models and the given
+       Hi-C data
+    """
+    grid = svd.get('grid_search', {})
+    saved = dict(grid.get('correlations', []))
+    cutoffs = [my_round(i) for i in dcutoff_arange]
+    if ((grid.get('corr'), grid.get('off_diag')) == (corr, off_diag) and
+        all(cutoff in saved for cutoff in cutoffs)):
+        return [(cutoff, saved[cutoff]) for cutoff in cutoffs]
+    tdm = StructuralModels(
+        nloci=svd['nloci'], models=svd['models'],
+        bad_models=svd['bad_models'], resolution=svd['resolution'],
+        original_data=values, clusters=svd['clusters'],
+        config=svd['config'], zscores=svd['zscore'], zeros=svd['zeros'])
+    return _correlate_models(tdm, scale, resolution, dcutoff_arange, corr,
+                             off_diag)
+
+
+def _correlate_models(tdm, scale, resolution, dcutoff_arange, corr, off_diag):
+    """
+    :returns: the list of distance cutoffs (rounded, in number of beads) and
+       corresponding correlations of the models with the real data
+    """
+    results = []
+    matrices = tdm.get_contact_matrix(
+        cutoff=[i * resolution * float(scale) for i in dcutoff_arange])
+    for m in matrices:
+        cut = m**0.5
+        result = tdm.correlate_with_real_data(cutoff=cut, corr=corr,
+                                              off_diag=off_diag,
+                                              contact_matrix=matrices[m])[0]
+        results.append((my_round(float(cut) / resolution / float(scale)), result))
+    return results
+
+
+def _model_parameter_set(params, kwargs, dcutoff_arange, corr, off_diag,
+                         savedata):
+    """
+    Generates the models of one set of parameters and correlates them with the
+    real data.
+
+    :returns: the set of parameters, the list of cutoffs and correlations
+       computed, the reduced models to be saved with these correlations (None
+       if not savedata) and the error message if any
+    """
+    scale, kbending, maxdist, lowfreq, upfreq = params
+    config_tmp = {'kforce'   : 5,
+                  'scale'    : float(scale),
+                  'kbending' : float(kbending),
+                  'lowrdist' : 100, # This parameters is fixed to XXX
+                  'maxdist'  : float(maxdist),
+                  'lowfreq'  : float(lowfreq),
+                  'upfreq'   : float(upfreq)}
+    results = []
+    try:
+        tdm = generate_3d_models(config=config_tmp, **kwargs)
+        results = _correlate_models(tdm, scale, kwargs['resolution'],
+                                    dcutoff_arange, corr, off_diag)
+    except Exception as e:
+        return params, results, None, str(e)
+    svd = None
+    if savedata and results and results[-1][1]:
+        svd = tdm._reduce_models(minimal=["restraints", "zscores", "original_data"])
+        svd['grid_search'] = {'parameters'  : params,
+                              'corr'        : corr,
+                              'off_diag'    : off_diag,
+                              'correlations': results}
+    return params, results, svd, None
+
+
+def _parameter_set_worker(tasks, done, *args):
+    for params in iter(tasks.get, None):
+        done.put(_model_parameter_set(params, *args))
+
+
+def _run_parameter_sets(parameters_sets, n_jobs, *args):
+    """
+    Yields the results of _model_parameter_set for each set of parameters, as
+    they are completed.
+
+    With more than one job, the sets of parameters are distributed among
+    n_jobs processes. These are not daemonic, as each one starts its own pool
+    of processes to generate the models.
+    """
+    if n_jobs == 1:
+        for params in parameters_sets:
+            yield _model_parameter_set(params, *args)
+        return
+    tasks = mu.Queue()
+    done  = mu.Queue()
+    for params in parameters_sets:
+        tasks.put(params)
+    for _ in range(n_jobs):
+        tasks.put(None)
+    procs = [mu.Process(target=_parameter_set_worker, args=(tasks, done) + args)
+             for _ in range(n_jobs)]
+    for proc in procs:
+        proc.start()
+    try:
+        for _ in parameters_sets:
+            while True:
+                try:
+                    result = done.get(timeout=10)
+                    break
+                except Empty:
+                    if any(proc.is_alive() for proc in procs):
+                        continue
+                    try:
+                        result = done.get(timeout=1)
+                        break
+                    except Empty:
+                        raise Exception('ERROR: grid search processes died '
+                                        'before modelling all the sets of '
+                                        'parameters')
+            yield result
+        for proc in procs:
+            proc.join()
+    finally:
+        for proc in procs:
+            if proc.is_alive():
+                proc.terminate()
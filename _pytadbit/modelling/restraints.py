@@ -1,8 +1,21 @@
 from math           import fabs, pow as power
 from collections    import OrderedDict
+from hashlib        import md5
+from itertools      import repeat
 
+from numpy          import fromiter, full, zeros, array, where, searchsorted
+from numpy          import nan, int64, float64
 from scipy          import polyfit
 
+# restraints computed by get_hicbased_restraints, by z-scores and parameters.
+# Only the last ones are kept (a list of restraints can hold millions of
+# tuples, and is copied in each forked process generating models)
+_RESTRAINTS_CACHE = OrderedDict()
+_CACHE_SIZE = 1
+
+_RESTRAINT_TYPES = ('NeighborHarmonic', 'NeighborHarmonicUpperBound',
+                    'HarmonicUpperBound', 'Harmonic', 'HarmonicLowerBound')
+
 class HiCBasedRestraints(object):
 
     """
@@ -101,17 +114,21 @@ class HiCBasedRestraints(object):
         # print 'config:', self.CONFIG
         # get SLOPE and regression for all particles of the z-score data
 
-        zsc_vals = [zscores[i][j] for i in zscores for j in zscores[i]
-                    if abs(int(i) - int(j)) > 1] # condition is to avoid
-                                                 # taking into account selfies
-                                                 # and neighbors
-        self.SLOPE, self.INTERCEPT   = polyfit([min(zsc_vals), max(zsc_vals)],
+        # all the z-scores as arrays (same order as in the dictionary)
+        nvals = sum(len(zscores[i]) for i in zscores)
+        bins1 = fromiter((int(i) for i in zscores for _ in zscores[i]), int64, nvals)
+        bins2 = fromiter((int(j) for i in zscores for j in zscores[i]), int64, nvals)
+        zsc   = fromiter((v for i in zscores for v in zscores[i].values()),
+                         float64, nvals)
+        seqdists = abs(bins1 - bins2)
+        zsc_vals = zsc[seqdists > 1] # condition is to avoid taking into account
+                                     # selfies and neighbors
+        self.SLOPE, self.INTERCEPT   = polyfit([zsc_vals.min(), zsc_vals.max()],
                                      [self.CONFIG['maxdist'], self.CONFIG['lowrdist']], 1)
         #print "#SLOPE = %f ; INTERCEPT = %f" % (self.SLOPE, self.INTERCEPT)
         #print "#maxdist = %f ; lowrdist = %f" % (self.CONFIG['maxdist'], self.CONFIG['lowrdist'])
         # get SLOPE and regression for neighbors of the z-score data
-        xarray = [zscores[i][j] for i in zscores for j in zscores[i]
-                  if abs(int(i) - int(j)) <= (close_bins + 1)]
+        xarray = zsc[seqdists <= (close_bins + 1)]
         yarray = [self.particle_radius * 2 for _ in range(len(xarray))]
         try:
             self.NSLOPE, self.NINTERCEPT = polyfit(xarray, yarray, 1)
@@ -120,58 +137,161 @@ class HiCBasedRestraints(object):
 
         # if z-scores are generated outside TADbit they may not start at zero
         if first == None:
-            first = min([int(j) for i in zscores for j in zscores[i]] +
-                        [int(i) for i in zscores])
+            first = min(bins2.tolist() + [int(i) for i in zscores])
         self.LOCI  = list(range(first, nloci + first))
 
         # Z-scores
 
         self.PDIST = zscores
+        rows = array(sorted(int(i) for i in zscores), dtype=int64)
+        self._zscores = rows, bins1, bins2, zsc
+        self._zscores_hash = md5(b''.join(
+            a.tobytes() for a in self._zscores)).hexdigest()
 
     def get_hicbased_restraints(self):
-
-        # HiCbasedRestraints is a list of restraints returned by this function.
-        # Each entry of the list is a list of 5 elements describing the details of the restraint:
-        # 0 - particle_i
-        # 1 - particle_j
-        # 2 - type_of_restraint = Harmonic or HarmonicLowerBound or HarmonicUpperBound
-        # 3 - the kforce of the restraint
-        # 4 - the equilibrium (or maximum or minimum respectively) distance associated to the restraint
-
+        """
+        Restraints between all the pairs of particles, computed from the
+        z-scores one row of particles at a time. The last restraints computed
+        are cached, so that the models generated with the same z-scores and
+        parameters (e.g. with one set of parameters of a grid search) reuse
+        them.
+
+        :returns: a list of restraints, each a tuple of 5 elements:
+           particle_i, particle_j, type of restraint (Harmonic,
+           HarmonicLowerBound or HarmonicUpperBound, possibly prefixed by
+           Neighbor), the kforce of the restraint and the equilibrium (or
+           maximum or minimum respectively) distance associated to the
+           restraint
+        """
+        key = (self._zscores_hash, self.nloci, self.particle_radius,
+               self.nnkforce, self.CONFIG['upfreq'], self.CONFIG['lowfreq'],
+               self.SLOPE, self.INTERCEPT, self.NSLOPE, self.NINTERCEPT,
+               self.min_seqdist, tuple(sorted(set(self.remove_rstrn))),
+               tuple(self.chromosomes.items()))
+        try:
+            restraints = _RESTRAINTS_CACHE[key]
+        except KeyError:
+            restraints = self._compute_hicbased_restraints()
+            _RESTRAINTS_CACHE[key] = restraints
+            while len(_RESTRAINTS_CACHE) > _CACHE_SIZE:
+                _RESTRAINTS_CACHE.popitem(last=False)
+        return list(restraints)
+
+    def _zscores_sparse(self):
+        """
+        :returns: the z-scores between particles (up to nloci included) as a
+           sorted array of flat indices (row * (nloci + 1) + column) with
+           their values, and a mask of the rows defined in the z-scores
+        """
+        size = self.nloci + 1
+        rows, bins1, bins2, values = self._zscores
+        inside = (bins1 >= 0) & (bins1 < size) & (bins2 >= 0) & (bins2 < size)
+        keys = bins1[inside] * size + bins2[inside]
+        order = keys.argsort(kind='mergesort')
+        has_row = zeros(size, dtype=bool)
+        has_row[rows[(rows >= 0) & (rows < size)]] = True
+        return keys[order], values[inside][order], has_row
+
+    def _compute_hicbased_restraints(self):
+        """
+        Same restraints as the functions defined below for each pair of
+        particles, but computed with arrays, one row of the upper triangle
+        at a time (the z-scores are never held as a square array).
+        """
+        size = self.nloci + 1
+        keys, values, rows = self._zscores_sparse()
+
+        def zscores_row(i):
+            # z-scores of particle i with all the others, and defined ones
+            beg, end = searchsorted(keys, (i * size, (i + 1) * size))
+            cols = keys[beg:end] - i * size
+            zsc = full(size, nan)
+            zsc[cols] = values[beg:end]
+            defined = zeros(size, dtype=bool)
+            defined[cols] = True
+            return zsc, defined
+
+        upfreq, lowfreq = self.CONFIG['upfreq'], self.CONFIG['lowfreq']
+
+        def combine(zsc1, def1, zsc2, def2):
+            # average of two z-scores, or the one defined
+            zsc1 = where(def1, zsc1, where(def2, zsc2, nan))
+            zsc2 = where(def2, zsc2, zsc1)
+            return (zsc1 + zsc2) / 2
+
+        nlocis = array(sorted(set(range(self.nloci)) - set(self.remove_rstrn)),
+                       dtype=int64)
+        # chromosome of each particle (first one ending after it)
+        crms = searchsorted(list(self.chromosomes.values()), nlocis,
+                            side='right')
         HiCbasedRestraints = []
-        nlocis = list(sorted(set(range(self.nloci)) - set(self.remove_rstrn)))
-        for ni, i in enumerate(nlocis):
-            chr1 = [k for k,v in list(self.chromosomes.items()) if v > i][0]
-            for j in nlocis[ni+1:]:
-                chr2 = [k for k,v in list(self.chromosomes.items()) if v > j][0]
-                # Compute the sequence separation (in particles) depending on it the restraint changes
-                seqdist = abs(j - i)
-
-                # 1 - CASE OF TWO CONSECUTIVE LOCI (NEAREST NEIGHBOR PARTICLES)
-                if seqdist == 1 and seqdist > self.min_seqdist:
-                    if chr1 != chr2:
-                        continue
-                    RestraintType, dist = self.get_nearest_neighbors_restraint_distance(self.particle_radius, i, j)
-                    kforce = self.nnkforce
-
-                # 2 - CASE OF 2 SECOND NEAREST NEIGHBORS SEQDIST = 2
-                if seqdist == 2 and seqdist > self.min_seqdist:
-                    if chr1 != chr2:
-                        continue
-                    RestraintType, dist = self.get_second_nearest_neighbors_restraint_distance(self.particle_radius, i, j)
-                    kforce = self.nnkforce
-
-                # 3 - CASE OF TWO NON-CONSECUTIVE PARTICLES SEQDIST > 2
-                if seqdist >  2 and seqdist > self.min_seqdist:
-
-                    #CASES OF TWO NON-CONSECUTIVE PARTICLES SEQDIST > 2
-                    RestraintType, kforce, dist = self.get_long_range_restraints_kforce_and_distance(i, j)
-                    if RestraintType == "None":
-                        #print "No HiC-based restraint between particles %d and %d" % (i,j)
-                        continue
-
-                HiCbasedRestraints.append([i, j, RestraintType, kforce, dist])
-
+        for ni, i in enumerate(nlocis.tolist()):
+            j = nlocis[ni + 1:]
+            seqdist = j - i
+            same_crm = crms[ni + 1:] == crms[ni]
+            zsc, defined = zscores_row(i)
+            types = full(len(j), -1)
+            dists = zeros(len(j))
+
+            # 1 - CASE OF TWO CONSECUTIVE LOCI (NEAREST NEIGHBOR PARTICLES)
+            near = (seqdist == 1) & same_crm
+            near_zsc = zsc[j]
+            closer = near & defined[j] & (near_zsc > upfreq)
+            types[near] = 1
+            dists[near] = 2.0 * self.particle_radius
+            types[closer] = 0
+            dists[closer] = self.NSLOPE * near_zsc[closer] + self.NINTERCEPT
+
+            # 2 - CASE OF 2 SECOND NEAREST NEIGHBORS SEQDIST = 2
+            second = (seqdist == 2) & same_crm
+            types[second] = 2
+            dists[second] = 4.0 * self.particle_radius
+
+            # 3 - CASE OF TWO NON-CONSECUTIVE PARTICLES SEQDIST > 2
+            far = seqdist > 2
+            jfar = j[far]
+            # the Z-score between i and j is defined
+            Zscore = where(defined[jfar], zsc[jfar], nan)
+            if rows[i]:
+                # Z-score defined only for particle i: average of the
+                # Z-scores of p2 nearest neighbor particles with p1
+                undef = ~defined[jfar]
+                Zscore[undef] = combine(zsc[jfar - 1], defined[jfar - 1],
+                                        zsc[jfar + 1], defined[jfar + 1])[undef]
+            else:
+                # Z-score defined only for particle j: same with the
+                # nearest neighbors of p1
+                undef = full(len(jfar), True)
+                prevx = i - 1 if i and rows[i - 1] else i + 1
+                postx = i + 1 if rows[i + 1] else prevx
+                if rows[prevx]:
+                    zscp, defp = zscores_row(prevx)
+                    zscn, defn = zscores_row(postx)
+                    Zscore = combine(zscp[jfar], defp[jfar], zscn[jfar], defn[jfar])
+            # ZSCORE > UPFREQ the spatial proximity of particles is favoured,
+            # ZSCORE < LOWFREQ the particles are restrained to be far
+            types[far] = where(Zscore > upfreq, 3, where(Zscore < lowfreq, 4, -1))
+            dists[far] = self.SLOPE * Zscore + self.INTERCEPT
+            halves = zeros(len(j), dtype=bool)
+            halves[far] = undef
+            zscores = zeros(len(j))
+            zscores[far] = Zscore
+
+            types[seqdist <= self.min_seqdist] = -1
+            keep = types >= 0
+            types, halves = types[keep], halves[keep]
+            # kforce computed as in k_force (not with numpy, to get the same
+            # rounding)
+            kforces = array(list(map(power, map(fabs, zscores[keep].tolist()),
+                                     repeat(0.5))))
+            kforces[halves] *= 0.5
+            kforces = kforces.tolist()
+            for pos in (types < 3).nonzero()[0].tolist():
+                kforces[pos] = self.nnkforce
+            HiCbasedRestraints.extend(zip(
+                repeat(i), j[keep].tolist(),
+                map(_RESTRAINT_TYPES.__getitem__, types.tolist()), kforces,
+                dists[keep].tolist()))
         return HiCbasedRestraints
 
 
@@ -0,0 +1,217 @@
+"""
+Binned interaction counts of a BAM file, indexed by row.
+
+Sidecar file of a TADbit BAM file storing, for one resolution and one set of
+filters, the number of interactions between each pair of bins (upper
+triangle only, bins numbered as in :func:`pytadbit.parsers.hic_bam_parser.read_bam`
+with the chromosomes in the order of the BAM file). The interactions of any
+range of rows are read from a memory-mapped file, without reading the rest.
+
+Layout of the file:
+   - text header, each line starting with '#', with the magic line, the
+     size and modification time (in nanoseconds) of the BAM file, the resolution, the
+     filters, the chromosome names and lengths and the number of pixels
+   - the pixels (see PIXEL_DTYPE), sorted by row (bin1) and column (bin2),
+     the row being given by the offsets
+   - the offsets of each row in the pixels (number of bins + 1 int64)
+"""
+
+from collections import OrderedDict
+from os          import path, stat, rename
+
+from numpy import dtype, memmap, empty, zeros, bincount, int32, int64
+from numpy import repeat, arange, diff, cumsum
+
+
+MAGIC = b'# TADbit bin index v1\n'
+
+PIXEL_DTYPE = dtype([('bin2', int32), ('count', int32)])
+
+
+def bin_index_path(inbam, resolution, filter_exclude):
+    """
+    :param inbam: path to a TADbit BAM file
+    :param resolution: resolution of the index
+    :param filter_exclude: filters (as a binary number) excluding reads
+
+    :returns: default path of the index, next to the BAM file
+    """
+    return '%s_%d_%d.binidx' % (inbam, resolution, filter_exclude)
+
+
+def bam_stamp(inbam):
+    """
+    :returns: size and modification time (in nanoseconds) of a BAM file, to
+       check that an index corresponds to it
+    """
+    stats = stat(inbam)
+    try:
+        return stats.st_size, stats.st_mtime_ns
+    except AttributeError:  # python 2
+        return stats.st_size, int(stats.st_mtime * 1e9)
+
+
+class BinIndexWriter(object):
+    """
+    Write binned interactions in TADbit bin index format.
+
+    Pixels are appended by rows with :func:`write`, rows being given in
+    increasing order, offsets and the number of pixels are written on
+    :func:`close`. The file is written under a temporary name, and only
+    renamed to outfile once complete.
+
+    :param outfile: path to the output file
+    :param chromosomes: ordered dictionary of chromosome lengths
+    :param resolution: resolution of the bins
+    :param filter_exclude: filters (as a binary number) excluding reads
+    :param stamp: size and modification time of the BAM file
+    """
+
+    def __init__(self, outfile, chromosomes, resolution, filter_exclude,
+                 stamp):
+        self.outfile = outfile
+        self.nbins = sum(l // resolution + 1 for l in chromosomes.values())
+        self.nrows = zeros(self.nbins, dtype=int64)
+        self.npixels = 0
+        self._out = open(outfile + '.tmp', 'wb')
+        self._out.write(MAGIC)
+        self._out.write(('# BAM %d\t%d\n' % stamp).encode())
+        self._out.write(('# RESOLUTION %d\n' % resolution).encode())
+        self._out.write(('# FILTER %d\n' % filter_exclude).encode())
+        for crm in chromosomes:
+            self._out.write(('# CRM %s\t%d\n' % (crm, chromosomes[crm])).encode())
+        self._count_pos = self._out.tell()
+        self._out.write(('# PIXELS %020d\n' % 0).encode())
+
+    def write(self, bin1, bin2, count):
+        """
+        :param bin1: sorted array of rows, all after the rows previously
+           written
+        :param bin2: array of columns (sorted within each row), with
+           bin2 >= bin1
+        :param count: array of interactions
+        """
+        pixels = empty(len(bin1), dtype=PIXEL_DTYPE)
+        pixels['bin2' ] = bin2
+        pixels['count'] = count
+        self._out.write(pixels.tobytes())
+        self.nrows += bincount(bin1, minlength=self.nbins)
+        self.npixels += len(bin1)
+
+    def close(self):
+        offsets = zeros(self.nbins + 1, dtype=int64)
+        self.nrows.cumsum(out=offsets[1:])
+        self._out.write(offsets.tobytes())
+        self._out.seek(self._count_pos)
+        self._out.write(('# PIXELS %020d\n' % self.npixels).encode())
+        self._out.close()
+        rename(self.outfile + '.tmp', self.outfile)
+
+
+class BinIndex(object):
+    """
+    Read-only access to a file in TADbit bin index format.
+
+    :param fnam: path to the index
+    """
+
+    def __init__(self, fnam):
+        self.fnam = fnam
+        self.chromosomes = OrderedDict()
+        with open(fnam, 'rb') as fhandler:
+            if fhandler.readline() != MAGIC:
+                raise Exception('ERROR: %s is not a TADbit bin index' % (fnam))
+            npixels = None
+            while npixels is None:
+                line = fhandler.readline().decode()
+                if not line.startswith('#'):
+                    raise Exception('ERROR: truncated header in %s' % (fnam))
+                key, val = line[2:].rstrip('\n').split(' ', 1)
+                if key == 'BAM':
+                    self.stamp = tuple(int(v) for v in val.split('\t'))
+                elif key == 'RESOLUTION':
+                    self.resolution = int(val)
+                elif key == 'FILTER':
+                    self.filter_exclude = int(val)
+                elif key == 'CRM':
+                    crm, length = val.split('\t')
+                    self.chromosomes[crm] = int(length)
+                elif key == 'PIXELS':
+                    npixels = int(val)
+            offset = fhandler.tell()
+        self.nbins = sum(l // self.resolution + 1
+                         for l in self.chromosomes.values())
+        if npixels:
+            self.pixels = memmap(fnam, dtype=PIXEL_DTYPE, mode='r',
+                                 offset=offset, shape=(npixels,))
+        else:
+            self.pixels = empty(0, dtype=PIXEL_DTYPE)
+        self.offsets = memmap(fnam, dtype=int64, mode='r', shape=(self.nbins + 1,),
+                              offset=offset + npixels * PIXEL_DTYPE.itemsize)
+
+    def matches(self, inbam, resolution, filter_exclude):
+        """
+        :returns: True if the index corresponds to this BAM file (same size
+           and modification time), resolution and filters
+        """
+        return (self.resolution == resolution and
+                self.filter_exclude == filter_exclude and
+                self.stamp == bam_stamp(inbam))
+
+    def rows(self, beg, end):
+        """
+        :param beg: first row
+        :param end: last row (excluded)
+
+        :returns: arrays of rows, columns and interactions of the pixels in
+           this range of rows (only these pixels are read)
+        """
+        offsets = self.offsets[beg:end + 1]
+        pixels = self.pixels[offsets[0]:offsets[-1]]
+        bin1 = repeat(arange(beg, end, dtype=int64), diff(offsets))
+        return bin1, pixels['bin2'].astype(int64), pixels['count'].astype(int64)
+
+    def block(self, beg, end, col_beg, col_end):
+        """
+        :param beg: first row
+        :param end: last row (excluded)
+        :param col_beg: first column
+        :param col_end: last column (excluded)
+
+        :returns: arrays of rows, columns and interactions of the pixels in
+           this block (columns being sorted within each row, only the
+           pixels of the block are read)
+        """
+        offsets = self.offsets[beg:end + 1].tolist()
+        columns = self.pixels['bin2']
+        lows  = empty(end - beg, dtype=int64)
+        highs = empty(end - beg, dtype=int64)
+        for i in range(end - beg):
+            row = columns[offsets[i]:offsets[i + 1]]
+            lows [i] = offsets[i] + row.searchsorted(col_beg)
+            highs[i] = offsets[i] + row.searchsorted(col_end)
+        sizes = highs - lows
+        # indexes of the pixels of each row, one range after the other
+        idx = arange(sizes.sum()) + repeat(lows - cumsum(sizes) + sizes, sizes)
+        pixels = self.pixels[idx]
+        bin1 = repeat(arange(beg, end, dtype=int64), sizes)
+        return bin1, pixels['bin2'].astype(int64), pixels['count'].astype(int64)
+
+
+def open_bin_index(fnam, inbam, resolution, filter_exclude):
+    """
+    :param fnam: path to the index
+    :param inbam: path to the corresponding BAM file
+
+    :returns: a BinIndex, or None if the file does not exist or does not
+       correspond to the BAM file, resolution or filters
+    """
+    if not path.exists(fnam):
+        return None
+    try:
+        index = BinIndex(fnam)
+    except Exception:
+        return None
+    if not index.matches(inbam, resolution, filter_exclude):
+        return None
+    return index
@@ -15,6 +15,9 @@ from math           import ceil
 from collections    import OrderedDict
 from time           import time
 
+# number of pixels per HDF5 chunk of the pixels datasets
+PIXELS_CHUNK = 1 << 16
+
 def printime(msg):
     print (msg +
            (' ' * (79 - len(msg.replace('\n', '')))) +
@@ -153,6 +156,7 @@ class cooler_file(object):
         self.nbuff = 0
         self.startj = 0
         self.startk = 0
+        self.h5 = None
         self.verbose = verbose
     
     def create_bins(self):
@@ -263,7 +267,8 @@ class cooler_file(object):
 
     def prepare_matrix(self, start1=None, start2=None):
         """
-        Prepare matrix datasets to be written as chunks.
+        Prepare matrix datasets to be written as chunks. The file is kept open
+        until :func:`close` is called, the datasets growing with each chunk.
 
         :param None start1: start bin of the first region of the matrix
         :param None start2: start bin of the second region of the matrix
@@ -272,19 +277,45 @@ class cooler_file(object):
 
         self.startj = 0 if start1 is None else start1
         self.startk = 0 if start2 is None else start2
-        max_size = self.nbins * (self.nbins - 1) // 2 + self.nbins
 
         if self.verbose:
             printime('Prepare matrix')
 
-        with h5py.File(self.outcool, "r+") as f:
-            root_grp = f[self.root_grp][str(self.resolution)]
-            grp = root_grp.create_group("pixels")
-            columns = ["bin1_id","bin2_id","count"]
-            dsets_dtypes = [np.int64, np.int64, np.int32]
-            for col, dset_dtype in zip(columns, dsets_dtypes):
-                grp.create_dataset(col, shape=(max_size,), dtype=dset_dtype,
-                                   maxshape=(None,), chunks=True, **self.h5opts)
+        h5opts = dict(self.h5opts)
+        h5opts.setdefault('chunks', (PIXELS_CHUNK,))
+        self.h5 = h5py.File(self.outcool, "r+")
+        root_grp = self.h5[self.root_grp][str(self.resolution)]
+        grp = root_grp.create_group("pixels")
+        columns = ["bin1_id","bin2_id","count"]
+        dsets_dtypes = [np.int64, np.int64, np.int32]
+        for col, dset_dtype in zip(columns, dsets_dtypes):
+            grp.create_dataset(col, shape=(0,), dtype=dset_dtype,
+                               maxshape=(None,), **h5opts)
+
+    def write_pixels(self, bin1, bin2, count):
+        """
+        Append a chunk of pixels to the matrix. Pixels of a chunk are sorted
+        before being written, but all the pixels of a chunk should come after
+        the ones of the previous chunks.
+
+        :param bin1: array of row numbers
+        :param bin2: array of column numbers
+        :param count: array of interaction values
+
+        """
+        if not len(bin1):
+            return
+        order = np.lexsort((bin2, bin1))
+        grp = self.h5[self.root_grp][str(self.resolution)]["pixels"]
+        values = (np.asarray(bin1, dtype=np.int64)[order] + (self.startj - self.sec_offset),
+                  np.asarray(bin2, dtype=np.int64)[order] + (self.startk - self.sec_offset),
+                  np.asarray(count, dtype=np.int32)[order])
+        nnz = self.nnz + len(order)
+        for dset, vals in zip(["bin1_id","bin2_id","count"], values):
+            grp[dset].resize((nnz,))
+            grp[dset][self.nnz:nnz] = vals
+        self.nnz = nnz
+        self.ncontacts += int(values[2].sum(dtype=np.int64))
 
     def write_iter(self, ichunk, j, k, v):
         """
@@ -298,43 +329,26 @@ class cooler_file(object):
 
         """
         if self.ichunk != ichunk:
-            self.buff.sort()
-            with h5py.File(self.outcool, "r+") as f:
-                root_grp = f[self.root_grp][str(self.resolution)]
-                grp = root_grp["pixels"]
-                dsets = ["bin1_id","bin2_id","count"]
-                for i, dset in enumerate(dsets):
-                    grp[dset].resize((self.nnz + self.nbuff,))
-                    grp[dset][self.nnz : self.nnz + self.nbuff] = [int(ch[i]) for ch in self.buff]
-            self.nnz += self.nbuff
-            self.ncontacts += sum([int(ch[2]) for ch in self.buff])
+            self._flush_buffer()
+        self.buff.append((j, k, v))
+        self.nbuff += 1
+        self.ichunk = ichunk
 
+    def _flush_buffer(self):
+        if self.nbuff > 0:
+            self.write_pixels(*np.array(self.buff, dtype=np.int64).T)
             del self.buff[:]
             self.nbuff = 0
-        vals = (j+(self.startj-self.sec_offset),k+(self.startk-self.sec_offset),v)
-        self.buff.append(vals)
-        self.nbuff += 1
-        self.ichunk = ichunk
 
     def close(self):
         """
         Copy remaining buffer to file, index the pixelsand complete information
         """
         # copy remaining reads in buffer
-        if self.nbuff > 0:
-            self.buff.sort()
-            with h5py.File(self.outcool, "r+") as f:
-                root_grp = f[self.root_grp][str(self.resolution)]
-                grp = root_grp["pixels"]
-                dsets = ["bin1_id","bin2_id","count"]
-                for i, dset in enumerate(dsets):
-                    grp[dset].resize((self.nnz + self.nbuff,))
-                    grp[dset][self.nnz : self.nnz + self.nbuff] = [int(ch[i]) for ch in self.buff]
-            self.nnz += self.nbuff
-            self.ncontacts += sum([int(ch[2]) for ch in self.buff])
-
-            del self.buff[:]
-            self.nbuff = 0
+        self._flush_buffer()
+        if self.h5 is not None:
+            self.h5.close()
+            self.h5 = None
         self.ichunk = 0
         self.write_indexes()
         self.write_info()
@@ -477,13 +491,13 @@ def rlencode(array, chunksize=None):
 
 def index_pixels(grp, n_bins, nnz):
     bin1 = grp["bin1_id"]
+    # pixels are sorted by row: offsets are the cumulative number of pixels
+    # per row
     bin1_offset = np.zeros(n_bins + 1, dtype=np.int64)
-    curr_val = 0
-    for start, length, value in zip(*rlencode(bin1, 1000000)):
-        bin1_offset[curr_val : value + 1] = start
-        curr_val = value + 1
-    bin1_offset[curr_val:] = nnz
-    return bin1_offset
+    for start in range(0, nnz, PIXELS_CHUNK * 16):
+        bin1_offset[1:] += np.bincount(bin1[start:start + PIXELS_CHUNK * 16],
+                                       minlength=n_bins)[:n_bins]
+    return np.cumsum(bin1_offset, out=bin1_offset)
 
 def index_bins(grp, n_chroms, n_bins):
     chrom_ids = grp["chrom"]
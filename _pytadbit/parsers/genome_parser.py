@@ -7,6 +7,7 @@ from __future__ import print_function
 
 from collections import OrderedDict
 import multiprocessing as mu
+from mmap import mmap, ACCESS_READ
 from os import path
 import re
 
@@ -18,8 +19,176 @@ try:
 except NameError:
     basestring = str
 
+INDEX_EXT = '.tdbidx'
+
+
+def _file_stamp(fnam):
+    return '%s\t%d\t%d' % (path.abspath(fnam), path.getsize(fnam),
+                            int(path.getmtime(fnam)))
+
+
+def _read_genome_index(fname):
+    """
+    :param fname: path to the genome cache file
+
+    :returns: the stamps of the FASTA files from which the cache was built,
+       the stamp of the cache, and an ordered dictionary with the length and
+       offset of each chromosome. None if the index does not exist
+    """
+    fastas = []
+    stamp = None
+    index = OrderedDict()
+    try:
+        with open(fname + INDEX_EXT) as f_open:
+            for line in f_open:
+                if line.startswith('# FASTA '):
+                    fastas.append(line[8:].rstrip('\n'))
+                elif line.startswith('# CACHE '):
+                    stamp = line[8:].rstrip('\n')
+                else:
+                    crm, length, offset = line.split('\t')
+                    index[crm] = int(length), int(offset)
+    except (IOError, ValueError):
+        return None
+    return fastas, stamp, index
+
+
+def _write_genome_index(fname, index, fastas=()):
+    """
+    :param fname: path to the genome cache file
+    :param index: ordered dictionary with the length and offset of each
+       chromosome
+    :param () fastas: stamps of the FASTA files from which the cache was built
+    """
+    try:
+        out = open(fname + INDEX_EXT, 'w')
+    except IOError:
+        return
+    for stamp in fastas:
+        out.write('# FASTA %s\n' % stamp)
+    out.write('# CACHE %s\n' % _file_stamp(fname))
+    for crm, (length, offset) in index.items():
+        out.write('%s\t%d\t%d\n' % (crm, length, offset))
+    out.close()
+
+
+def _valid_genome_cache(fname, f_names):
+    """
+    :returns: True if the genome cache exists and was built from these FASTA
+       files, as they are now (same size and modification time)
+    """
+    if not path.exists(fname):
+        return False
+    index = _read_genome_index(fname)
+    if index is None:
+        return False
+    try:
+        return index[0] == [_file_stamp(fnam) for fnam in f_names]
+    except OSError:
+        return False
+
+
+class MappedGenome(object):
+    """
+    Read-only dictionary-like access to a genome cached by
+    :func:`pytadbit.parsers.genome_parser.parse_fasta`.
+
+    The cache file is memory-mapped, and chromosome sequences are only read
+    when accessed, so that processes working on the same genome share a single
+    copy of it. Pickling a MappedGenome only sends the path to the cache, and
+    the index of chromosome positions.
+
+    The index (chromosome name, length and offset in the cache file) is stored
+    next to the cache with the '.tdbidx' extension, and created again if
+    missing or if the cache changed.
+
+    :param fname: path to the genome cache file
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        self._map = None
+        index = _read_genome_index(fname)
+        if index is None or index[1] != _file_stamp(fname):
+            # the stamps of the FASTA files are kept, for parse_fasta to
+            # still use this cache
+            self._index_cache(index[0] if index else ())
+        else:
+            self._index = index[2]
+
+    def _index_cache(self, fastas=()):
+        self._index = OrderedDict()
+        offset = 0
+        with open(self.fname, 'rb') as f_open:
+            for line in f_open:
+                offset += len(line)
+                if line.startswith(b'>'):
+                    crm = line[1:].strip().decode()
+                    seq_offset = offset
+                else:
+                    self._index[crm] = len(line.rstrip()), seq_offset
+        _write_genome_index(self.fname, self._index, fastas)
+
+    def __getstate__(self):
+        return self.fname, self._index
+
+    def __setstate__(self, state):
+        self.fname, self._index = state
+        self._map = None
+
+    def __len__(self):
+        return len(self._index)
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __contains__(self, crm):
+        return crm in self._index
+
+    def keys(self):
+        return list(self._index.keys())
+
+    def items(self):
+        return [(crm, self[crm]) for crm in self._index]
+
+    def length(self, crm):
+        """
+        :param crm: chromosome name
+
+        :returns: the length of the chromosome, without reading its sequence
+        """
+        return self._index[crm][0]
+
+    def lengths(self):
+        """
+        :returns: an ordered dictionary with the length of each chromosome
+        """
+        return OrderedDict((crm, self._index[crm][0]) for crm in self._index)
+
+    def region(self, crm, beg=0, end=None):
+        """
+        :param crm: chromosome name
+        :param 0 beg: start of the region (0-based, as in python slices)
+        :param None end: end of the region (excluded), defaults to the end of
+           the chromosome
+
+        :returns: the sequence of the region (upper case)
+        """
+        length, offset = self._index[crm]
+        beg = min(max(beg, 0), length)
+        end = length if end is None else min(max(end, beg), length)
+        if self._map is None:
+            with open(self.fname, 'rb') as f_open:
+                self._map = mmap(f_open.fileno(), 0, access=ACCESS_READ)
+        return self._map[offset + beg:offset + end].decode()
+
+    def __getitem__(self, crm):
+        return self.region(crm)
+
+
 def parse_fasta(f_names, chr_names=None, chr_filter=None, chr_regexp=None,
-                verbose=True, save_cache=True, reload_cache=False, only_length=False):
+                verbose=True, save_cache=True, reload_cache=False, only_length=False,
+                mapped=False):
     """
     Parse a list of fasta files, or just one fasta.
 
@@ -31,9 +200,13 @@ def parse_fasta(f_names, chr_names=None, chr_filter=None, chr_regexp=None,
     :param None chr_filter: use only chromosome in the input list
     :param None chr_regexp: use only chromosome matching
     :param True save_cache: save a cached version of this file for faster
-       loadings (~4 times faster)
+       loadings (~4 times faster). The cache is not used if the FASTA files
+       changed (size or modification time) since it was saved
     :param False reload_cache: reload cached genome
     :param False only_length: returns dictionary with length of genome,not sequence
+    :param False mapped: returns a
+       :class:`pytadbit.parsers.genome_parser.MappedGenome` over the cached
+       genome (created if needed), instead of loading all sequences in memory
 
     :returns: a sorted dictionary with chromosome names as keys, and sequences
        as values (sequence in upper case)
@@ -45,19 +218,20 @@ def parse_fasta(f_names, chr_names=None, chr_filter=None, chr_regexp=None,
         fname = f_names[0] + '_genome.TADbit'
     else:
         fname = path.join(path.commonprefix(f_names), 'genome.TADbit')
-    if path.exists(fname) and not reload_cache:
+    if not reload_cache and _valid_genome_cache(fname, f_names):
         if verbose:
             print('Loading cached genome')
+        if mapped:
+            return MappedGenome(fname)
+        if only_length:
+            return MappedGenome(fname).lengths()
         genome_seq = OrderedDict()
         with open(fname) as f_open:
             for line in f_open:
                 if line.startswith('>'):
                     c = line[1:].strip()
                 else:
-                    if only_length:
-                        genome_seq[c] = len(line.strip())
-                    else:
-                        genome_seq[c] = line.strip()
+                    genome_seq[c] = line.strip()
         return genome_seq
 
     if isinstance(chr_names, basestring):
@@ -130,7 +304,7 @@ def parse_fasta(f_names, chr_names=None, chr_filter=None, chr_regexp=None,
                     genome_seq[header] = ''.join([l.rstrip() for l in fhandler]).upper()
         if 'UNWANTED' in genome_seq:
             del(genome_seq['UNWANTED'])
-    if save_cache and not only_length:
+    if (save_cache or mapped) and not only_length:
         if verbose:
             print('saving genome in cache')
         if len(f_names) == 1:
@@ -138,9 +312,18 @@ def parse_fasta(f_names, chr_names=None, chr_filter=None, chr_regexp=None,
         else:
             fname = path.join(path.commonprefix(f_names), 'genome.TADbit')
         out = open(fname, 'w')
+        index = OrderedDict()
+        offset = 0
         for c in genome_seq:
+            offset += len(c) + 2
             out.write('>%s\n%s\n' % (c, genome_seq[c]))
+            index[c] = len(genome_seq[c]), offset
+            offset += len(genome_seq[c]) + 1
         out.close()
+        _write_genome_index(fname, index,
+                            [_file_stamp(fnam) for fnam in f_names])
+        if mapped:
+            return MappedGenome(fname)
     return genome_seq
 
 
@@ -163,7 +346,12 @@ def get_gc_content(genome, resolution, chromosomes=None, n_cpus=None, by_chrom=F
     get_chr_gc = _get_chr_gc_dico if by_chrom else _get_chr_gc_list
     jobs = {}
     for crm in chromosomes:
-        jobs[crm] = pool.apply_async(get_chr_gc, args=(genome[crm], resolution))
+        if isinstance(genome, MappedGenome):
+            # workers read their chromosome from the shared cache
+            jobs[crm] = pool.apply_async(_get_mapped_chr_gc,
+                                         args=(genome, crm, resolution, get_chr_gc))
+        else:
+            jobs[crm] = pool.apply_async(get_chr_gc, args=(genome[crm], resolution))
     pool.close()
     pool.join()
     if by_chrom:
@@ -173,6 +361,10 @@ def get_gc_content(genome, resolution, chromosomes=None, n_cpus=None, by_chrom=F
     return gc_content
 
 
+def _get_mapped_chr_gc(genome, crm, resolution, get_chr_gc):
+    return get_chr_gc(genome[crm], resolution)
+
+
 def _get_chr_gc_list(chrom, resolution):
     gc_content = []
     for pos in range(0, len(chrom), resolution):
@@ -8,30 +8,41 @@ from builtins   import next
 
 from future import standard_library
 standard_library.install_aliases()
-from pickle                       import load, dump
+from pickle                       import load
 from time                         import sleep, time
 from collections                  import OrderedDict
-from subprocess                   import Popen, PIPE
 from random                       import getrandbits
 from tarfile                      import open as taropen
 from io                           import StringIO
 from shutil                       import copyfile
 import datetime
 from sys                          import stdout, stderr, exc_info, modules
-from distutils.version            import LooseVersion
 import os
 import multiprocessing as mu
 
+from numpy                        import load as npload, save as npsave
+from numpy                        import array, empty, dtype, unique, argsort
+from numpy                        import searchsorted, concatenate, where
+from numpy                        import int32, int64, bincount, full, arange
+from numpy                        import minimum, lexsort, sort
+
 try:
     from lockfile                 import LockFile
 except ImportError:
     pass  # silently pass, very specific need
 
-from pysam                        import AlignmentFile
+from pysam                        import AlignmentFile, AlignmentHeader
+from pysam                        import AlignedSegment
+from pysam                        import sort as pysam_sort, merge as pysam_merge
+from pysam                        import index as pysam_index
+from pysam.libcalignedsegment     import CMATCH as BAM_CMATCH, CPAD as BAM_CPAD
+from pysam.libcalignedsegment     import CSOFT_CLIP as BAM_CSOFT_CLIP
 
-from pytadbit.utils.file_handling   import mkdir, which
+from pytadbit.utils.file_handling   import mkdir
 from pytadbit.utils.extraviews      import nicer
-from pytadbit.mapping.filter        import MASKED
+from pytadbit.mapping.filter        import MASKED, get_bitmask
+from pytadbit.parsers.bin_index     import BinIndex, BinIndexWriter
+from pytadbit.parsers.bin_index     import bin_index_path, bam_stamp, open_bin_index
 try:
     from pytadbit.parsers.cooler_parser import cooler_file
 except ImportError:
@@ -72,135 +83,181 @@ def print_progress(procs):
                         '%s/%s' % (len(procs),len(procs))))
 
 
-def _map2sam_short(line, flag):
+def _tc_tag(qname):
+    """
+    number of times the sequenced fragment is involved in a pairwise contact
+    """
+    try:
+        return int(qname.split('#')[1].split('/')[1])
+    except IndexError:
+        return 1
+
+
+def _copy_cigar(pos, length, copy):
     """
-    translate map + flag into hic-sam (two lines per contact)
+    pseudo CIGAR with the length of the read-end and the copy of the contact
+    (padding, P, for the first one, soft clip, S, for the second)
+    """
+    # samtools skip these reads at position 1 see:
+    # https://github.com/samtools/samtools/issues/1240
+    if pos == 1:
+        return [(BAM_CMATCH, 1), (copy, length - 1)]
+    return [(copy, length)]
+
+
+def _new_read(header, qname, flag, tid1, pos1, tid2, pos2, cigar, tlen, tags):
+    read = AlignedSegment(header)
+    read.query_name = qname
+    read.flag = flag
+    read.reference_id = tid1
+    read.reference_start = pos1 - 1
+    read.mapping_quality = 0
+    read.cigartuples = cigar
+    read.next_reference_id = tid2
+    read.next_reference_start = pos2 - 1
+    read.template_length = tlen
+    read.set_tags(tags)
+    return read
+
+
+def _map2bam_short(line, flag, header, tids):
+    """
+    translate map + flag into hic-bam (two reads per contact)
     lose information
     58% of the size using RE sites, and 68% of the generation time
     """
     (qname,
      rname, pos, _, _, _, _,
      rnext, pnext, _) = line.strip().split('\t', 9)
-
-    # multicontact?
-    try:
-        tc = qname.split('#')[1].split('/')[1]
-    except IndexError:
-        tc = '1'
     # trans contact?
     if rname != rnext:
         flag += 1024 # filter_keys['trans-chromosomic'] = 2**10
-    r1r2 = ('{0}\t{1}\t{2}\t{3}\t0\t1P\t{4}\t{5}\t*\t*\t*\t'
-            'TC:i:{6}\n'
-            '{0}\t{1}\t{4}\t{5}\t0\t1S\t{2}\t{3}\t*\t*\t*\t'
-            'TC:i:{6}\n'
-           ).format(
-               qname,               # 0
-               flag,                # 1
-               rname,               # 2
-               pos,                 # 3
-               rnext,               # 4
-               pnext,               # 5
-               tc)                  # 6
-    return r1r2
-
-
-def _map2sam_mid(line, flag):
+    tid1, pos1 = tids[rname], int(pos)
+    tid2, pos2 = tids[rnext], int(pnext)
+    tags = [('TC', _tc_tag(qname))]
+    return (_new_read(header, qname, flag, tid1, pos1, tid2, pos2,
+                      [(BAM_CPAD, 1)], 0, tags),
+            _new_read(header, qname, flag, tid2, pos2, tid1, pos1,
+                      [(BAM_CSOFT_CLIP, 1)], 0, tags))
+
+
+def _map2bam_mid(line, flag, header, tids):
     """
-    translate map + flag into hic-sam (two lines per contact)
+    translate map + flag into hic-bam (two reads per contact)
     only loses RE sites, that can be added back later
     63% of the size using RE sites, and 72% of the generation time
     """
     (qname,
      rname, pos, s1, l1, _, _,
      rnext, pnext, s2, l2, _) = line.strip().split('\t', 11)
-
-    # multicontact?
-    try:
-        tc = qname.split('#')[1].split('/')[1]
-    except IndexError:
-        tc = '1'
     # trans contact?
     if rname != rnext:
         flag += 1024 # filter_keys['trans-chromosomic'] = 2**10
-    ci1 = l1
-    ci2 = l2
-    # samtools skip these reads at position 1 see:
-    # https://github.com/samtools/samtools/issues/1240
-    if pos == '1':
-        ci1 = "1M%d" % (int(l1) - 1)
-    if pnext == '1':
-        ci2 = "1M%d" % (int(l2) - 1)
-    r1r2 = ('{0}\t{1}\t{2}\t{3}\t0\t{11}P\t{6}\t{7}\t{5}\t*\t*\t'
-            'TC:i:{8}\t'
-            'S1:i:{9}\tS2:i:{10}\n'
-            '{0}\t{1}\t{6}\t{7}\t0\t{12}S\t{2}\t{3}\t{4}\t*\t*\t'
-            'TC:i:{8}\t'
-            'S1:i:{9}\tS2:i:{10}\n').format(
-                qname,               # 0
-                flag,                # 1
-                rname,               # 2
-                pos,                 # 3
-                l1,                  # 4
-                l2,                  # 5
-                rnext,               # 6
-                pnext,               # 7
-                tc,                  # 8
-                s1,                  # 9
-                s2,                  # 10
-                ci1,                 # 11
-                ci2)                 # 12
-    return r1r2
-
-
-def _map2sam_long(line, flag):
+    tid1, pos1, l1 = tids[rname], int(pos), int(l1)
+    tid2, pos2, l2 = tids[rnext], int(pnext), int(l2)
+    tags = [('TC', _tc_tag(qname)), ('S1', int(s1)), ('S2', int(s2))]
+    return (_new_read(header, qname, flag, tid1, pos1, tid2, pos2,
+                      _copy_cigar(pos1, l1, BAM_CPAD), l2, tags),
+            _new_read(header, qname, flag, tid2, pos2, tid1, pos1,
+                      _copy_cigar(pos2, l2, BAM_CSOFT_CLIP), l1, tags))
+
+
+def _map2bam_long(line, flag, header, tids):
     """
-    translate map + flag into hic-sam (two lines per contact)
+    translate map + flag into hic-bam (two reads per contact)
     """
     (qname,
      rname, pos, s1, l1, e1, e2,
      rnext, pnext, s2, l2, e3, e4) = line.strip().split('\t')
-
-    # multicontact?
-    try:
-        tc = qname.split('#')[1].split('/')[1]
-    except IndexError:
-        tc = '1'
     # trans contact?
     if rname != rnext:
         flag += 1024 # filter_keys['trans-chromosomic'] = 2**10
-    ci1 = l1
-    ci2 = l2
-    # samtools skip these reads at position 1 see:
-    # https://github.com/samtools/samtools/issues/1240
-    if pos == '1':
-        ci1 = "1M%d" % (int(l1) - 1)
-    if pnext == '1':
-        ci2 = "1M%d" % (int(l2) - 1)
-    r1r2 = ('{0}\t{1}\t{2}\t{3}\t0\t{15}P\t{6}\t{7}\t{5}\t*\t*\t'
-            'TC:i:{8}\tS1:i:{13}\tS2:i:{14}\t'
-            'E1:i:{9}\tE2:i:{10}\tE3:i:{11}\tE4:i:{12}\n'
-            '{0}\t{1}\t{6}\t{7}\t0\t{16}S\t{2}\t{3}\t{4}\t*\t*\t'
-            'TC:i:{8}\tS1:i:{14}\tS2:i:{13}\t'
-            'E3:i:{11}\tE4:i:{12}\tE1:i:{9}\tE2:i:{10}\n').format(
-                qname,               # 0
-                flag,                # 1
-                rname,               # 2
-                pos,                 # 3
-                l1,                  # 4
-                l2,                  # 5
-                rnext,               # 6
-                pnext,               # 7
-                tc,                  # 8
-                e1,                  # 9
-                e2,                  # 10
-                e3,                  # 11
-                e4,                  # 12
-                s1,                  # 13
-                s2,                  # 14
-                ci1,                 # 15
-                ci2)                 # 16
-    return r1r2
+    tid1, pos1, l1 = tids[rname], int(pos), int(l1)
+    tid2, pos2, l2 = tids[rnext], int(pnext), int(l2)
+    tc, s1, s2 = _tc_tag(qname), int(s1), int(s2)
+    e1, e2, e3, e4 = int(e1), int(e2), int(e3), int(e4)
+    return (_new_read(header, qname, flag, tid1, pos1, tid2, pos2,
+                      _copy_cigar(pos1, l1, BAM_CPAD), l2,
+                      [('TC', tc), ('S1', s1), ('S2', s2),
+                       ('E1', e1), ('E2', e2), ('E3', e3), ('E4', e4)]),
+            _new_read(header, qname, flag, tid2, pos2, tid1, pos1,
+                      _copy_cigar(pos2, l2, BAM_CSOFT_CLIP), l1,
+                      [('TC', tc), ('S1', s2), ('S2', s1),
+                       ('E3', e3), ('E4', e4), ('E1', e1), ('E2', e2)]))
+
+
+def _split_lines(infile, beg, nchunks):
+    """
+    Cut a text file in chunks of similar size, starting at line boundaries
+
+    :param infile: path to the file
+    :param beg: byte offset of the first line to consider
+    :param nchunks: maximum number of chunks
+
+    :returns: list of (start, end) byte offsets, and the number of lines
+       preceding each chunk
+    """
+    size = os.path.getsize(infile)
+    offsets = [beg]
+    with open(infile, 'rb') as fhandler:
+        for i in range(1, nchunks):
+            fhandler.seek(max(offsets[-1], beg + (size - beg) * i // nchunks - 1))
+            fhandler.readline()  # go to the start of next line
+            if offsets[-1] < fhandler.tell() < size:
+                offsets.append(fhandler.tell())
+        offsets.append(size)
+        nlines = [0]
+        fhandler.seek(beg)
+        for end in offsets[1:-1]:
+            count = 0
+            left = end - fhandler.tell()
+            while left:
+                block = fhandler.read(min(left, 1 << 24))
+                count += block.count(b'\n')
+                left -= len(block)
+            nlines.append(nlines[-1] + count)
+    return list(zip(offsets[:-1], offsets[1:])), nlines
+
+
+def _write_bam_part(infile, beg, end, first, flags, shift, header_text, frmt,
+                    outbam):
+    """
+    Convert the pairs of reads between two byte offsets of the input file
+    into a coordinate sorted BAM file.
+
+    :param first: number of pairs of reads preceding this chunk
+    :param flags: path to an array with the filter flags of each pair of reads
+       (None if all are valid)
+    :param shift: number of bits by which the values in flags are shifted
+    :param header_text: SAM header
+
+    :returns: path to the sorted BAM file
+    """
+    header = AlignmentHeader.from_text(header_text)
+    tids = dict((crm, i) for i, crm in enumerate(header.references))
+    if frmt == 'mid':
+        map2bam = _map2bam_mid
+    elif frmt == 'long':
+        map2bam = _map2bam_long
+    else:
+        map2bam = _map2bam_short
+    if flags is not None:
+        flags = npload(flags, mmap_mode='r')
+    out = AlignmentFile(outbam + '_unsorted.bam', 'wb', header=header)
+    with open(infile, 'rb') as fhandler:
+        fhandler.seek(beg)
+        left = end - beg
+        for nline, line in enumerate(fhandler, first):
+            flag = 0 if flags is None else int(flags[nline]) >> shift
+            for read in map2bam(line.decode(), flag, header, tids):
+                out.write(read)
+            left -= len(line)
+            if left <= 0:
+                break
+    out.close()
+    pysam_sort('--no-PG', '-o', outbam + '.bam', outbam + '_unsorted.bam')
+    os.remove(outbam + '_unsorted.bam')
+    return outbam + '.bam'
 
 
 def bed2D_to_BAMhic(infile, valid, ncpus, outbam, frmt, masked=None, samtools='samtools'):
@@ -226,13 +283,13 @@ def bed2D_to_BAMhic(infile, valid, ncpus, outbam, frmt, masked=None, samtools='s
        - S1 and S2 tags are the strand orientation of the left and right read-end
 
     Each pair of contacts produces two lines in the output BAM
-    """
-    samtools = which(samtools)
-    if not samtools:
-        raise Exception('ERROR: samtools is needed to save a compressed '
-                        'version of the results. Check '
-                        'http://samtools.sourceforge.net/ \n')
 
+    The BAM records are built with pysam: the input file is cut in ncpus
+    chunks converted and sorted in parallel, the sorted chunks being then
+    merged and indexed.
+
+    :param 'samtools' samtools: not used anymore, kept for compatibility
+    """
     # define filter codes
     filter_keys = OrderedDict()
     for k in MASKED:
@@ -240,8 +297,8 @@ def bed2D_to_BAMhic(infile, valid, ncpus, outbam, frmt, masked=None, samtools='s
 
     output = ''
 
-    # write header
-    output += ("\t".join(("@HD" ,"VN:1.5", "SO:queryname")) + '\n')
+    # write header (reads are sorted by coordinate before being written)
+    output += ("\t".join(("@HD" ,"VN:1.5", "SO:coordinate")) + '\n')
     fhandler = open(infile)
     line = next(fhandler)
     # chromosome lengths
@@ -252,6 +309,7 @@ def bed2D_to_BAMhic(infile, valid, ncpus, outbam, frmt, masked=None, samtools='s
         output += ("\t".join(("@SQ", "SN:" + cr, "LN:" + ln)) + '\n')
         pos_fh += len(line)
         line = next(fhandler)
+    fhandler.close()
 
     # filter codes
     for i in filter_keys:
@@ -274,59 +332,59 @@ def bed2D_to_BAMhic(infile, valid, ncpus, outbam, frmt, masked=None, samtools='s
     output += ("\t".join(("@CO" ,"S1:i", "Strand of the 1st read-end (1: positive, 0: negative)\n")))
     output += ("\t".join(("@CO" ,"S2:i", "Strand of the 2nd read-end  (1: positive, 0: negative)\n")))
 
-    # open and init filter files
+    # filter flag of each pair of reads: one uint16 per pair, with bit k set
+    # if filtered by filter k, reused if saved by the filtering, otherwise
+    # written next to the output (the input directory may be read-only)
+    flags = None
+    tmp_flags = outbam + '_flags.npy'
     if not valid:
-        filter_line, filter_handler = get_filters(infile, masked)
-    fhandler.seek(pos_fh)
-    # check samtools version number and modify command line
-    version = LooseVersion([l.split()[1]
-                            for l in Popen(samtools, stderr=PIPE,
-                                           universal_newlines=True).communicate()[1].split('\n')
-                            if 'Version' in l][0])
-    pre = '-o' if version >= LooseVersion('1.3') else ''
-
-    proc = Popen(samtools + ' view -Shb -@ %d - | samtools sort -@ %d - %s %s' % (
-        ncpus, ncpus, pre,
-        outbam + '.bam' if  version >= LooseVersion('1.3') else ''),  # in new version '.bam' is no longer added
-                 shell=True, stdin=PIPE, universal_newlines=True)
-    proc.stdin.write(output)
-    if frmt == 'mid':
-        map2sam = _map2sam_mid
-    elif frmt == 'long':
-        map2sam = _map2sam_long
-    else:
-        map2sam = _map2sam_short
+        if masked:
+            # copy, not to record the bitmask in the dictionary given
+            masked = dict((k, dict(masked[k])) for k in masked)
+        else:
+            # filter files next to the input file
+            masked = {}
+            for k in MASKED:
+                fnam = '%s_%s.tsv' % (infile, MASKED[k]['name'].replace(' ', '_'))
+                if os.path.exists(fnam):
+                    masked[k] = {'name': MASKED[k]['name'], 'fnam': fnam}
+        flags = get_bitmask(infile, masked, bitmask=tmp_flags)
+
+    # convert and sort chunks of the input file in parallel
+    chunks, nlines = _split_lines(infile, pos_fh, ncpus)
+    if len(chunks) > 1:
+        # comments would be repeated for each chunk when merging, the full
+        # header is given to the merge instead
+        header = outbam + '_header.sam'
+        with open(header, 'w') as out:
+            out.write(output)
+        output = ''.join(l + '\n' for l in output.split('\n')
+                         if l.startswith('@HD') or l.startswith('@SQ'))
+    pool = mu.Pool(ncpus)
+    procs = [pool.apply_async(_write_bam_part, args=(
+        infile, beg, end, first, flags,
+        # bit k of the bitmask corresponds to flag 2**(k-1)
+        1, output, frmt, '%s_%d' % (outbam, i)))
+             for i, ((beg, end), first) in enumerate(zip(chunks, nlines))]
+    pool.close()
+    parts = [proc.get() for proc in procs]
+    pool.join()
 
-    if valid:
-        for line in fhandler:
-            flag = 0
-            # get output in sam format
-            proc.stdin.write(map2sam(line, flag))
+    # merge sorted chunks, keeping their order for equal coordinates
+    if len(parts) > 1:
+        pysam_merge('-f', '-@', str(ncpus), '-h', header, outbam + '.bam',
+                    *parts)
+        for part in parts + [header]:
+            os.remove(part)
     else:
-        for line in fhandler:
-            flag = 0
-            # check if read matches any filter
-            rid = line.split("\t")[0]
-            for i in filter_line:
-                if filter_line[i] == rid:
-                    flag += filter_keys[i]
-                    try:
-                        filter_line[i] = next(filter_handler[i]).strip()
-                    except StopIteration:
-                        pass
-            # get output in sam format
-            proc.stdin.write(map2sam(line, flag))
-    proc.stdin.close()
-    proc.wait()
+        os.rename(parts[0], outbam + '.bam')
 
-    # Index BAM
-    _ = Popen(samtools + ' index %s.bam' % (outbam), shell=True, universal_newlines=True).communicate()
+    if flags == tmp_flags:
+        os.remove(tmp_flags)
+        os.remove(tmp_flags + '.stamp')
 
-    # close file handlers
-    fhandler.close()
-    if not valid:
-        for i in filter_handler:
-            filter_handler[i].close()
+    # Index BAM
+    pysam_index(outbam + '.bam')
 
 
 def get_filters(infile, masked):
@@ -363,22 +421,77 @@ def get_filters(infile, masked):
     return filter_line, filter_handler
 
 
+PAIRS_DTYPE = dtype([('cis', bool), ('bin1', int32), ('bin2', int32),
+                     ('count', int32)])
+
+
+def _count_pairs(cis, bins1, bins2, half=False):
+    """
+    Count the occurrences of each pair of bins.
+
+    :param cis: array of booleans, True for intra-chromosomal pairs
+    :param bins1: array of bin indexes of the first read-ends
+    :param bins2: array of bin indexes of the second read-ends
+    :param False half: if False, each pair is also stored with bins swapped
+       (a pair observed in both orientations takes the count of the first
+       one observed)
+
+    :returns: a numpy structured array (PAIRS_DTYPE) with one row per pair of
+       bins, in order of first occurrence (the swapped pairs following the
+       observed ones)
+    """
+    if not len(bins1):
+        return empty(0, dtype=PAIRS_DTYPE)
+    size = int(max(bins1.max(), bins2.max())) + 1
+    keys = (cis * size + bins1) * size + bins2
+    keys, first, counts = unique(keys, return_index=True, return_counts=True)
+    crms, pos = divmod(keys, size * size)
+    bins1, bins2 = divmod(pos, size)
+    order = argsort(first)
+    if not half:
+        mirror = (crms * size + bins2) * size + bins1
+        idx = searchsorted(keys, mirror).clip(0, len(keys) - 1)
+        found = keys[idx] == mirror
+        both = found & (mirror != keys)
+        counts[both] = where(first[idx[both]] < first[both],
+                             counts[idx[both]], counts[both])
+        order = concatenate((order, order[~found[order]] + len(keys)))
+        crms   = concatenate((crms  , crms ))
+        bins1, bins2 = concatenate((bins1, bins2)), concatenate((bins2, bins1))
+        counts = concatenate((counts, counts))
+    pairs = empty(len(order), dtype=PAIRS_DTYPE)
+    pairs['cis'  ] = crms[order]
+    pairs['bin1' ] = bins1[order]
+    pairs['bin2' ] = bins2[order]
+    pairs['count'] = counts[order]
+    return pairs
+
+
 def _read_bam_frag(inbam, filter_exclude, all_bins, sections1, sections2,
                    rand_hash, resolution, tmpdir, region, start, end,
-                   half=False, sum_columns=False):
+                   half=False, sum_columns=False, two_regions=False):
+    """
+    Count the interactions of the read-ends of a chunk of the BAM file.
+
+    :param False two_regions: rows (sections1) and columns (sections2) come
+       from two different regions: each read-end of the chunk is counted with
+       its mate, in this orientation only (the other copy of the pair counting
+       for the swapped pixel), and the pixels are not mirrored
+    """
     bamfile = AlignmentFile(inbam, 'rb')
     refs = bamfile.references
     bam_start = start - 2
     bam_start = max(0, bam_start)
-    section_pos = []
-    for sec in sections1:
-        if sec not in section_pos:
-            section_pos.append(sec[0])
-    for sec in sections2:
-        if sec not in section_pos:
-            section_pos.append(sec[0])
+    # order of the chromosomes in the matrix
+    crm_rank = {}
+    for crm, _ in sections1:
+        crm_rank.setdefault(crm, len(crm_rank))
+    for crm, _ in sections2:
+        crm_rank.setdefault(crm, len(crm_rank))
     try:
-        dico = {}
+        cis   = []
+        bins1 = []
+        bins2 = []
         for r in bamfile.fetch(region=region,
                                start=bam_start, end=end,  # coords starts at 0
                                multiple_iterators=True):
@@ -386,38 +499,38 @@ def _read_bam_frag(inbam, filter_exclude, all_bins, sections1, sections2,
                 continue
             crm1 = r.reference_name
             pos1 = r.reference_start + 1
+            # read-ends fetched because they overlap with the previous chunk
+            if pos1 < start:
+                continue
             crm2 = refs[r.mrnm]
             pos2 = r.mpos + 1
-            if ((crm1 not in section_pos or crm2 not in section_pos) or
-                (section_pos.index(crm1) > section_pos.index(crm2)) or 
-                (crm1 == crm2 and pos1 > pos2)):
-                continue
             try:
+                if two_regions:
+                    # both copies of a pair within a bin would fall in the
+                    # same pixel
+                    if (crm1 == crm2 and pos1 > pos2 and
+                        pos1 // resolution == pos2 // resolution):
+                        continue
+                elif (crm_rank[crm1] > crm_rank[crm2] or
+                      (crm1 == crm2 and pos1 > pos2)):
+                    continue
                 pos1 = sections1[(crm1, pos1 // resolution)]
                 pos2 = sections2[(crm2, pos2 // resolution)]
             except KeyError:
                 continue  # not in the subset matrix we want
-            crm = crm1 * (crm1 == crm2)
-            try:
-                dico[(crm, pos1, pos2)] += 1
-            except KeyError:
-                dico[(crm, pos1, pos2)] = 1
-            # print '%-50s %5s %9s %5s %9s' % (r.query_name,
-            #                                  crm1, r.reference_start + 1,
-            #                                  crm2, r.mpos + 1)
-        if not half:
-            for c, i, j in list(dico):
-                dico[(c, j, i)] = dico[(c, i, j)] 
-        out = open(os.path.join(tmpdir, '_tmp_%s' % (rand_hash),
-                                '%s:%d-%d.tsv' % (region, start, end)), 'w')
-        out.write(''.join('%s\t%d\t%d\t%d\n' % (c, a, b, v)
-                          for (c, a, b), v in dico.items()))
-        out.close()
+            cis.append(crm1 == crm2)
+            bins1.append(pos1)
+            bins2.append(pos2)
+        pairs = _count_pairs(array(cis, dtype=bool), array(bins1, dtype=int64),
+                             array(bins2, dtype=int64),
+                             half=half or two_regions)
+        npsave(os.path.join(tmpdir, '_tmp_%s' % (rand_hash),
+                            '%s:%d-%d.npy' % (region, start, end)), pairs)
         if sum_columns:
             sumcol = {}
             cisprc = {}
-            for (c, i, j), v in dico.items():
-                # out.write('%d\t%d\t%d\n' % (i, j, v))
+            for i, j, v in zip(pairs['bin1'].tolist(), pairs['bin2'].tolist(),
+                               pairs['count'].tolist()):
                 try:
                     sumcol[i] += v
                     cisprc[i][all_bins[i][0] == all_bins[j][0]] += v
@@ -609,12 +722,14 @@ def read_bam(inbam, filter_exclude, resolution, ncpus=8,
         if ncpus == 1:
             _read_bam_frag(inbam, filter_exclude, all_bins,
                            bins_dict1, bins_dict2, rand_hash,
-                           resolution, tmpdir, region, b, e,)
+                           resolution, tmpdir, region, b, e,
+                           two_regions=bool(region2))
         else:
             procs.append(pool.apply_async(
                 _read_bam_frag, args=(inbam, filter_exclude, all_bins,
                                       bins_dict1, bins_dict2, rand_hash,
-                                      resolution, tmpdir, region, b, e,)))
+                                      resolution, tmpdir, region, b, e,),
+                kwds={'two_regions': bool(region2)}))
     pool.close()
     if verbose:
         print_progress(procs)
@@ -624,8 +739,291 @@ def read_bam(inbam, filter_exclude, resolution, ncpus=8,
     return regions, rand_hash, bin_coords, chunks
 
 
-def _iter_matrix_frags(chunks, tmpdir, rand_hash, clean=False, verbose=True,
-                       include_chunk_count=False):
+def build_bin_index(inbam, resolution,
+                    filter_exclude=(1, 2, 3, 4, 6, 7, 8, 9, 10), outfile=None,
+                    ncpus=8, nchunks=100, tmpdir='.', verbose=True):
+    """
+    Count the interactions between each pair of bins of the genome, and
+    store them in a bin index (see :mod:`pytadbit.parsers.bin_index`) from
+    which any sub-matrix can later be extracted without parsing the BAM.
+
+    :param inbam: path to BAM file (generated byt TADbit)
+    :param resolution: resolution of the bins
+    :param (1, 2, 3, 4, 6, 7, 8, 9, 10) filter exclude: filters to define the
+       set of valid pair of reads.
+    :param None outfile: path to the index, by default next to the BAM file
+       (see :func:`pytadbit.parsers.bin_index.bin_index_path`)
+    :param 8 ncpus: number of cpus to use to read the BAM file
+    :param 100 nchunks: maximum number of chunks into which to cut the BAM
+    :param '.' tmpdir: where to write temporary files
+    :param True verbose: speak
+
+    :returns: path to the index
+    """
+    if not isinstance(filter_exclude, int):
+        filter_exclude = filters_to_bin(filter_exclude)
+    if outfile is None:
+        outfile = bin_index_path(inbam, resolution, filter_exclude)
+    stamp = bam_stamp(inbam)
+    bamfile = AlignmentFile(inbam, 'rb')
+    chromosomes = OrderedDict(zip(bamfile.references, bamfile.lengths))
+    bamfile.close()
+
+    _, rand_hash, _, chunks = read_bam(
+        inbam, filter_exclude, resolution, ncpus=ncpus, tmpdir=tmpdir,
+        nchunks=nchunks, verbose=verbose)
+
+    if verbose:
+        printime('  - Writing bin index')
+    out = BinIndexWriter(outfile, chromosomes, resolution, filter_exclude,
+                         stamp)
+    for _, _, pairs in _iter_matrix_arrays(chunks, tmpdir, rand_hash,
+                                           clean=True, verbose=verbose):
+        # each pair of bins once, sorted by row and column
+        pairs = pairs[pairs['bin1'] <= pairs['bin2']]
+        pairs = pairs[lexsort((pairs['bin2'], pairs['bin1']))]
+        out.write(pairs['bin1'], pairs['bin2'], pairs['count'])
+    out.close()
+    os.system('rm -rf %s' % (os.path.join(tmpdir, '_tmp_%s' % (rand_hash))))
+    return outfile
+
+
+def load_bin_index(inbam, resolution, filter_exclude, bin_index=True,
+                   ncpus=8, nchunks=100, tmpdir='.', verbose=True):
+    """
+    Open the bin index of a BAM file, building it if it does not exist or if
+    it does not correspond anymore to the BAM file.
+
+    :param True bin_index: path to the index, path to the directory where to
+       store it, or True for the default path (next to the BAM file, or in
+       tmpdir if the directory of the BAM file is not writable)
+
+    :returns: a :class:`pytadbit.parsers.bin_index.BinIndex`
+    """
+    if not isinstance(filter_exclude, int):
+        filter_exclude = filters_to_bin(filter_exclude)
+    fnam = bin_index_path(inbam, resolution, filter_exclude)
+    if isinstance(bin_index, basestring):
+        if os.path.isdir(bin_index):
+            fnam = os.path.join(bin_index, os.path.basename(fnam))
+        else:
+            fnam = bin_index
+    index = open_bin_index(fnam, inbam, resolution, filter_exclude)
+    if (index is None and not isinstance(bin_index, basestring) and
+        not os.access(os.path.dirname(os.path.abspath(fnam)), os.W_OK)):
+        fnam = os.path.join(tmpdir, os.path.basename(fnam))
+        index = open_bin_index(fnam, inbam, resolution, filter_exclude)
+    if index is None:
+        if verbose:
+            printime('  - Building bin index %s' % (fnam))
+        build_bin_index(inbam, resolution, filter_exclude, outfile=fnam,
+                        ncpus=ncpus, nchunks=nchunks, tmpdir=tmpdir,
+                        verbose=verbose)
+        index = BinIndex(fnam)
+    return index
+
+
+def _mirror_pixels(cis, bins1, bins2, counts):
+    """
+    Same output as :func:`_count_pairs` (with half=False), from pixels
+    already counted: each pixel is also stored with bins swapped, unless this
+    swapped pixel was itself observed.
+    """
+    if not len(bins1):
+        return empty(0, dtype=PAIRS_DTYPE)
+    size = int(max(bins1.max(), bins2.max())) + 1
+    keys = sort(bins1 * size + bins2)
+    mirror = bins2 * size + bins1
+    idx = searchsorted(keys, mirror).clip(0, len(keys) - 1)
+    new = keys[idx] != mirror
+    pairs = empty(len(bins1) + new.sum(), dtype=PAIRS_DTYPE)
+    pairs['cis'  ] = concatenate((cis   , cis   [new]))
+    pairs['bin1' ] = concatenate((bins1 , bins2 [new]))
+    pairs['bin2' ] = concatenate((bins2 , bins1 [new]))
+    pairs['count'] = concatenate((counts, counts[new]))
+    return pairs
+
+
+def _read_index_block(index, crm_ids, rows, cols, beg, end, col_beg, col_end):
+    """
+    Pixels of a rectangular block of the matrix, between the rows of one
+    region and the columns of another, without mirroring them.
+
+    Each pixel is stored once in the index, in its upper triangle: either in
+    the block of these rows and columns, or in the transposed one (the
+    pixels on the diagonal of the index being in both).
+
+    :param crm_ids: chromosome of each bin of the index
+    :param rows: row of the matrix of each bin of the index
+    :param cols: column of the matrix of each bin of the index
+
+    :returns: a numpy structured array (PAIRS_DTYPE)
+    """
+    bins1, bins2, counts = index.block(beg, end, col_beg, col_end)
+    tbins2, tbins1, tcounts = index.block(col_beg, col_end, beg, end)
+    keep = tbins1 != tbins2
+    bins1  = concatenate((bins1 , tbins1[keep]))
+    bins2  = concatenate((bins2 , tbins2[keep]))
+    counts = concatenate((counts, tcounts[keep]))
+    pairs = empty(len(counts), dtype=PAIRS_DTYPE)
+    pairs['cis'  ] = crm_ids[bins1] == crm_ids[bins2]
+    pairs['bin1' ] = rows[bins1]
+    pairs['bin2' ] = cols[bins2]
+    pairs['count'] = counts
+    return pairs
+
+
+def read_bin_index(index, resolution, region1=None, start1=None, end1=None,
+                   region2=None, start2=None, end2=None, nchunks=100,
+                   tmpdir='.', verbose=True, max_size=None, chr_order=None):
+    """
+    Same as :func:`read_bam`, but the interactions are read from a bin index
+    (see :func:`build_bin_index`), and only the blocks of the index
+    overlapping with the wanted matrix are read.
+
+    :param index: a :class:`pytadbit.parsers.bin_index.BinIndex`, at this
+       resolution
+
+    :returns: same as :func:`read_bam`
+    """
+    if index.resolution != resolution:
+        raise Exception('ERROR: bin index at %d resolution, %d wanted' % (
+            index.resolution, resolution))
+    bam_refs = list(index.chromosomes)
+    if chr_order:
+        bam_refs = [crm for crm in chr_order if crm in index.chromosomes]
+        if not bam_refs:
+            raise Exception('''ERROR: Wrong number of chromosomes in chr_order.
+                Found %s in bam file \n''' % (' '.join(index.chromosomes)))
+    sections = OrderedDict((crm, index.chromosomes[crm] // resolution + 1)
+                           for crm in bam_refs)
+    # position of each chromosome in the matrix and in the index
+    total = 0
+    section_pos = dict()
+    for crm in sections:
+        section_pos[crm] = (total, total + sections[crm])
+        total += sections[crm]
+    index_pos = dict()
+    crm_ids = []
+    for num, crm in enumerate(index.chromosomes):
+        index_pos[crm] = len(crm_ids)
+        crm_ids.extend([num] * (index.chromosomes[crm] // resolution + 1))
+    crm_ids = array(crm_ids)
+
+    def _bin_range(region, start, end):
+        if not region in section_pos:
+            raise Exception('ERROR: chromosome %s not found' % region)
+        beg_crm, end_crm = section_pos[region]
+        return (beg_crm + (0 if start is None else start // resolution),
+                end_crm if end is None else beg_crm + end // resolution)
+
+    regions = bam_refs
+    if region1:
+        regions = [region1]
+        if region2:
+            regions.append(region2)
+        start_bin1, end_bin1 = _bin_range(region1, start1, end1)
+    else:
+        if start1 is not None or end1:
+            raise Exception('ERROR: Cannot use start/end1 without region')
+        start_bin1, end_bin1 = 0, total
+    if region2:
+        start_bin2, end_bin2 = _bin_range(region2, start2, end2)
+    else:
+        start_bin2, end_bin2 = start_bin1, end_bin1
+
+    size1 = end_bin1 - start_bin1
+    size2 = end_bin2 - start_bin2
+    if verbose:
+        printime('\n  (Matrix size %dx%d)' % (size1, size2))
+    if max_size and max_size < size1 * size2:
+        raise Exception(('ERROR: matrix too large ({0}x{1}) should be at most '
+                         '{2}x{2}').format(size1, size2, int(max_size**0.5)))
+
+    # index bins of each chromosome within a range of matrix bins, and
+    # conversion of index bins into rows and columns of the matrix
+    def _index_ranges(beg, end):
+        for crm in sections:
+            beg_crm, end_crm = section_pos[crm]
+            if max(beg, beg_crm) < min(end, end_crm):
+                yield (crm, index_pos[crm] + max(beg, beg_crm) - beg_crm,
+                       index_pos[crm] + min(end, end_crm) - beg_crm)
+
+    def _index_map(beg, end):
+        bins = full(index.nbins, -1, dtype=int64)
+        for crm, ibeg, iend in _index_ranges(beg, end):
+            bins[ibeg:iend] = arange(iend - ibeg) + section_pos[crm][0] + (
+                ibeg - index_pos[crm]) - beg
+        return bins
+
+    rows = _index_map(start_bin1, end_bin1)
+    cols = _index_map(start_bin2, end_bin2) if region2 else rows
+    # columns of a region are read as a block, otherwise the full rows
+    if region1 or region2:
+        _, col_beg, col_end = next(_index_ranges(start_bin2, end_bin2),
+                                   (None, 0, 0))
+    else:
+        col_beg, col_end = 0, index.nbins
+
+    # define chunks, using at most nchunks sub-divisions of region1
+    step = size1 // (min(size1, nchunks) + 1) + 1
+    regs  = []
+    begs  = []
+    ends  = []
+    irows = []
+    for crm, ibeg, iend in _index_ranges(start_bin1, end_bin1):
+        for beg in range(ibeg, iend, step):
+            end = min(beg + step, iend)
+            regs.append(crm)
+            begs.append((beg - index_pos[crm]) * resolution)
+            ends.append((end - index_pos[crm]) * resolution)
+            irows.append((beg, end))
+
+    rand_hash = "%016x" % getrandbits(64)
+    if verbose:
+        printime('\n  - Reading bin index (%d chunks)' % (len(regs)))
+    mkdir(os.path.join(tmpdir, '_tmp_%s' % (rand_hash)))
+    for region, b, e, (ibeg, iend) in zip(regs, begs, ends, irows):
+        fnam = os.path.join(tmpdir, '_tmp_%s' % (rand_hash),
+                            '%s:%d-%d.npy' % (region, b, e))
+        if region2:
+            npsave(fnam, _read_index_block(index, crm_ids, rows, cols,
+                                           ibeg, iend, col_beg, col_end))
+            continue
+        if (col_beg, col_end) == (0, index.nbins):
+            bins1, bins2, counts = index.rows(ibeg, iend)
+        else:
+            bins1, bins2, counts = index.block(ibeg, iend, col_beg, col_end)
+        cis = crm_ids[bins2] == crm_ids[ibeg]
+        bins1, bins2 = rows[bins1], cols[bins2]
+        # the index stores each pixel once, in the order of the BAM file: in
+        # the matrix, pixels before the diagonal belong to other rows
+        keep = (bins2 >= 0) & (bins2 >= bins1)
+        parts = [(cis[keep], bins1[keep], bins2[keep], counts[keep])]
+        # and pixels with another chromosome stored in the rows of this
+        # other chromosome (placed before in the BAM file)
+        others = [r for r in _index_ranges(start_bin1, end_bin1)
+                  if index_pos[r[0]] < index_pos[region] and
+                  section_pos[r[0]][0] > section_pos[region][0]]
+        for _, obeg, oend in others:
+            obins1, obins2, ocounts = index.block(obeg, oend, ibeg, iend)
+            parts.append((full(len(ocounts), False), rows[obins2],
+                          cols[obins1], ocounts))
+        cis, bins1, bins2, counts = [concatenate([p[i] for p in parts])
+                                     for i in range(4)]
+        npsave(fnam, _mirror_pixels(cis, bins1, bins2, counts))
+    bin_coords = start_bin1, end_bin1, start_bin2, end_bin2
+    chunks = regs, begs, ends
+    return regions, rand_hash, bin_coords, chunks
+
+
+def _iter_matrix_arrays(chunks, tmpdir, rand_hash, clean=False, verbose=True):
+    """
+    Iterate over the interactions counted in each chunk of the BAM file.
+
+    :yields: the index of the chunk, its chromosome, and a numpy structured
+       array with the pairs of bins counted (PAIRS_DTYPE)
+    """
     if verbose:
         stdout.write('     ')
     countbin = 0
@@ -639,13 +1037,8 @@ def _iter_matrix_frags(chunks, tmpdir, rand_hash, clean=False, verbose=True,
             stdout.flush()
 
         fname = os.path.join(tmpdir, '_tmp_%s' % (rand_hash),
-                             '%s:%d-%d.tsv' % (region, start, end))
-        for l in open(fname):
-            c, a, b, v = l.split('\t')
-            if include_chunk_count:
-                yield countbin, c, int(a), int(b), int(v)
-            else:
-                yield c, int(a), int(b), int(v)
+                             '%s:%d-%d.npy' % (region, start, end))
+        yield countbin, region, npload(fname)
         if clean:
             os.system('rm -f %s' % fname)
     if verbose:
@@ -653,6 +1046,17 @@ def _iter_matrix_frags(chunks, tmpdir, rand_hash, clean=False, verbose=True,
                             '%s/%s' % (len(chunks[0]),len(chunks[0]))))
 
 
+def _dict_to_array(dico, size, fill=float('nan'), dtype=float):
+    """
+    Convert a dictionary indexed by bins into an array (from bin 0 to size)
+    """
+    arr = empty(max([size] + [k + 1 for k in dico]), dtype=dtype)
+    arr.fill(fill)
+    for k, v in dico.items():
+        arr[k] = v
+    return arr
+
+
 def get_biases_region(biases, bin_coords, check_resolution=None):
     """
     Retrieve biases, decay, and bad bins from a dictionary, and re-index it
@@ -694,7 +1098,8 @@ def get_matrix(inbam, resolution, biases=None,
                region1=None, start1=None, end1=None,
                region2=None, start2=None, end2=None, dico=None, clean=False,
                return_headers=False, tmpdir='.', normalization='raw', ncpus=8,
-               nchunks=100, verbose=False, max_size=None, chr_order=None):
+               nchunks=100, verbose=False, max_size=None, chr_order=None,
+               bin_index=None):
     """
     Get matrix from a BAM file containing interacting reads. The matrix
     will be extracted from the genomic BAM, the genomic coordinates of this
@@ -729,6 +1134,10 @@ def get_matrix(inbam, resolution, biases=None,
     :param 100 nchunks: maximum number of chunks into which to cut the BAM
     :param None max_size: maximum size of matrix to read
     :param None chr_order: chromosome order
+    :param None bin_index: read the interactions from the bin index of the
+       BAM file (see :func:`build_bin_index`), built on first use. Either
+       True (index next to the BAM file, or in tmpdir if its directory is
+       not writable), the path to the index or the directory where to store it
 
     :returns: dictionary with keys being tuples of the indexes of interacting
        bins: dico[(bin1, bin2)] = interactions
@@ -737,12 +1146,22 @@ def get_matrix(inbam, resolution, biases=None,
     if not isinstance(filter_exclude, int):
         filter_exclude = filters_to_bin(filter_exclude)
 
-    regions, rand_hash, bin_coords, chunks = read_bam(
-        inbam, filter_exclude, resolution, ncpus=ncpus,
-        region1=region1, start1=start1, end1=end1,
-        region2=region2, start2=start2, end2=end2,
-        tmpdir=tmpdir, nchunks=nchunks, verbose=verbose,
-        max_size=max_size, chr_order=chr_order)
+    if bin_index:
+        index = load_bin_index(inbam, resolution, filter_exclude, bin_index,
+                               ncpus=ncpus, nchunks=nchunks, tmpdir=tmpdir,
+                               verbose=verbose)
+        regions, rand_hash, bin_coords, chunks = read_bin_index(
+            index, resolution, region1=region1, start1=start1, end1=end1,
+            region2=region2, start2=start2, end2=end2,
+            tmpdir=tmpdir, nchunks=nchunks, verbose=verbose,
+            max_size=max_size, chr_order=chr_order)
+    else:
+        regions, rand_hash, bin_coords, chunks = read_bam(
+            inbam, filter_exclude, resolution, ncpus=ncpus,
+            region1=region1, start1=start1, end1=end1,
+            region2=region2, start2=start2, end2=end2,
+            tmpdir=tmpdir, nchunks=nchunks, verbose=verbose,
+            max_size=max_size, chr_order=chr_order)
 
     if region1:
         regions = [region1]
@@ -760,42 +1179,66 @@ def get_matrix(inbam, resolution, biases=None,
     if verbose:
         printime('  - Getting matrices')
 
-    def transform_value_raw(_, __ , ___, v):
-        return v
-    def transform_value_norm(_, a, b, v):
-        return v / bias1[a] / bias2[b]
-    def transform_value_decay(c, a, b, v):
-        return v / bias1[a] / bias2[b] / decay[c][abs(a-b)]
-    def transform_value_decay_2reg(c, a, b, v):
-        return v / bias1[a] / bias2[b] / decay[c][abs((a + start_bin1) - (b + start_bin2))]
-
-    if normalization == 'raw':
-        transform_value = transform_value_raw
-    elif normalization == 'norm':
-        transform_value = transform_value_norm
-    elif normalization == 'decay':
-        if start_bin1 == start_bin2:
-            transform_value = transform_value_decay
-        else:
-            transform_value = transform_value_decay_2reg
-    else:
+    if normalization not in ('raw', 'norm', 'decay'):
         raise NotImplementedError(('ERROR: %s normalization not implemented '
                                    'here') % normalization)
+    # biases and bad columns as arrays (large enough for swapped bins)
+    size = max(bin_coords[1] - start_bin1, bin_coords[3] - start_bin2)
+    if normalization != 'raw':
+        bias1 = _dict_to_array(bias1, size)
+        bias2 = _dict_to_array(bias2, size)
+    bad_mask1 = _dict_to_array(dict.fromkeys(bads1, True), size, fill=False,
+                               dtype=bool)
+    bad_mask2 = _dict_to_array(dict.fromkeys(bads2, True), size, fill=False,
+                               dtype=bool)
+
+    def transform_values(region, pairs):
+        a = pairs['bin1']
+        b = pairs['bin2']
+        if normalization == 'raw':
+            return pairs['count']
+        values = pairs['count'] / bias1[a] / bias2[b]
+        if normalization == 'decay':
+            dists = abs((a + start_bin1) - (b + start_bin2))
+            for cis in (True, False):
+                sub = pairs['cis'] == cis
+                if not sub.any():
+                    continue
+                c = region if cis else ''
+                udists, inv = unique(dists[sub], return_inverse=True)
+                values[sub] /= array([decay[c][d] for d in udists.tolist()])[inv]
+        return values
+
+    def iter_values():
+        for _, region, pairs in _iter_matrix_arrays(
+                chunks, tmpdir, rand_hash, clean=clean, verbose=verbose):
+            pairs = pairs[~(bad_mask1[pairs['bin1']] |
+                            bad_mask2[pairs['bin2']])]
+            yield pairs['bin1'], pairs['bin2'], transform_values(region, pairs)
 
     return_something = False
     if dico is None:
         return_something = True
-        dico = dict(((i, j), transform_value(c, i, j, v))
-                    for c, i, j, v in _iter_matrix_frags(
-                        chunks, tmpdir, rand_hash, clean=clean, verbose=verbose)
-                    if i not in bads1 and j not in bads2)
+        dico = {}
+        for a, b, v in iter_values():
+            dico.update(zip(zip(a.tolist(), b.tolist()), v.tolist()))
         # pull all sub-matrices and write full matrix
+    elif hasattr(dico, '_update_from_arrays'): # array-backed HiC data object
+        # cells of all the chunks inserted at once (each insertion sorts the
+        # whole matrix)
+        size = len(dico)
+        keys = []
+        values = []
+        for a, b, v in iter_values():
+            keys.append(a.astype(int64) * size + b)
+            values.append(v)
+        if keys:
+            dico._update_from_arrays(concatenate(keys), concatenate(values))
+        del keys, values
     else: # dico probably an HiC data object
-        for _, i, j, v in _iter_matrix_frags(
-                chunks, tmpdir, rand_hash,
-                clean=clean, verbose=verbose):
-            if i not in bads1 and j not in bads2:
-                dico[i, j] = v
+        for a, b, v in iter_values():
+            for i, j, val in zip(a.tolist(), b.tolist(), v.tolist()):
+                dico[i, j] = val
 
     if clean:
         os.system('rm -rf %s' % (os.path.join(tmpdir, '_tmp_%s' % (rand_hash))))
@@ -832,7 +1275,8 @@ def write_matrix(inbam, resolution, biases, outdir,
                  region1=None, start1=None, end1=None, clean=True,
                  region2=None, start2=None, end2=None, extra='',
                  half_matrix=True, nchunks=100, tmpdir='.', append_to_tar=None,
-                 ncpus=8, cooler=False, row_names=False, chr_order=None, verbose=True):
+                 ncpus=8, cooler=False, row_names=False, chr_order=None, verbose=True,
+                 bin_index=None):
     """
     Writes matrix file from a BAM file containing interacting reads. The matrix
     will be extracted from the genomic BAM, the genomic coordinates of this
@@ -872,6 +1316,10 @@ def write_matrix(inbam, resolution, biases, outdir,
        WARNING: results in two extra columns
     :param None chr_order: chromosome order
     :param 100 nchunks: maximum number of chunks into which to cut the BAM
+    :param None bin_index: read the interactions from the bin index of the
+       BAM file (see :func:`build_bin_index`), built on first use. Either
+       True (index next to the BAM file, or in tmpdir if its directory is
+       not writable), the path to the index or the directory where to store it
 
     :returns: path to output files
     """
@@ -890,12 +1338,22 @@ def write_matrix(inbam, resolution, biases, outdir,
     if not isinstance(filter_exclude, int):
         filter_exclude = filters_to_bin(filter_exclude)
 
-    regions, rand_hash, bin_coords, chunks = read_bam(
-        inbam, filter_exclude, resolution, ncpus=ncpus,
-        region1=region1, start1=start1, end1=end1,
-        region2=region2, start2=start2, end2=end2,
-        tmpdir=tmpdir, nchunks=nchunks, chr_order=chr_order,
-        verbose=verbose)
+    if bin_index:
+        index = load_bin_index(inbam, resolution, filter_exclude, bin_index,
+                               ncpus=ncpus, nchunks=nchunks, tmpdir=tmpdir,
+                               verbose=verbose)
+        regions, rand_hash, bin_coords, chunks = read_bin_index(
+            index, resolution, region1=region1, start1=start1, end1=end1,
+            region2=region2, start2=start2, end2=end2,
+            tmpdir=tmpdir, nchunks=nchunks, chr_order=chr_order,
+            verbose=verbose)
+    else:
+        regions, rand_hash, bin_coords, chunks = read_bam(
+            inbam, filter_exclude, resolution, ncpus=ncpus,
+            region1=region1, start1=start1, end1=end1,
+            region2=region2, start2=start2, end2=end2,
+            tmpdir=tmpdir, nchunks=nchunks, chr_order=chr_order,
+            verbose=verbose)
 
     if region1:
         regions = [region1]
@@ -1124,28 +1582,27 @@ def write_matrix(inbam, resolution, biases, outdir,
     if region2 is not None:  # already half-matrix in this case
         half_matrix = False
 
+    size = max(end_bin1 - start_bin1, end_bin2 - start_bin2)
+    bad_mask1 = _dict_to_array(dict.fromkeys(bads1, True), size, fill=False,
+                               dtype=bool)
+    bad_mask2 = _dict_to_array(dict.fromkeys(bads2, True), size, fill=False,
+                               dtype=bool)
+    for _, region, pairs in _iter_matrix_arrays(
+            chunks, tmpdir, rand_hash, verbose=verbose, clean=clean):
+        keep = ~(bad_mask1[pairs['bin1']] | bad_mask2[pairs['bin2']])
+        if cooler:
+            keep &= pairs['bin1'] <= pairs['bin2']
+        elif half_matrix:
+            keep &= pairs['bin2'] <= pairs['bin1']
+        pairs = pairs[keep]
+        if cooler:
+            out_raw.write_pixels(pairs['bin1'], pairs['bin2'], pairs['count'])
+            continue
+        for cis, j, k, v in zip(pairs['cis'].tolist(), pairs['bin1'].tolist(),
+                                pairs['bin2'].tolist(), pairs['count'].tolist()):
+            write(region if cis else '', j, k, v)
     if cooler:
-        for ichunk, c, j, k, v in _iter_matrix_frags(chunks, tmpdir, rand_hash,
-                                                     verbose=verbose, clean=clean,
-                                                     include_chunk_count=True):
-            if j > k:
-                continue
-            if j not in bads1 and k not in bads2:
-                out_raw.write_iter(ichunk, j, k, v)
         out_raw.close()
-    else:
-        if half_matrix:
-            for c, j, k, v in _iter_matrix_frags(chunks, tmpdir, rand_hash,
-                                                 verbose=verbose, clean=clean):
-                if k > j:
-                    continue
-                if j not in bads1 and k not in bads2:
-                    write(c, j, k, v)
-        else:
-            for c, j, k, v in _iter_matrix_frags(chunks, tmpdir, rand_hash,
-                                                 verbose=verbose, clean=clean):
-                if j not in bads1 and k not in bads2:
-                    write(c, j, k, v)
 
     fnames = {}
     if append_to_tar:
@@ -1191,3 +1648,125 @@ def write_matrix(inbam, resolution, biases, outdir,
         os.system('rm -rf %s' % (os.path.join(tmpdir, '_tmp_%s' % (rand_hash))))
 
     return fnames
+
+
+def _merge_pixels(keys, counts):
+    """
+    Sum the counts of identical pixels
+
+    :returns: sorted unique keys and their summed counts
+    """
+    keys, inverse = unique(keys, return_inverse=True)
+    return keys, bincount(inverse, weights=counts).astype(int64)
+
+
+def write_multires_cooler(inbam, resolution, outdir, resolutions=(),
+                          filter_exclude=(1, 2, 3, 4, 6, 7, 8, 9, 10),
+                          extra='', nchunks=100, tmpdir='.', ncpus=8,
+                          chr_order=None, clean=True, verbose=True):
+    """
+    Writes the raw interaction matrices of the full genome at several
+    resolutions into a single multi-resolution cooler file. The BAM file is
+    read only once, at the finest resolution, the matrices at coarser
+    resolutions being obtained by summing the counts of the finest bins.
+
+    :param inbam: path to BAM file (generated byt TADbit)
+    :param resolution: finest resolution, at which the BAM file is read
+    :param outdir: path to a folder where to write output files
+    :param () resolutions: coarser resolutions, all multiples of resolution
+    :param (1, 2, 3, 4, 6, 7, 8, 9, 10) filter exclude: filters to define the
+       set of valid pair of reads.
+    :param '' extra: extra string to add to the name of the output file
+    :param 100 nchunks: maximum number of chunks into which to cut the BAM
+    :param '.' tmpdir: where to write temporary files
+    :param 8 ncpus: number of cpus to use to read the BAM file
+    :param None chr_order: chromosome order
+    :param True clean: remove temporary files
+    :param True verbose: speak
+
+    :returns: dictionary with the path to the output file (key 'RAW')
+    """
+    if 'h5py' not in modules:
+        raise Exception('ERROR: cooler output is not available. Probably ' +
+                        'you need to install h5py\n')
+    resolutions = sorted(set([resolution] + list(resolutions)))
+    if resolutions[0] != resolution or any(r % resolution for r in resolutions):
+        raise Exception('ERROR: all resolutions should be multiples of %d' % (
+            resolution))
+
+    if not isinstance(filter_exclude, int):
+        filter_exclude = filters_to_bin(filter_exclude)
+
+    regions, rand_hash, _, chunks = read_bam(
+        inbam, filter_exclude, resolution, ncpus=ncpus, tmpdir=tmpdir,
+        nchunks=nchunks, chr_order=chr_order, verbose=verbose)
+
+    bamfile = AlignmentFile(inbam, 'rb')
+    lengths = dict(zip(bamfile.references, bamfile.lengths))
+    bamfile.close()
+    sections = OrderedDict((crm, lengths[crm]) for crm in regions)
+
+    # chromosome and position of each bin of the finest matrix, as read by
+    # read_bam (length // resolution + 1 bins per chromosome)
+    crm_idx = concatenate([full(sections[crm] // resolution + 1, i, dtype=int64)
+                           for i, crm in enumerate(sections)])
+    local = concatenate([arange(sections[crm] // resolution + 1, dtype=int64)
+                         for crm in sections])
+    totals = {}
+    total_num = 0
+    for crm in sections:
+        totals[crm] = total_num
+        total_num += sections[crm] // resolution + 1
+
+    if verbose:
+        printime('  - Writing matrices')
+    fnam = 'raw_full_%s%s.mcool' % (
+        '-'.join(nicer(r).replace(' ', '') for r in resolutions),
+        ('_' + extra) if extra else '')
+    fnam = os.path.join(outdir, fnam)
+    if os.path.exists(fnam):
+        os.remove(fnam)
+
+    # for each resolution, the cooler bin of each bin of the finest matrix
+    bin_map = {}
+    coolers = {}
+    for reso in resolutions:
+        nbins = array([-(-sections[crm] // reso) for crm in sections],
+                      dtype=int64)
+        offsets = concatenate(([0], nbins.cumsum()[:-1]))
+        bin_map[reso] = offsets[crm_idx] + minimum(local // (reso // resolution),
+                                                   nbins[crm_idx] - 1)
+        coolers[reso] = cooler_file(fnam, reso, sections, regions)
+        coolers[reso].create_bins()
+        coolers[reso].prepare_matrix()
+
+    # pixels are stored as bin1 * size + bin2, those with a row (bin1) that
+    # may still receive counts from the next chunks are kept pending
+    size = int(bin_map[resolution][-1]) + 1
+    pending = dict((reso, (empty(0, dtype=int64), empty(0, dtype=int64)))
+                   for reso in resolutions)
+
+    for ichunk, region, pairs in _iter_matrix_arrays(
+            chunks, tmpdir, rand_hash, verbose=verbose, clean=clean):
+        pairs = pairs[pairs['bin1'] <= pairs['bin2']]
+        start = totals[region] + chunks[1][ichunk] // resolution
+        for reso in resolutions:
+            keys, counts = pending[reso]
+            keys, counts = _merge_pixels(
+                concatenate((keys, bin_map[reso][pairs['bin1']] * size +
+                             bin_map[reso][pairs['bin2']])),
+                concatenate((counts, pairs['count'])))
+            done = searchsorted(keys, bin_map[reso][start] * size)
+            coolers[reso].write_pixels(keys[:done] // size, keys[:done] % size,
+                                       counts[:done])
+            pending[reso] = keys[done:], counts[done:]
+    for reso in resolutions:
+        keys, counts = pending[reso]
+        coolers[reso].write_pixels(keys // size, keys % size, counts)
+        coolers[reso].close()
+
+    # this is the last thing we do in case something goes wrong
+    if clean:
+        os.system('rm -rf %s' % (os.path.join(tmpdir, '_tmp_%s' % (rand_hash))))
+
+    return {'RAW': fnam}
@@ -19,6 +19,7 @@ from pysam                           import AlignmentFile
 import numpy as np
 from pytadbit.parsers.gzopen         import gzopen
 from pytadbit                        import HiC_data
+from pytadbit.hic_data               import HiC_data_array
 from pytadbit.parsers.hic_bam_parser import get_matrix
 try:
     from pytadbit.parsers.cooler_parser import parse_cooler, is_cooler
@@ -552,7 +553,8 @@ def load_hic_data_from_reads(fnam, resolution, **kwargs):
 
 def load_hic_data_from_bam(fnam, resolution, biases=None, tmpdir='.', ncpus=8,
                            filter_exclude=(1, 2, 3, 4, 6, 7, 8, 9, 10),
-                           region=None, verbose=True, clean=True):
+                           region=None, verbose=True, clean=True,
+                           storage='dict', bin_index=None):
     """
     :param fnam: TADbit-generated BAM file with read-ends1 and read-ends2
     :param resolution: the resolution of the experiment (size of a bin in
@@ -564,9 +566,24 @@ def load_hic_data_from_bam(fnam, resolution, biases=None, tmpdir='.', ncpus=8,
     :param (1, 2, 3, 4, 6, 7, 8, 9, 10) filter exclude: filters to define the
        set of valid pair of reads.
     :param None region: chromosome name, if None, all genome will be loaded
+    :param 'dict' storage: storage of the interactions, either 'dict' (one
+       dictionary entry per cell) or 'array' (sorted arrays, much lighter in
+       memory, see :class:`pytadbit.hic_data.HiC_data_array`)
+    :param None bin_index: read the interactions from the bin index of the
+       BAM file (built on first use, see
+       :func:`pytadbit.parsers.hic_bam_parser.build_bin_index`). Either True
+       (index next to the BAM file, or in tmpdir if its directory is not
+       writable), the path to the index or the directory where to store it
 
     :returns: HiC_data object
     """
+    if storage == 'dict':
+        hic_class = HiC_data
+    elif storage == 'array':
+        hic_class = HiC_data_array
+    else:
+        raise NotImplementedError('ERROR: storage "%s" not implemented' % (
+            storage))
     bam = AlignmentFile(fnam)
     genome_seq = OrderedDict((c, l) for c, l in
                              zip(bam.references,
@@ -582,8 +599,8 @@ def load_hic_data_from_bam(fnam, resolution, biases=None, tmpdir='.', ncpus=8,
 
     chromosomes = {region: genome_seq[region]} if region else genome_seq
     dict_sec = dict([(j, i) for i, j in enumerate(sections)])
-    imx = HiC_data((), size, chromosomes=chromosomes, dict_sec=dict_sec,
-                   resolution=resolution)
+    imx = hic_class((), size, chromosomes=chromosomes, dict_sec=dict_sec,
+                    resolution=resolution)
 
     if biases:
         if isinstance(biases, basestring):
@@ -608,7 +625,8 @@ def load_hic_data_from_bam(fnam, resolution, biases=None, tmpdir='.', ncpus=8,
 
     get_matrix(fnam, resolution, biases=None, filter_exclude=filter_exclude,
                normalization='raw', tmpdir=tmpdir, clean=clean,
-               ncpus=ncpus, dico=imx, region1=region, verbose=verbose)
+               ncpus=ncpus, dico=imx, region1=region, verbose=verbose,
+               bin_index=bin_index)
     imx._symmetricize()
     imx.symmetricized = True
 
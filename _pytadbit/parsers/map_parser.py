@@ -3,14 +3,18 @@
 """
 from __future__ import print_function
 
-from bisect                               import bisect_right as bisect
 from warnings                             import warn
 from sys                                  import stdout
 from subprocess                           import Popen
+from heapq                                import merge
 import os
+import multiprocessing as mu
+
+from numpy                                import array, zeros, int64
 
 from pytadbit.utils.file_handling         import magic_open
-from pytadbit.mapping.restriction_enzymes import map_re_sites
+from pytadbit.mapping.restriction_enzymes import map_re_sites_array
+from pytadbit.mapping.restriction_enzymes import find_re_sites
 
 try:
     basestring
@@ -46,6 +50,15 @@ def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
        multiple-contacts
     :param False compress: compress (gzip) input map files. This is done in the
        background while next MAP files are parsed, or while files are sorted.
+    :param 1000000 max_size: maximum number of reads kept in memory, sorted and
+       written to a temporary file, before the final merge sort
+    :param 1 ncpus: number of CPUs used to sort the temporary files
+    :param 64 max_open: maximum number of temporary files merged at once
+    :param None re_cache: directory where to cache the positions of RE sites
+       in the genome (see
+       :func:`pytadbit.mapping.restriction_enzymes.map_re_sites_array`)
+    :param None genome_path: path to the FASTA file(s) of genome_seq, needed
+       to cache the RE sites
     """
     # not nice, dirty fix in order to allow this function to only parse
     # one SAM file
@@ -58,15 +71,16 @@ def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
     if (f_names2 and not out_file2) or (not f_names2 and out_file2):
         raise Exception('ERROR: out_file2 AND f_names2 needed\n')
 
-    frag_chunk = kwargs.get('frag_chunk', 100000)
     if verbose:
         print('Searching and mapping RE sites to the reference genome')
     if len(re_name) == 1 and re_name[0] in (None, 'None'):
         frags = {}
         read_read = read_read_nofrags
     else:
-        frags = map_re_sites(re_name, genome_seq, frag_chunk=frag_chunk,
-                             verbose=verbose)
+        frags = map_re_sites_array(re_name, genome_seq,
+                                   cache_dir=kwargs.get('re_cache', None),
+                                   genome_path=kwargs.get('genome_path', None),
+                                   verbose=verbose)
         read_read = read_read_frags
 
     if isinstance(f_names1, basestring):
@@ -81,7 +95,10 @@ def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
         outfiles = (out_file1, )
 
     # max number of reads per intermediate files for sorting
-    max_size = 1000000
+    max_size = kwargs.get('max_size', 1000000)
+    ncpus    = kwargs.get('ncpus', 1)
+    pool     = mu.Pool(ncpus) if ncpus > 1 else None
+    jobs     = []
 
     windows = {}
     multis  = {}
@@ -115,44 +132,42 @@ def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
                 while not False:
                     for _ in range(max_size):
                         try:
-                            reads.append(read_read(next(fhandler), frags,
-                                                   frag_chunk))
+                            reads.append(read_read(next(fhandler), frags))
                         except KeyError:
                             # Chromosome not in hash
                             continue
                         read_count += 1
                     nfile += 1
-                    write_reads_to_file(reads, outfiles[read], tmp_files, nfile)
+                    format_reads(reads, frags)
+                    write_reads_to_file(reads, outfiles[read], tmp_files, nfile,
+                                        pool, jobs, ncpus)
             except StopIteration:
                 fhandler.close()
                 nfile += 1
-                write_reads_to_file(reads, outfiles[read], tmp_files, nfile)
+                format_reads(reads, frags)
+                write_reads_to_file(reads, outfiles[read], tmp_files, nfile,
+                                    pool, jobs, ncpus)
             windows[read][num] = read_count
             if kwargs.get('compress', False) and fnam.endswith('.map'):
                 print('compressing input MAP file')
                 procs.append(Popen(['gzip', fnam]))
         nfile += 1
-        write_reads_to_file(reads, outfiles[read], tmp_files, nfile)
+        write_reads_to_file(reads, outfiles[read], tmp_files, nfile,
+                            pool, jobs, ncpus)
+        # wait for all temporary files to be sorted
+        while jobs:
+            jobs.pop(0).get()
 
         # we have now sorted temporary files
-        # we do merge sort for eah pair
+        # we do a k-way merge sort
         if verbose:
             stdout.write('Merge sort')
             stdout.flush()
-        while len(tmp_files) > 1:
-            file1 = tmp_files.pop(0)
-            try:
-                file2 = tmp_files.pop(0)
-            except IndexError:
-                break
-            if verbose:
-                stdout.write('.')
-            stdout.flush()
-            nfile += 1
-            tmp_files.append(merge_sort(file1, file2, outfiles[read], nfile))
+        tmp_name = merge_sort(tmp_files, outfiles[read], nfile,
+                              max_open=kwargs.get('max_open', 64),
+                              verbose=verbose)
         if verbose:
             stdout.write('\n')
-        tmp_name = tmp_files[0]
 
         if verbose:
             print('Getting Multiple contacts')
@@ -198,64 +213,159 @@ def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
         reads_fh.close()
         tmp_reads_fh.close()
         if clean:
-            os.system('rm -rf ' + tmp_name)
+            os.remove(tmp_name)
+    if pool is not None:
+        pool.close()
+        pool.join()
     # wait for compression to finish
     for p in procs:
         p.communicate()
     return windows, multis
 
 
-def write_reads_to_file(reads, outfiles, tmp_files, nfile):
-    if not reads: # can be...
-        return
+def read_name_key(line):
+    """
+    Sort key of parsed reads: read name, without the multi-contact suffix
+    """
+    return line.split('\t', 1)[0].split('~')[0]
+
+
+def paired_read_key(line):
+    """
+    Sort key of parsed pairs of reads (see
+    :func:`pytadbit.parsers.sam_parser.parse_gem_3c`): chromosome index and
+    position of each read-end
+    """
+    elts = line.split('\t', 11)
+    return int(elts[1]), float(elts[3]), int(elts[8]), float(elts[10])
+
+
+def _tmp_name(outfiles, prefix, nfile):
     tmp_name = os.path.join(*outfiles.split('/')[:-1] +
-                            [('tmp_%03d_' % nfile) + outfiles.split('/')[-1]])
-    tmp_name = ('/' * outfiles.startswith('/')) + tmp_name
-    tmp_files.append(tmp_name)
+                            [(prefix % nfile) + outfiles.split('/')[-1]])
+    return ('/' * outfiles.startswith('/')) + tmp_name
+
+
+def _sort_reads_to_file(reads, tmp_name):
     out = open(tmp_name, 'w')
-    out.write(''.join(sorted(reads, key=lambda x: x.split('\t', 1)[0].split('~')[0])))
+    out.write(''.join(sorted(reads, key=read_name_key)))
     out.close()
+
+
+def write_reads_to_file(reads, outfiles, tmp_files, nfile, pool=None,
+                        jobs=None, ncpus=1):
+    """
+    Sort reads and write them to a new temporary file.
+
+    :param reads: list of parsed reads, emptied by this function
+    :param None pool: multiprocessing pool, if given the sort is done in one of
+       its processes and the corresponding job is appended to jobs
+    :param 1 ncpus: number of processes of the pool. At most one job per
+       process is kept waiting, to limit the memory used by the reads in the
+       queue.
+    """
+    if not reads: # can be...
+        return
+    tmp_name = _tmp_name(outfiles, 'tmp_%03d_', nfile)
+    tmp_files.append(tmp_name)
+    if pool is None:
+        _sort_reads_to_file(reads, tmp_name)
+    else:
+        while len(jobs) >= ncpus:
+            jobs.pop(0).get()
+        jobs.append(pool.apply_async(_sort_reads_to_file,
+                                     args=(list(reads), tmp_name)))
     del(reads[:])  # empty list
 
 
-def merge_sort(file1, file2, outfiles, nfile):
-    tmp_name = os.path.join(*outfiles.split('/')[:-1] +
-                            [('tmp_merged_%03d_' % nfile) + outfiles.split('/')[-1]])
-    tmp_name = ('/' * outfiles.startswith('/')) + tmp_name
-    tmp_file = open(tmp_name, 'w')
-    fh1 = open(file1)
-    fh2 = open(file2)
-    greater = lambda x, y: x.split('\t', 1)[0].split('~')[0] > y.split('\t', 1)[0].split('~')[0]
-    read1 = next(fh1)
-    read2 = next(fh2)
-    while True:
-        if greater(read2, read1):
-            tmp_file.write(read1)
-            try:
-                read1 = next(fh1)
-            except StopIteration:
-                tmp_file.write(read2)
-                break
-        else:
-            tmp_file.write(read2)
+def _keyed_lines(fhandler, key, idx):
+    for line in fhandler:
+        yield key(line), idx, line
+
+
+def merge_sort(tmp_files, outfiles, nfile, paired=False, max_open=64,
+               verbose=False):
+    """
+    k-way merge of sorted temporary files into a single sorted file. The sort
+    key of each line is computed only once, and lines with same key keep the
+    order of the input files. Input files are removed.
+
+    :param tmp_files: list of paths to sorted files
+    :param outfiles: path to the final output file, used to name the merged
+       temporary file
+    :param nfile: number used to name the merged temporary files (incremented
+       for each merge)
+    :param False paired: if True, lines are pairs of reads sorted by
+       :func:`paired_read_key`, otherwise reads sorted by
+       :func:`read_name_key`
+    :param 64 max_open: maximum number of files merged at once, if more files
+       are given, merged files are merged again
+
+    :returns: path to the merged file
+    """
+    key = paired_read_key if paired else read_name_key
+    tmp_files = list(tmp_files)
+    if not tmp_files:  # nothing to merge, return empty file
+        tmp_files.append(_tmp_name(outfiles, 'tmp_merged_%03d_', nfile + 1))
+        open(tmp_files[0], 'w').close()
+    while len(tmp_files) > 1:
+        group = tmp_files[:max_open]
+        tmp_files = tmp_files[max_open:]
+        nfile += 1
+        tmp_name = _tmp_name(outfiles, 'tmp_merged_%03d_', nfile)
+        fhandlers = [open(fnam) for fnam in group]
+        tmp_file = open(tmp_name, 'w')
+        tmp_file.writelines(line for _, _, line in merge(
+            *[_keyed_lines(fh, key, i) for i, fh in enumerate(fhandlers)]))
+        tmp_file.close()
+        for fh, fnam in zip(fhandlers, group):
+            fh.close()
+            os.remove(fnam)
+        tmp_files.append(tmp_name)
+        if verbose:
+            stdout.write('.')
+            stdout.flush()
+    return tmp_files[0]
+
+
+def format_reads(reads, frags):
+    """
+    Replace, in place, parsed reads by the lines of the tab separated output,
+    with the position of the RE sites surrounding each read.
+
+    :param reads: list of tuples with read name, chromosome, position, strand
+       (True if positive) and mapped length
+    :param frags: dictionary of arrays of RE sites per chromosome, as returned
+       by :func:`pytadbit.mapping.restriction_enzymes.map_re_sites_array`. If
+       empty, RE sites are set to 0
+    """
+    if not reads:
+        return
+    names, crms, positions, positives, lengths = zip(*reads)
+    positions = array(positions, dtype=int64)
+    prev_re   = zeros(len(reads), dtype=int64)
+    next_re   = zeros(len(reads), dtype=int64)
+    if frags:
+        lengths = array(lengths, dtype=int64)
+        by_crm = {}
+        for i, crm in enumerate(crms):
             try:
-                read2 = next(fh2)
-            except StopIteration:
-                tmp_file.write(read1)
-                break
-    for read in fh1:
-        tmp_file.write(read)
-    for read in fh2:
-        tmp_file.write(read)
-    fh1.close()
-    fh2.close()
-    tmp_file.close()
-    os.system('rm -f ' + file1)
-    os.system('rm -f ' + file2)
-    return tmp_name
-
-
-def read_read_nofrags(r, _, __):
+                by_crm[crm].append(i)
+            except KeyError:
+                by_crm[crm] = [i]
+        for crm, idx in by_crm.items():
+            idx = array(idx)
+            (positions[idx],
+             prev_re[idx],
+             next_re[idx]) = find_re_sites(frags[crm], positions[idx],
+                                           lengths[idx])
+        lengths = lengths.tolist()
+    reads[:] = ['%s\t%s\t%d\t%d\t%d\t%d\t%d\n' % r for r in zip(
+        names, crms, positions.tolist(), positives, lengths,
+        prev_re.tolist(), next_re.tolist())]
+
+
+def read_read_nofrags(r, _):
     name, seq, _, _, ali = r.split('\t')[:5]
     try:
         crm, strand, pos = ali.split(':')[:3]
@@ -267,39 +377,22 @@ def read_read_nofrags(r, _, __):
         pos = int(pos)
     else:
         pos = int(pos) + len_seq - 1 # remove 1 because all inclusive
-    return ('%s\t%s\t%d\t%d\t%d\t0\t0\n' % (
-        name, crm, pos, positive, len_seq))
+    return name, crm, pos, positive, len_seq
 
 
-def read_read_frags(r, frags, frag_chunk):
+def read_read_frags(r, frags):
     name, seq, _, _, ali = r.split('\t')[:5]
     try:
         crm, strand, pos = ali.split(':')[:3]
     except ValueError:
         raise KeyError()
     crm = crm.split()[0]
+    if not crm in frags:
+        raise KeyError()
     positive = strand == '+'
     len_seq  = len(seq)
     if positive:
         pos = int(pos)
     else:
         pos = int(pos) + len_seq - 1 # remove 1 because all inclusive
-    frag_piece = frags[crm][pos // frag_chunk]
-    idx = bisect(frag_piece, pos)
-    try:
-        next_re = frag_piece[idx]
-    except IndexError:
-        # case where part of the read is mapped outside chromosome
-        count = 0
-        while idx >= len(frag_piece) and count < len_seq:
-            pos -= 1
-            count += 1
-            frag_piece = frags[crm][pos // frag_chunk]
-            idx = bisect(frag_piece, pos)
-        if count >= len_seq:
-            raise Exception('Read mapped mostly outside ' +
-                            'chromosome\n(also reference genome can be truncated)')
-        next_re = frag_piece[idx]
-    prev_re = frag_piece[idx - 1 if idx else 0]
-    return ('%s\t%s\t%d\t%d\t%d\t%d\t%d\n' % (
-        name, crm, pos, positive, len_seq, prev_re, next_re))
+    return name, crm, pos, positive, len_seq
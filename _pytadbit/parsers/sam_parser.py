@@ -5,12 +5,15 @@ from __future__ import print_function
 from builtins import next
 
 from itertools import combinations
-from bisect import bisect_right as bisect
 from pysam import Samfile
-from pytadbit.mapping.restriction_enzymes import map_re_sites
+from pytadbit.mapping.restriction_enzymes import map_re_sites_array
+from pytadbit.mapping.restriction_enzymes import find_re_sites
+from pytadbit.parsers.map_parser import merge_sort, write_reads_to_file
+from pytadbit.parsers.map_parser import format_reads
 from shutil import copyfileobj
 from warnings import warn
 import os
+import multiprocessing as mu
 from sys import stdout
 
 try:
@@ -43,6 +46,15 @@ def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
     :param re_name: name of the restriction enzyme used
     :param None mapper: software used to map (supported are GEM and BOWTIE2).
        Guessed from file by default.
+    :param 1000000 max_size: maximum number of reads kept in memory, sorted and
+       written to a temporary file, before the final merge sort
+    :param 1 ncpus: number of CPUs used to sort the temporary files
+    :param 64 max_open: maximum number of temporary files merged at once
+    :param None re_cache: directory where to cache the positions of RE sites
+       in the genome (see
+       :func:`pytadbit.mapping.restriction_enzymes.map_re_sites_array`)
+    :param None genome_path: path to the FASTA file(s) of genome_seq, needed
+       to cache the RE sites
     """
     # not nice, dirty fix in order to allow this function to only parse
     # one SAM file
@@ -55,11 +67,12 @@ def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
     if (f_names2 and not out_file2) or (not f_names2 and out_file2):
         raise Exception('ERROR: out_file2 AND f_names2 needed\n')
 
-    frag_chunk = kwargs.get('frag_chunk', 100000)
     if verbose:
         print('Searching and mapping RE sites to the reference genome')
-    frags = map_re_sites(re_name, genome_seq, frag_chunk=frag_chunk,
-                         verbose=verbose)
+    frags = map_re_sites_array(re_name, genome_seq,
+                               cache_dir=kwargs.get('re_cache', None),
+                               genome_path=kwargs.get('genome_path', None),
+                               verbose=verbose)
 
     if isinstance(f_names1, basestring):
         f_names1 = [f_names1]
@@ -73,7 +86,10 @@ def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
         outfiles = (out_file1, )
 
     # max number of reads per intermediate files for sorting
-    max_size = 1000000
+    max_size = kwargs.get('max_size', 1000000)
+    ncpus    = kwargs.get('ncpus', 1)
+    pool     = mu.Pool(ncpus) if ncpus > 1 else None
+    jobs     = []
 
     windows = {}
     multis  = {}
@@ -137,59 +153,37 @@ def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
                     pos = r.pos + 1
                 else:
                     pos = r.pos + len_seq
-                try:
-                    frag_piece = frags[crm][pos // frag_chunk]
-                except KeyError:
+                if not crm in frags:
                     # Chromosome not in hash
                     continue
-                idx = bisect(frag_piece, pos)
-                try:
-                    next_re = frag_piece[idx]
-                except IndexError:
-                    # case where part of the read is mapped outside chromosome
-                    count = 0
-                    while idx >= len(frag_piece) and count < len_seq:
-                        pos -= 1
-                        count += 1
-                        frag_piece = frags[crm][pos // frag_chunk]
-                        idx = bisect(frag_piece, pos)
-                    if count >= len_seq:
-                        raise Exception('Read mapped mostly outside ' +
-                                        'chromosome\n(also reference genome can be truncated)')
-                    next_re    = frag_piece[idx]
-                prev_re    = frag_piece[idx - 1 if idx else 0]
-                name       = r.qname
-                reads.append('%s\t%s\t%d\t%d\t%d\t%d\t%d\n' % (
-                    name, crm, pos, positive, len_seq, prev_re, next_re))
+                # RE sites are searched for the whole buffer at once
+                reads.append((r.qname, crm, pos, positive, len_seq))
                 windows[read][num] += 1
                 sub_count += 1
                 if sub_count >= max_size:
                     sub_count = 0
                     nfile += 1
-                    write_reads_to_file(reads, outfiles[read], tmp_files, nfile)
+                    format_reads(reads, frags)
+                    write_reads_to_file(reads, outfiles[read], tmp_files, nfile,
+                                        pool, jobs, ncpus)
             nfile += 1
-            write_reads_to_file(reads, outfiles[read], tmp_files, nfile)
-
+            format_reads(reads, frags)
+            write_reads_to_file(reads, outfiles[read], tmp_files, nfile,
+                                pool, jobs, ncpus)
+        # wait for all temporary files to be sorted
+        while jobs:
+            jobs.pop(0).get()
 
         # we have now sorted temporary files
-        # we do merge sort for eah pair
+        # we do a k-way merge sort
         if verbose:
             stdout.write('Merge sort')
             stdout.flush()
-        while len(tmp_files) > 1:
-            file1 = tmp_files.pop(0)
-            try:
-                file2 = tmp_files.pop(0)
-            except IndexError:
-                break
-            if verbose:
-                stdout.write('.')
-            stdout.flush()
-            nfile += 1
-            tmp_files.append(merge_sort(file1, file2, outfiles[read], nfile))
+        tmp_name = merge_sort(tmp_files, outfiles[read], nfile,
+                              max_open=kwargs.get('max_open', 64),
+                              verbose=verbose)
         if verbose:
             stdout.write('\n')
-        tmp_name = tmp_files[0]
 
         if verbose:
             print('Getting Multiple contacts')
@@ -235,7 +229,10 @@ def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
         reads_fh.close()
         tmp_reads_fh.close()
         if clean:
-            os.system('rm -rf ' + tmp_name)
+            os.remove(tmp_name)
+    if pool is not None:
+        pool.close()
+        pool.join()
     # wait for compression to finish
     for p in procs:
         p.communicate()
@@ -253,7 +250,6 @@ def parse_gem_3c(f_name, out_file, genome_lengths, frags, verbose=False,
     :param False tmp_format: If True leave the file prepared to be merged with other map files.
     """
 
-    frag_chunk = kwargs.get('frag_chunk', 100000)
     try:
         fhandler = Samfile(f_name)
     except IOError:
@@ -338,27 +334,13 @@ def parse_gem_3c(f_name, out_file, genome_lengths, frags, verbose=False,
                 else:
                     pos = read.pos + len_seq
                 try:
-                    frag_piece = frags[crm][pos // frag_chunk]
+                    re_sites = frags[crm]
                 except KeyError:
                     # Chromosome not in hash
                     read_multi = []
                     break
-                idx = bisect(frag_piece, pos)
-                try:
-                    next_re = frag_piece[idx]
-                except IndexError:
-                    # case where part of the read is mapped outside chromosome
-                    count = 0
-                    while idx >= len(frag_piece) and count < len_seq:
-                        pos -= 1
-                        count += 1
-                        frag_piece = frags[crm][pos // frag_chunk]
-                        idx = bisect(frag_piece, pos)
-                    if count >= len_seq:
-                        raise Exception('Read mapped mostly outside ' +
-                                        'chromosome\n')
-                    next_re    = frag_piece[idx]
-                prev_re    = frag_piece[idx - 1 if idx else 0]
+                pos, prev_re, next_re = [int(v[0]) for v in find_re_sites(
+                    re_sites, [pos], [len_seq])]
                 reads_grp.append([read.tid, crm, pos, positive,
                                   len_seq, prev_re, next_re])
             if len(reads_grp) > 2:
@@ -404,51 +386,31 @@ def parse_gem_3c(f_name, out_file, genome_lengths, frags, verbose=False,
 
     #map_out.close()
     # we have now sorted temporary files
-    # we do merge sort for eah pair
+    # we do a k-way merge sort
     if verbose:
         stdout.write('Merge sort')
         stdout.flush()
-    while len(tmp_files) > 1:
-        file1 = tmp_files.pop(0)
-        try:
-            file2 = tmp_files.pop(0)
-        except IndexError:
-            break
-        if verbose:
-            stdout.write('.')
-        stdout.flush()
-        nfile += 1
-        tmp_files.append(merge_sort(file1, file2, out_file, nfile, paired=True))
+    tmp_name = merge_sort(tmp_files, out_file, nfile, paired=True,
+                          max_open=kwargs.get('max_open', 64), verbose=verbose)
     if verbose:
         stdout.write('\n')
 
     if tmp_format:
-        os.rename(tmp_files[0], out_file)
+        os.rename(tmp_name, out_file)
     else:
         map_out   = open(out_file, 'w')
-        tmp_reads_fh = open(tmp_files[0],'rb')
+        tmp_reads_fh = open(tmp_name)
         for crm in genome_lengths:
             map_out.write('# CRM %s\t%d\n' % (crm, genome_lengths[crm]))
         for read_line in tmp_reads_fh:
             read = read_line.split('\t')
             map_out.write('\t'.join([read[0]]+read[2:8]+read[9:]))
         map_out.close()
-        os.system('rm -rf ' + tmp_files[0])
+        tmp_reads_fh.close()
+        os.remove(tmp_name)
 
     return out_file
 
-def write_reads_to_file(reads, outfiles, tmp_files, nfile):
-    if not reads: # can be...
-        return
-    tmp_name = os.path.join(*outfiles.split('/')[:-1] +
-                            [('tmp_%03d_' % nfile) + outfiles.split('/')[-1]])
-    tmp_name = ('/' * outfiles.startswith('/')) + tmp_name
-    tmp_files.append(tmp_name)
-    out = open(tmp_name, 'w')
-    out.write(''.join(sorted(reads, key=lambda x: x.split('\t', 1)[0].split('~')[0])))
-    out.close()
-    del(reads[:]) # empty list
-
 def write_paired_reads_to_file(reads, outfiles, tmp_files, nfile):
     if not reads: # can be...
         return
@@ -503,46 +465,3 @@ def _merge_multis(reads_multi):
             merged_reads.append(list(map1[:2]) + [str(beg), strand, str(nts)] + list(map1[5:]))
 
     reads_multi = merged_reads
-
-
-def merge_sort(file1, file2, outfiles, nfile, paired=False):
-    tmp_name = os.path.join(*outfiles.split('/')[:-1] +
-                            [('tmp_merged_%03d_' % nfile) + outfiles.split('/')[-1]])
-    tmp_name = ('/' * outfiles.startswith('/')) + tmp_name
-    tmp_file = open(tmp_name, 'w')
-    fh1 = open(file1)
-    fh2 = open(file2)
-    if paired:
-        greater = lambda x, y: [y,x] == sorted([y,x], key=lambda j: (int(j.split('\t')[1]),
-                                                                 float(j.split('\t')[3]),
-                                                                 int(j.split('\t')[8]),
-                                                                 float(j.split('\t')[10])))
-    else:
-        greater = lambda x, y: x.split('\t', 1)[0].split('~')[0] > y.split('\t', 1)[0].split('~')[0]
-    read1 = next(fh1)
-    read2 = next(fh2)
-    while True:
-        if greater(read2, read1):
-            tmp_file.write(read1)
-            try:
-                read1 = next(fh1)
-            except StopIteration:
-                tmp_file.write(read2)
-                break
-        else:
-            tmp_file.write(read2)
-            try:
-                read2 = next(fh2)
-            except StopIteration:
-                tmp_file.write(read1)
-                break
-    for read in fh1:
-        tmp_file.write(read)
-    for read in fh2:
-        tmp_file.write(read)
-    fh1.close()
-    fh2.close()
-    tmp_file.close()
-    os.system('rm -f ' + file1)
-    os.system('rm -f ' + file2)
-    return tmp_name
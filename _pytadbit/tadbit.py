@@ -9,6 +9,7 @@ from pytadbit.tadbit_py           import _tadbit_wrapper
 from math                         import isnan, sqrt
 from scipy.sparse.csr             import csr_matrix
 from scipy.stats                  import mannwhitneyu
+import multiprocessing as mu
 import numpy as np
 
 
@@ -40,9 +41,14 @@ def tadbit(x, remove=None, n_cpus=1, verbose=True,
        removed)
     :param 1 n_cpus: The number of CPUs to allocate to TADbit. If
        n_cpus='max' the total number of CPUs will be used
+    :param True verbose: print the progress of the C implementation
     :param auto max_tad_size: an integer defining maximum size of TAD. Default
-       (auto or max) defines it as the number of rows/columns
+       (auto or max) defines it as the number of rows/columns. Only the
+       segments up to this size are evaluated, their likelihoods being stored
+       in a band of size * max_tad_size values
     :param False no_heuristic: whether to use or not some heuristics
+    :param None ntads: number of TADs of the segmentation returned (by default
+       the optimal one, according to the BIC)
     :param False use_topdom: whether to use TopDom algorithm to find tads or not (http://www.ncbi.nlm.nih.gov/pubmed/26704975, http://zhoulab.usc.edu/TopDom/)
     :param 5 topdom_window: the window size for topdom algorithm
     :param False get_weights: either to return the weights corresponding to the
@@ -52,15 +58,22 @@ def tadbit(x, remove=None, n_cpus=1, verbose=True,
     :returns: the :py:func:`list` of topologically associated domains'
        boundaries, and the corresponding list associated log likelihoods.
        If no weights are given, it may also return calculated weights.
+
+    .. note::
+
+       Up to version 0.4.97 the values of verbose, max_tad_size, no_heuristic
+       and ntads never reached the C implementation, that always ran
+       silently, with the heuristic, on segments of any size, returning the
+       optimal number of TADs. They are now all applied.
     """
     nums = [hic_data for hic_data in read_matrix(x, one=False)]
 
     if not use_topdom:
         size = len(nums[0])
-        nums = [num.get_as_tuple() for num in nums]
+        nums = [_get_c_matrix(num) for num in nums]
         if not remove:
             # if not given just remove columns with zero in diagonal
-            remove = tuple([0 if nums[0][i*size+i] else 1 for i in range(size)])
+            remove = tuple([0 if d else 1 for d in nums[0].diagonal()])
         n_cpus = n_cpus if n_cpus != 'max' else 0
         max_tad_size = size if max_tad_size in ["max", "auto"] else max_tad_size
         _, nbks, passages, _, _, bkpts = \
@@ -71,11 +84,11 @@ def tadbit(x, remove=None, n_cpus=1, verbose=True,
                            n_cpus,           # number of threads
                            int(verbose),     # verbose 0/1
                            max_tad_size,     # max_tad_size
-                           kwargs.get('ntads', -1) + 1,
+                           kwargs.get('ntads', 0),
                            int(no_heuristic),# heuristic 0/1
                            )
 
-        breaks = [i for i in range(size) if bkpts[i + nbks * size] == 1]
+        breaks = [i for i in range(size) if bkpts[i] == 1]
         scores = [p for p in passages if p > 0]
 
         result = {'start': [], 'end'  : [], 'score': []}
@@ -105,6 +118,33 @@ def tadbit(x, remove=None, n_cpus=1, verbose=True,
     return result
 
 
+def _get_c_matrix(hic_data):
+    """
+    Dense copy of a Hi-C matrix laid out as expected by the C
+    implementation of TADbit (column-major, C integers), passed to it
+    without any further copy.
+
+    The C implementation only works on raw counts: an error is raised if
+    the matrix holds non-integer values (e.g. normalized data), instead of
+    silently truncating them.
+    """
+    size = len(hic_data)
+    matrix = np.zeros((size, size), dtype=np.intc)
+    keys = np.fromiter(hic_data.keys(), dtype=np.int64)
+    values = np.fromiter(hic_data.values(), dtype=float)
+    if (values != np.rint(values)).any():
+        raise Exception('ERROR: TADbit works on raw counts, input matrix '
+                        'holds non-integer values (normalized data?)')
+    if len(values) and (values.min() < np.iinfo(np.intc).min or
+                        values.max() > np.iinfo(np.intc).max):
+        raise Exception('ERROR: input matrix holds counts out of the range '
+                        'of C integers')
+    rows, cols = np.divmod(keys, size)
+    # the element (i, j) of the matrix is at position i + j * size
+    matrix[cols, rows] = values
+    return matrix
+
+
 def batch_tadbit(directory, parser=None, **kwargs):
     """
     Use tadbit on directories of data files.
@@ -190,19 +230,23 @@ def TopDom(hic_data,window_size,statFilter=True):
         of computed p-values by Wilcox Ranksum Test as score while boundaries and gaps have a score of zero.
     """
     n_bins = len(hic_data)
-    mean_cf = np.zeros(n_bins)
     pvalue = np.ones(n_bins)
 
     local_ext = np.ones(n_bins)*(-0.5)
 
+    # upper triangle of the matrix, only needed diagonals are kept
+    coo_mat = hic_data.get_hic_data_as_csr().tocoo()
+    diag = coo_mat.col - coo_mat.row
+    keep = (diag >= 0) & (diag < 2 * window_size)
+    rows, cols, values = coo_mat.row[keep], coo_mat.col[keep], coo_mat.data[keep]
+
     #Step 1
-    csr_mat = hic_data.get_hic_data_as_csr()
-    for i in range(n_bins):
-        diamond_mean = Get_Diamond_Matrix_Mean(data=csr_mat, i=i, size=window_size)
-        mean_cf[i] = diamond_mean
+    mean_cf = _topdom_diamond_means(rows, cols, values, n_bins, window_size)
 
     #Step 2
-    gap_idx = Which_Gap_Region(data=csr_mat)
+    nonzero = coo_mat.data != 0
+    gap_idx = _topdom_gaps(coo_mat.row[nonzero], coo_mat.col[nonzero], n_bins)
+    del coo_mat
     proc_regions = Which_process_region(rmv_idx=gap_idx, n_bins=n_bins, min_size=3)
 
     for key in proc_regions:
@@ -216,31 +260,17 @@ def TopDom(hic_data,window_size,statFilter=True):
 
     if statFilter:
         #Step 3
-        lil_mat = csr_mat.todense()
-        for k in range(1,(2*window_size)):
-
-            mat_row = []
-            mat_column = []
-            my_range = list(range((n_bins*k), (n_bins*n_bins), 1+n_bins))
-            mat_values = np.empty(len(my_range))
-            col_arr = 0
-            for j in my_range:
-                mat_row.append(int(round(j//lil_mat.shape[0])))
-                mat_column.append(j%lil_mat.shape[0])
-                mat_values[col_arr] = lil_mat[int(round(j//lil_mat.shape[0])),j%lil_mat.shape[0]]
-                col_arr = col_arr + 1
-            
-            scale_values = scale(mat_values)
-            
-            for i in range(len(mat_row)):
-                lil_mat[mat_column[i],mat_row[i]] = scale_values[i]
-
+        # band[i, k] is the cell (i, i + k), diagonals are scaled
+        band = np.zeros((n_bins, 2 * window_size))
+        band[rows, cols - rows] = values
+        for k in range(1, min(2 * window_size, n_bins)):
+            band[:n_bins - k, k] = scale(band[:n_bins - k, k])
 
         for key in proc_regions:
             start = proc_regions[key]['start']
             end = proc_regions[key]['end']
 
-            pvalue[start:end] = Get_Pvalue(data=lil_mat[start:end+1, start:end+1], size=window_size, scale=1)
+            pvalue[start:end] = _topdom_pvalues(band, start, end, window_size)
 
         for i in range(len(local_ext)):
             if local_ext[i] == -1 and pvalue[i] < 0.05:
@@ -262,6 +292,110 @@ def TopDom(hic_data,window_size,statFilter=True):
 
     return domains
 
+def _topdom_diamond_means(rows, cols, values, n_bins, size):
+    """
+    Mean of the interactions in the diamond of each bin (see
+    :func:`Get_Diamond_Matrix_Mean`), from a summed-area table of the band of
+    the matrix.
+    """
+    mean_cf = np.empty(n_bins)
+    mean_cf[-1] = np.nan
+    table = _band_summed_area(rows, cols, values, n_bins, 2 * size + 1)
+    pos = np.arange(n_bins - 1)
+    # rows lowerbound to pos, columns pos + 1 to upperbound - 1
+    lowerbound = np.maximum(0, pos - size + 1)
+    upperbound = np.minimum(pos + size + 1, n_bins)
+    last = upperbound - 1
+    sums = (table[last + 1, last - pos + 1]
+            - table[last + 1, last - lowerbound + 2]
+            - table[pos + 1, 1]
+            + table[pos + 1, pos - lowerbound + 2])
+    mean_cf[:-1] = sums / ((pos + 1 - lowerbound) * (upperbound - pos - 1))
+    return mean_cf
+
+
+def _topdom_gaps(rows, cols, n_bins):
+    """
+    Same as :func:`Which_Gap_Region`, from the coordinates of the non-zero
+    cells of the matrix.
+    """
+    # for each bin, the closest bin it interacts with, upstream (or itself)
+    closest = np.ones(n_bins, dtype=int) * -1
+    np.maximum.at(closest, np.maximum(rows, cols), np.minimum(rows, cols))
+    closest = closest.tolist()
+    gap = np.zeros(n_bins)
+    i = 0
+    while i < n_bins:
+        j = i + 1
+        # square from i to j is empty
+        while j < n_bins and closest[i] < i and closest[j] < i:
+            gap[i:j+1] = -0.5
+            j = j + 1
+        i = j
+    return np.where(gap==-0.5)[0]
+
+
+def _topdom_pvalues(band, start, end, size):
+    """
+    Same as :func:`Get_Pvalue` on the region from start to end (included),
+    with the matrix stored as a band of scaled diagonals.
+    """
+    dias = []
+    others = []
+    for i in range(start + 1, end + 1):
+        # diamond: rows i - size to i - 1, columns i to i + size - 1
+        beg = max(start, i - size)
+        fin = min(i + size, end + 1)
+        rows, cols = np.meshgrid(np.arange(beg, i), np.arange(i, fin),
+                                 indexing='ij')
+        dia = band[rows, cols - rows].ravel()
+        dias.append(dia[np.logical_not(np.isnan(dia))])
+        # upstream and downstream triangles
+        triags = []
+        for lo, hi in ((max(start, i - size - 1), i), (i, fin)):
+            rows, cols = np.triu_indices(hi - lo, k=1)
+            triag = band[rows + lo, cols - rows]
+            triags.append(triag[triag != 0])
+        others.append(np.concatenate(triags))
+
+    pvalue = _mannwhitneyu_less(dias, others)
+    pvalue[ np.isnan(pvalue) ] = 1
+
+    return pvalue
+
+
+def _mannwhitneyu_less(xs, ys):
+    """
+    P-values of one-sided Mann-Whitney U tests (values in x lower than in y),
+    with continuity correction, for a list of pairs of samples, as given by
+    scipy.stats.mannwhitneyu.
+
+    scipy always uses the normal approximation when both samples are larger
+    than 8: these tests are grouped by sample sizes and each group is computed
+    with a single call along an axis (method given explicitly). Other tests
+    are passed one by one, scipy choosing the method as for a single test.
+    """
+    pvalue = np.empty(len(xs))
+    groups = {}
+    for k, (x, y) in enumerate(zip(xs, ys)):
+        if len(x) > 8 and len(y) > 8:
+            groups.setdefault((len(x), len(y)), []).append(k)
+        else:
+            pvalue[k] = mannwhitneyu(x=x, y=y, use_continuity=True,
+                                     alternative='less').pvalue
+    for ks in groups.values():
+        try:
+            pvalue[ks] = mannwhitneyu(
+                np.array([xs[k] for k in ks]), np.array([ys[k] for k in ks]),
+                use_continuity=True, alternative='less', axis=1,
+                method='asymptotic').pvalue
+        except TypeError:  # scipy < 1.7, without axis nor method
+            for k in ks:
+                pvalue[k] = mannwhitneyu(x=xs[k], y=ys[k], use_continuity=True,
+                                         alternative='less').pvalue
+    return pvalue
+
+
 def Get_Diamond_Matrix_Mean(data, i, size):
 
     n_bins = data.shape[1]
@@ -533,8 +667,67 @@ def Get_Downstream_Triangle(data, i, size):
     return triag[triag!=0].tolist()
 
 
+def _band_summed_area(rows, cols, values, size, width):
+    """
+    Summed-area table of a band of a matrix.
+
+    Values are stored by row and distance to the diagonal, cumulated along
+    rows, and then along anti-diagonals (row + column constant). The sum of
+    the values in rows r0 to r1, and columns c0 to c1 (all inclusive), is:
+
+       table[c1 + 1, c1 - r1 + 1] - table[c1 + 1, c1 - r0 + 2]
+       - table[c0, c0 - r1] + table[c0, c0 - r0 + 1]
+    """
+    band = np.zeros((size, width))
+    band[rows, cols - rows + 1] = values
+    band = np.cumsum(band, axis=1)
+    # anti-diagonals as rows
+    table = np.zeros((size + width, width + 1))
+    for col in range(width):
+        table[col:col + size, col] = band[:, col]
+    del band
+    table[:, :width] = np.cumsum(table[:, width - 1::-1], axis=1)[:, ::-1]
+    return table
+
+
+def _insulation_chromosome(rows, cols, values, size, dists):
+    """
+    Insulation scores of one chromosome, for all bands at once.
+
+    :param rows: numpy array of rows of the interactions (in the chromosome)
+    :param cols: numpy array of columns of the interactions, with
+       0 <= col - row <= twice the largest band
+    :param values: numpy array of normalized interactions
+    :param size: number of bins in the chromosome
+    :param dists: list of pairs of distances (see
+       :func:`pytadbit.tadbit.insulation_score`)
+
+    :returns: a dictionary with, for each pair of distances, an array of
+       insulation scores of the bins from end to size - end
+    """
+    width = 2 * max(end for _, end in dists) + 2
+    sums = _band_summed_area(rows, cols, values, size, width)
+    # number of interactions, to get exact zeros
+    nums = _band_summed_area(rows, cols, np.ones(len(rows)), size, width)
+    insidx = {}
+    for dist, end in dists:
+        # rows pos - end to pos - dist, columns pos + dist to pos + end
+        pos = np.arange(end, max(end, size - end))
+        vals = []
+        for table in (sums, nums):
+            vals.append(table[pos + end + 1, end + dist + 1]
+                        - table[pos + end + 1, 2 * end + 2]
+                        - table[pos + dist, 2 * dist]
+                        + table[pos + dist, end + dist + 1])
+        vals, num = vals
+        vals[num < 0.5] = 0
+        insidx[(dist, end)] = np.maximum(vals, 0)
+    return insidx
+
+
 def insulation_score(hic_data, dists, normalize=False, resolution=1,
-                     delta=0, silent=False, savedata=None, savedeltas=None):
+                     delta=0, silent=False, savedata=None, savedeltas=None,
+                     n_cpus=1):
     """
     Compute insulation score.
 
@@ -550,6 +743,7 @@ def insulation_score(hic_data, dists, normalize=False, resolution=1,
     :param False silent:
     :param None savedata: path to file where to save result
     :param None savedeltas: path to file where to save deltas
+    :param 1 n_cpus: number of chromosomes processed in parallel
 
     :returns: dictionary with insulation score
     """
@@ -560,6 +754,40 @@ def insulation_score(hic_data, dists, normalize=False, resolution=1,
         raise Exception('ERROR: HiC_data should be normalized by visibility '
                         'and by expected')
 
+    max_dist = 2 * max(end for _, end in dists)
+    size = len(hic_data)
+    norm = np.array([bias.get(i, 1.) for i in range(size)], dtype=float)
+    good = np.ones(size, dtype=bool)
+    if bads:
+        good[list(bads)] = False
+    matrix = hic_data.get_hic_data_as_csr()
+    pool = mu.Pool(n_cpus) if n_cpus > 1 else None
+    jobs = {}
+    for crm in hic_data.chromosomes:
+        if crm in decay:
+            this_decay = decay[crm]
+        else:
+            this_decay = decay
+        beg, fin = hic_data.section_pos[crm]
+        sub = matrix[beg:fin, beg:fin].tocoo()
+        diag = sub.col - sub.row
+        keep = ((diag >= 0) & (diag <= max_dist) &
+                good[sub.row + beg] & good[sub.col + beg])
+        rows, cols, diag = sub.row[keep], sub.col[keep], diag[keep]
+        crm_decay = np.array([this_decay[d] for d in range(
+            min(max_dist, fin - beg - 1) + 1)], dtype=float)
+        values = (sub.data[keep] / norm[rows + beg] / norm[cols + beg] /
+                  crm_decay[diag])
+        args = (rows, cols, values, fin - beg, dists)
+        if pool:
+            jobs[crm] = pool.apply_async(_insulation_chromosome, args=args)
+        else:
+            jobs[crm] = _insulation_chromosome(*args)
+    if pool:
+        pool.close()
+        pool.join()
+        jobs = dict((crm, jobs[crm].get()) for crm in jobs)
+
     insidx = {}
     deltas = {}
     for dist, end in dists:
@@ -568,22 +796,12 @@ def insulation_score(hic_data, dists, normalize=False, resolution=1,
         insidx[(dist, end)] = {}
         deltas[(dist, end)] = {}
         for crm in hic_data.chromosomes:
-            if crm in decay:
-                this_decay = decay[crm]
-            else:
-                this_decay = decay
-            total = 0
-            count = 0
-            for pos in range(hic_data.section_pos[crm][0] + end,
-                             hic_data.section_pos[crm][1] - end):
-                val = sum(hic_data[i, j] / bias[i] / bias[j] / this_decay[abs(j-i)]
-                          for i in range(pos - end, pos - dist + 1)
-                          if not i in bads
-                          for j in range(pos + dist, pos + end + 1)
-                          if not j in bads)
-                total += val
-                count += 1
+            beg = hic_data.section_pos[crm][0]
+            vals = jobs[crm][(dist, end)].tolist()
+            for pos, val in enumerate(vals, beg + end):
                 insidx[(dist, end)][pos] = val
+            total = sum(vals)
+            count = len(vals)
             if normalize:
                 try:
                     total /= float(count)
@@ -31,6 +31,7 @@ from pytadbit.mapping.filter         import MASKED
 from pytadbit.utils.file_handling    import mkdir
 from pytadbit.parsers.hic_bam_parser import filters_to_bin, printime
 from pytadbit.parsers.hic_bam_parser import write_matrix, get_matrix
+from pytadbit.parsers.hic_bam_parser import write_multires_cooler
 from pytadbit.parsers.tad_parser     import parse_tads
 from pytadbit.utils.sqlite_utils     import already_run, digest_parameters
 from pytadbit.utils.sqlite_utils     import add_path, get_jobid, print_db, retry
@@ -188,7 +189,7 @@ def run(opts):
                     return_headers=True,
                     nchunks=opts.nchunks, verbose=not opts.quiet,
                     clean=clean, max_size=max_size,
-                    chr_order=opts.chr_name)
+                    chr_order=opts.chr_name, bin_index=opts.bin_index)
             except NotImplementedError:
                 if norm == "raw&decay":
                     warn('WARNING: raw&decay normalization not implemented '
@@ -292,7 +293,15 @@ def run(opts):
                     plt.close('all')
                 else:
                     tadbit_savefig(path.join(outdir, fnam))
-    if not opts.matrix and not opts.only_plot:
+    if not opts.matrix and not opts.only_plot and opts.coarser:
+        printime('Getting and writing matrices at %d resolutions' % (
+            len(set([opts.reso] + opts.coarser))))
+        out_files.update(write_multires_cooler(
+            mreads, opts.reso, outdir, resolutions=opts.coarser,
+            filter_exclude=opts.filter, tmpdir=tmpdir, ncpus=opts.cpus,
+            nchunks=opts.nchunks, verbose=not opts.quiet,
+            extra=param_hash, clean=clean, chr_order=opts.chr_name))
+    elif not opts.matrix and not opts.only_plot:
         printime('Getting and writing matrices')
         out_files.update(write_matrix(
             mreads, opts.reso,
@@ -304,7 +313,7 @@ def run(opts):
             tmpdir=tmpdir, append_to_tar=None, ncpus=opts.cpus,
             nchunks=opts.nchunks, verbose=not opts.quiet,
             extra=param_hash, cooler=opts.cooler, clean=clean,
-            chr_order=opts.chr_name))
+            chr_order=opts.chr_name, bin_index=opts.bin_index))
 
     if clean:
         printime('Cleaning')
@@ -478,6 +487,19 @@ def check_options(opts):
     if not path.exists(opts.workdir):
         raise IOError('ERROR: workdir not found.')
 
+    # several resolutions from a single reading of the BAM
+    if opts.coarser:
+        if opts.coord1 or opts.coord2:
+            raise Exception('ERROR: multiple resolutions only available for '
+                            'the full genome.')
+        if opts.normalizations != ['raw']:
+            raise Exception('ERROR: multiple resolutions only available for '
+                            'raw matrices.')
+        if any(reso % opts.reso for reso in opts.coarser):
+            raise Exception('ERROR: coarser resolutions should be multiples '
+                            'of %d.' % (opts.reso))
+        opts.cooler = True
+
     # check resume
     if opts.triangular and opts.coord2:
         raise NotImplementedError('ERROR: triangular is only available for '
@@ -571,6 +593,16 @@ def populate_args(parser):
                         help='''maximum number of chunks into which to
                         cut the BAM''')
 
+    glopts.add_argument('--bin_index', dest='bin_index', action='store',
+                        nargs='?', const=True, default=False, metavar='PATH',
+                        help='''read the interactions from an index of the
+                        binned BAM file, instead of parsing the BAM. The index
+                        is built the first time (per resolution and set of
+                        filters), and rebuilt if the BAM file changes. It is
+                        stored next to the BAM file (or in the temporary
+                        directory if not writable), or in the directory
+                        given''')
+
     glopts.add_argument("-C", "--cpus", dest="cpus", type=int,
                         default=cpu_count(), help='''[%(default)s] Maximum
                         number of CPU cores  available in the execution host.
@@ -595,6 +627,14 @@ def populate_args(parser):
                         help='''Write i,j,v matrix in cooler format instead of text.
                         ''')
 
+    outopt.add_argument('--coarser', dest='coarser', metavar='INT', nargs='+',
+                        default=None, type=int,
+                        help='''coarser resolutions (multiples of the one given
+                        with -r) computed from the same reading of the BAM
+                        file. All matrices are written in a single
+                        multi-resolution cooler file (implies --cooler, only
+                        for raw matrices of the full genome)''')
+
     outopt.add_argument('--rownames', dest='row_names', action='store_true',
                         default=False,
                         help='''To store row names in the output text matrix.
@@ -57,7 +57,8 @@ def run(opts):
             # compute the intersection of the two read ends
             print('Getting intersection between read 1 and read 2')
             count, multiples = get_intersection(fname1, fname2, reads,
-                                                compress=opts.compress_input)
+                                                compress=opts.compress_input,
+                                                ncpus=opts.cpus)
 
         # compute insert size
         print('Get insert size...')
@@ -91,7 +92,8 @@ def run(opts):
                               min_frag_size=opts.min_frag_size,
                               re_proximity=opts.re_proximity,
                               strict_duplicates=opts.strict_duplicates,
-                              min_dist_to_re=min_dist, fast=True)
+                              min_dist_to_re=min_dist, fast=True,
+                              ncpus=opts.cpus, bitmask=True)
 
     n_valid_pairs = apply_filter(reads, mreads, masked, filters=opts.apply)
 
@@ -461,7 +463,8 @@ def populate_args(parser):
 
     glopts.add_argument('--samtools', dest='samtools', metavar="PATH",
                         action='store', default='samtools', type=str,
-                        help='''path samtools binary''')
+                        help='''path samtools binary (not used anymore, the
+                        BAM file is written with pysam)''')
 
     parser.add_argument_group(glopts)
 
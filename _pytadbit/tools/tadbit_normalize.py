@@ -24,6 +24,10 @@ import time
 
 from pysam                                import AlignmentFile
 from numpy                                import nanmean, isnan, nansum, seterr
+from numpy                                import empty, zeros, fromiter, bincount
+from numpy                                import flatnonzero, int32, int64, float64
+from numpy                                import save as npsave
+from numpy                                import load as npload
 
 from pytadbit                             import load_hic_data_from_bam
 from pytadbit.utils.sqlite_utils          import already_run, digest_parameters
@@ -36,7 +40,8 @@ from pytadbit.parsers.hic_bam_parser      import filters_to_bin
 from pytadbit.parsers.bed_parser          import parse_mappability_bedGraph
 from pytadbit.utils.extraviews            import nicer
 from pytadbit.utils.hic_filtering         import filter_by_cis_percentage
-from pytadbit.utils.normalize_hic         import oneD
+from pytadbit.utils.normalize_hic         import oneD, iterative_dot
+from pytadbit.utils.normalize_hic         import sum_diagonals, count_diagonal_cells
 from pytadbit.mapping.restriction_enzymes import RESTRICTION_ENZYMES
 from pytadbit.parsers.genome_parser       import parse_fasta, get_gc_content
 from functools import reduce
@@ -76,7 +81,7 @@ def run(opts):
 
         # get genome sequence ~1 min
         printime('  - parsing FASTA')
-        genome = parse_fasta(opts.fasta, verbose=False)
+        genome = parse_fasta(opts.fasta, verbose=False, mapped=True)
 
         fas = set(genome.keys())
         bam = set(refs)
@@ -119,8 +124,8 @@ def run(opts):
         n_rsites  = []
         re_site = RESTRICTION_ENZYMES[opts.renz].replace('|', '')
         for crm in refs:
-            for pos in range(200, len(genome[crm]) + 200, opts.reso):
-                seq = genome[crm][pos-200:pos + opts.reso + 200]
+            for pos in range(200, genome.length(crm) + 200, opts.reso):
+                seq = genome.region(crm, pos - 200, pos + opts.reso + 200)
                 n_rsites.append(seq.count(re_site))
 
         ## CHECK TO BE REMOVED
@@ -140,7 +145,8 @@ def run(opts):
         p_fit=opts.p_fit, cg_content=gc_content, n_rsites=n_rsites,
         min_perc=opts.min_perc, max_perc=opts.max_perc, seed=opts.seed,
         normalize_only=opts.normalize_only, max_njobs=opts.max_njobs,
-        extra_bads=opts.badcols, biases_path=opts.biases_path)
+        extra_bads=opts.badcols, biases_path=opts.biases_path,
+        ice_engine=opts.ice_engine)
 
     inter_vs_gcoord = path.join(opts.workdir, '04_normalization',
                                 'interactions_vs_genomic-coords.png_%s_%s.png' % (
@@ -418,6 +424,15 @@ def populate_args(parser):
                         choices=['Vanilla', 'ICE', 'SQRT', 'oneD', 'custom'],
                         help='''[%(default)s] normalization(s) to apply.
                         Order matters. Choices: %(choices)s''')
+    normpt.add_argument('--ice_engine', dest='ice_engine', metavar="STR",
+                        action='store', default='python', type=str,
+                        choices=['python', 'sparse', 'chunked'],
+                        help='''[%(default)s] implementation of the ICE
+                        normalization. "sparse" is vectorized on a sparse
+                        matrix and uses much less memory. "chunked" never
+                        loads the full matrix, it streams over the
+                        memory-mapped chunks of the BAM at each iteration
+                        (bounded memory). Choices: %(choices)s''')
     normpt.add_argument('--biases_path', dest='biases_path', type=str,
                         default=None, help='''biases file to compute decay.
                         REQUIRED with "custom" normalization. Format: single
@@ -570,7 +585,8 @@ def nice(reso):
 ## TODO: This should be handled in the hic bam parser
 
 def read_bam_frag_valid(inbam, filter_exclude, all_bins, sections,
-                  resolution, outdir, extra_out,region, start, end):
+                  resolution, outdir, extra_out,region, start, end,
+                  save_arrays=False):
     bamfile = AlignmentFile(inbam, 'rb')
     refs = bamfile.references
     try:
@@ -612,6 +628,9 @@ def read_bam_frag_valid(inbam, filter_exclude, all_bins, sections,
                              'tmp_bins_%s:%d-%d_%s.pickle' % (region, start, end, extra_out)), 'wb')
         dump(cisprc, out, HIGHEST_PROTOCOL)
         out.close()
+        if save_arrays:
+            _save_chunk_arrays(dico, path.join(outdir, 'tmp_ice_%s:%d-%d_%s.npy' % (
+                region, start, end, extra_out)))
     except Exception as e:
         exc_type, exc_obj, exc_tb = exc_info()
         fname = path.split(exc_tb.tb_frame.f_code.co_filename)[1]
@@ -620,7 +639,8 @@ def read_bam_frag_valid(inbam, filter_exclude, all_bins, sections,
 
 
 def read_bam_frag_filter(inbam, filter_exclude, all_bins, sections,
-                         resolution, outdir, extra_out,region, start, end):
+                         resolution, outdir, extra_out,region, start, end,
+                         save_arrays=False):
     bamfile = AlignmentFile(inbam, 'rb')
     refs = bamfile.references
     try:
@@ -664,6 +684,9 @@ def read_bam_frag_filter(inbam, filter_exclude, all_bins, sections,
             region, start, end, extra_out)), 'wb')
         dump(cisprc, out, HIGHEST_PROTOCOL)
         out.close()
+        if save_arrays:
+            _save_chunk_arrays(dico, path.join(outdir, 'tmp_ice_%s:%d-%d_%s.npy' % (
+                region, start, end, extra_out)))
     except Exception as e:
         exc_type, exc_obj, exc_tb = exc_info()
         fname = path.split(exc_tb.tb_frame.f_code.co_filename)[1]
@@ -675,7 +698,8 @@ def read_bam(inbam, filter_exclude, resolution, min_count=2500, biases_path='',
              normalization='Vanilla', mappability=None, n_rsites=None,
              cg_content=None, sigma=2, ncpus=8, factor=1, outdir='.', seed=1,
              extra_out='', only_valid=False, normalize_only=False, p_fit=None,
-             max_njobs=100, min_perc=None, max_perc=None, extra_bads=None):
+             max_njobs=100, min_perc=None, max_perc=None, extra_bads=None,
+             ice_engine='python'):
     bamfile = AlignmentFile(inbam, 'rb')
     sections = OrderedDict(list(zip(bamfile.references,
                                [x // resolution + 1 for x in bamfile.lengths])))
@@ -729,11 +753,13 @@ def read_bam(inbam, filter_exclude, resolution, min_count=2500, biases_path='',
     pool = mu.Pool(ncpus)
     procs = []
     read_bam_frag = read_bam_frag_valid if only_valid else read_bam_frag_filter
+    # out-of-core ICE needs the interactions of each chunk as numpy arrays
+    save_arrays = normalization == 'ICE' and ice_engine == 'chunked'
     for i, (region, start, end) in enumerate(zip(regs, begs, ends)):
         procs.append(pool.apply_async(
             read_bam_frag, args=(inbam, filter_exclude, bins, bins_dict,
                                  resolution, outdir, extra_out,
-                                 region, start, end,)))
+                                 region, start, end, save_arrays)))
     pool.close()
     print_progress(procs)
     pool.join()
@@ -802,13 +828,23 @@ def read_bam(inbam, filter_exclude, resolution, min_count=2500, biases_path='',
     biases = [float('nan') if k in badcol else cisprc.get(k, [0, 1.])[1]
               for k in range(size)]
 
-    if normalization == 'ICE':
+    if normalization == 'ICE' and ice_engine == 'chunked':
+        printime('  - ICE normalization (out-of-core, %d chunks)' % (len(regs)))
+        fnames = [path.join(outdir, 'tmp_ice_%s:%d-%d_%s.npy' % (
+            region, start, end, extra_out))
+                  for region, start, end in zip(regs, begs, ends)]
+        biases = ice_chunked(fnames, size, badcol, ncpus=ncpus, outdir=outdir,
+                             extra_out=extra_out, iterations=100,
+                             max_dev=0.000001)
+    elif normalization == 'ICE':
         printime('  - ICE normalization')
         hic_data = load_hic_data_from_bam(
             inbam, resolution, filter_exclude=filter_exclude,
-            tmpdir=outdir, ncpus=ncpus)
+            tmpdir=outdir, ncpus=ncpus,
+            storage='array' if ice_engine == 'sparse' else 'dict')
         hic_data.bads = badcol
-        hic_data.normalize_hic(iterations=100, max_dev=0.000001)
+        hic_data.normalize_hic(iterations=100, max_dev=0.000001,
+                               engine=ice_engine)
         biases = hic_data.bias.copy()
         del(hic_data)
     elif normalization == 'Vanilla':
@@ -910,13 +946,19 @@ def read_bam(inbam, filter_exclude, resolution, min_count=2500, biases_path='',
     # normalize decay by size of the diagonal, and by Vanilla correction
     # (all cells must still be equals to 1 in average)
 
+    nbins = len(bins)
+    bias_array = fromiter((biases.get(b, float('nan')) for b in range(nbins)),
+                          dtype=float64, count=nbins)
+    bad_mask = zeros(nbins, dtype=bool)
+    bad_mask[[b for b in badcol if b < nbins]] = True
     pool = mu.Pool(ncpus)
     procs = []
     for i, (region, start, end) in enumerate(zip(regs, begs, ends)):
         fname = path.join(outdir,
                           'tmp_%s:%d-%d_%s.pickle' % (region, start, end, extra_out))
         procs.append(pool.apply_async(sum_dec_matrix,
-                                      args=(fname, biases, badcol, bins)))
+                                      args=(fname, bias_array, bad_mask,
+                                            section_pos)))
     pool.close()
     print_progress(procs)
     pool.join()
@@ -939,32 +981,8 @@ def read_bam(inbam, filter_exclude, resolution, min_count=2500, biases_path='',
                         nrmdec[c] = {k: v}
                         rawdec[c] = {k: tmpraw[c][k]}
     # count the number of cells per diagonal
-    # TODO: parallelize
-    # find largest chromosome
-    len_crms = dict((c, section_pos[c][1] - section_pos[c][0]) for c in section_pos)
-    # initialize dictionary
-    ndiags = dict((c, dict((k, 0) for k in range(len_crms[c]))) for c in sections)
-    for crm in section_pos:
-        beg_chr, end_chr = section_pos[crm][0], section_pos[crm][1]
-        chr_size = end_chr - beg_chr
-        thesebads = [b for b in badcol if beg_chr <= b <= end_chr]
-        for dist in range(1, chr_size):
-            ndiags[crm][dist] += chr_size - dist
-            # from this we remove bad columns
-            # bad columns will only affect if they are at least as distant from
-            # a border as the distance between the longest diagonal and the
-            # current diagonal.
-            bad_diag = set()  # 2 bad rows can point to the same bad cell in diagonal
-            maxp = end_chr - dist
-            minp = beg_chr + dist
-            for b in thesebads:
-                if b < maxp:  # not inclusive!!
-                    bad_diag.add(b)
-                if b >= minp:
-                    bad_diag.add(b - dist)
-            ndiags[crm][dist] -= len(bad_diag)
-        # different behavior for longest diagonal:
-        ndiags[crm][0] += chr_size - sum(beg_chr <= b < end_chr for b in thesebads)
+    ndiags = dict((c, dict(enumerate(n.tolist()))) for c, n in
+                  count_diagonal_cells(section_pos, bad_mask).items())
 
     # normalize sum per diagonal by total number of cells in diagonal
     signal_to_noise = 0.05
@@ -1009,31 +1027,97 @@ def read_bam(inbam, filter_exclude, resolution, min_count=2500, biases_path='',
     return biases, nrmdec, badcol, raw_cisprc, norm_cisprc
 
 
-def sum_dec_matrix(fname, biases, badcol, bins):
+def _save_chunk_arrays(dico, fname):
+    """
+    Save the interactions of a chunk as a numpy array of (row, column, count)
+    that can be memory-mapped.
+    """
+    mat = empty(len(dico), dtype=[('i', int32), ('j', int32), ('v', int32)])
+    mat['i'] = fromiter((i for i, _ in dico), dtype=int32, count=len(dico))
+    mat['j'] = fromiter((j for _, j in dico), dtype=int32, count=len(dico))
+    mat['v'] = fromiter(dico.values(), dtype=int32, count=len(dico))
+    npsave(fname, mat)
+
+
+def _ice_dot_chunk(fname, vect_fname):
+    """
+    Product of the sub-matrix of a chunk by a vector, restricted to the rows
+    of the chunk.
+
+    :returns: the index of the first row, and the partial result
+    """
+    mat  = npload(fname, mmap_mode='r')
+    if not len(mat):
+        return 0, zeros(0)
+    vect = npload(vect_fname, mmap_mode='r')
+    rows = mat['i']
+    beg  = rows.min()
+    return beg, bincount(rows - beg, weights=mat['v'] * vect[mat['j']])
+
+
+def ice_chunked(fnames, size, badcol, ncpus=8, outdir='.', extra_out='',
+                iterations=100, max_dev=0.000001, verbose=True):
+    """
+    Out-of-core ICE normalization. The matrix is never loaded in memory, each
+    iteration computes the row sums by streaming over the memory-mapped
+    arrays of each chunk, in parallel.
+
+    :param fnames: list of paths to the numpy files with the interactions of
+       each chunk (as written by _save_chunk_arrays)
+    :param size: size of the genomic matrix
+    :param badcol: dictionary of bad columns
+    :param 8 ncpus: number of processes
+
+    :returns: dictionary of biases
+    """
+    pool = mu.Pool(ncpus)
+    npass = [0]
+
+    def dot(vect):
+        # the vector is shared with the workers through a memory-mapped file
+        vect_fname = path.join(outdir, 'tmp_ice_vector_%s_%d.npy' % (
+            extra_out, npass[0]))
+        npsave(vect_fname, vect)
+        procs = [pool.apply_async(_ice_dot_chunk, args=(fname, vect_fname))
+                 for fname in fnames]
+        result = zeros(size)
+        for proc in procs:
+            beg, partial = proc.get()
+            result[beg:beg + len(partial)] += partial
+        remove(vect_fname)
+        npass[0] += 1
+        return result
+
+    try:
+        biases = iterative_dot(dot, size, bads=badcol, iterations=iterations,
+                               max_dev=max_dev, verbose=verbose)
+    finally:
+        pool.close()
+        pool.join()
+        for fname in fnames:
+            system('rm -f %s' % (fname))
+    return biases
+
+
+def sum_dec_matrix(fname, bias_array, bad_mask, section_pos):
     dico = load(open(fname,'rb'))
+    ncells = len(dico)
+    rows = fromiter((i for i, _ in dico), dtype=int64, count=ncells)
+    cols = fromiter((j for _, j in dico), dtype=int64, count=ncells)
+    values = fromiter(dico.values(), dtype=float64, count=ncells)
+    del dico
+    # lower triangle of each chromosome
+    nrmsums, counts = sum_diagonals(cols, rows, values, section_pos,
+                                    bads=bad_mask, bias=bias_array)
+    rawsums, _ = sum_diagonals(cols, rows, values, section_pos, bads=bad_mask)
     rawdec = {}
     nrmdec = {}
-    for (i, j), v in dico.items():
-        if i < j:
+    for c in counts:
+        found = flatnonzero(counts[c])
+        if not len(found):
             continue
-        # different chromosome
-        c = bins[i][0]
-        if c != bins[j][0]:
-            continue
-        if i in badcol or j in badcol:
-            continue
-        k = i - j
-        val = v / biases[i] / biases[j]
-        try:
-            nrmdec[c][k] += val
-            rawdec[c][k] += v
-        except KeyError:
-            try:
-                nrmdec[c][k] = val
-                rawdec[c][k] = v
-            except KeyError:
-                nrmdec[c] = {k: val}
-                rawdec[c] = {k: v}
+        nrmdec[c] = dict(zip(found.tolist(), nrmsums[c][found].tolist()))
+        rawdec[c] = dict(zip(found.tolist(), rawsums[c][found].tolist()))
     system('rm -f %s' % (fname))
     return nrmdec, rawdec
 
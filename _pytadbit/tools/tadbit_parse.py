@@ -17,6 +17,7 @@ from argparse                       import HelpFormatter
 from pickle                         import load, UnpicklingError
 from warnings                       import warn
 from functools                      import reduce
+from multiprocessing                import cpu_count
 
 import time
 import logging
@@ -55,7 +56,7 @@ def run(opts):
 
     name = path.split(opts.workdir)[-1]
 
-    param_hash = digest_parameters(opts)
+    param_hash = digest_parameters(opts, extra=['cpus'])
 
     outdir = '02_parsed_reads'
 
@@ -79,18 +80,25 @@ def run(opts):
         # allows the use of pickle genome to make it faster
         genome = load(open(opts.genome[0],'rb'))
     except (UnpicklingError, KeyError):
-        genome = parse_fasta(opts.genome, chr_regexp=opts.filter_chrom)
+        genome = parse_fasta(opts.genome, chr_regexp=opts.filter_chrom,
+                             mapped=True)
 
     if not opts.skip:
         logging.info('parsing reads in %s project', name)
+        # RE sites are cached next to the genome, as the parsed genome itself
+        re_cache = path.dirname(path.abspath(opts.genome[0]))
         if opts.mapped1 or opts.mapped2:
             counts, multis = parse_sam(f_names1, f_names2, out_file1=out_file1,
                                        out_file2=out_file2, re_name=renz, verbose=True,
-                                       genome_seq=genome, compress=opts.compress_input)
+                                       genome_seq=genome, compress=opts.compress_input,
+                                       ncpus=opts.cpus, re_cache=re_cache,
+                                       genome_path=opts.genome)
         else:
             counts, multis = parse_map(f_names1, f_names2, out_file1=out_file1,
                                        out_file2=out_file2, re_name=renz, verbose=True,
-                                       genome_seq=genome, compress=opts.compress_input)
+                                       genome_seq=genome, compress=opts.compress_input,
+                                       ncpus=opts.cpus, re_cache=re_cache,
+                                       genome_path=opts.genome)
     else:
         counts = {}
         counts[0] = {}
@@ -201,8 +209,8 @@ def save_to_db(opts, counts, multis, f_names1, f_names2, out_file1, out_file2,
                 Parameters_md5 text,
                 unique (Parameters_md5))""")
         try:
-            parameters = digest_parameters(opts, get_md5=False)
-            param_hash = digest_parameters(opts, get_md5=True )
+            parameters = digest_parameters(opts, get_md5=False, extra=['cpus'])
+            param_hash = digest_parameters(opts, get_md5=True , extra=['cpus'])
             cur.execute("""
     insert into JOBs
      (Id  , Parameters, Launch_time, Finish_time,    Type, Parameters_md5)
@@ -376,6 +384,12 @@ def populate_args(parser):
                         help='''if provided uses this directory to manipulate the
                         database''')
 
+    glopts.add_argument("-C", "--cpus", dest="cpus", type=int,
+                        default=cpu_count(), help='''[%(default)s] Maximum
+                        number of CPU cores  available in the execution host.
+                        Used to sort temporary files of parsed reads in
+                        parallel''')
+
     glopts.add_argument('--genome', dest='genome', metavar="PATH", nargs='+',
                         type=str,
                         help='''paths to file(s) with FASTA files of the
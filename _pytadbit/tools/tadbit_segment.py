@@ -10,12 +10,13 @@ from future import standard_library
 standard_library.install_aliases()
 from argparse                       import HelpFormatter
 from os                             import path, remove
+from collections                    import OrderedDict
 from shutil                         import copyfile
 from string                         import ascii_letters
 from random                         import random
 from warnings                       import warn
 from pickle                        import load
-from multiprocessing                import cpu_count
+from multiprocessing                import cpu_count, Pool
 from traceback                      import print_exc
 import sqlite3 as lite
 import time
@@ -82,7 +83,8 @@ def run(opts):
         mkdir(cmprt_dir)
         if opts.fasta:
             print('  - Computing GC content to label compartments')
-            rich_in_A = get_gc_content(parse_fasta(opts.fasta, chr_filter=opts.crms), reso,
+            rich_in_A = get_gc_content(parse_fasta(opts.fasta, chr_filter=opts.crms,
+                                                   mapped=True), reso,
                                        chromosomes=opts.crms,
                                        by_chrom=True, n_cpus=opts.cpus)
         elif opts.rich_in_A:
@@ -94,7 +96,7 @@ def run(opts):
             crms=opts.crms, savefig=cmprt_dir, verbose=True, suffix=param_hash,
             rich_in_A=rich_in_A, show_compartment_labels=rich_in_A is not None,
             savecorr=cmprt_dir if opts.savecorr else None,
-            max_ev=n_evs,
+            max_ev=n_evs, n_cpus=opts.cpus,
             ev_index=opts.ev_index,
             vmin=None if opts.fix_corr_scale else 'auto',
             vmax=None if opts.fix_corr_scale else 'auto')
@@ -139,16 +141,28 @@ def run(opts):
         tad_dir = path.join(opts.workdir, '06_segmentation',
                              'tads_%s' % (nice(reso)))
         mkdir(tad_dir)
+        jobs = []
         for crm in hic_data.chromosomes:
             if opts.crms and not crm in opts.crms:
                 continue
-            print('  - %s' % crm)
-            matrix = hic_data.get_matrix(focus=crm)
             beg, end = hic_data.section_pos[crm]
-            size = len(matrix)
-            if size < 10:
-                print("     Chromosome too short (%d bins), skipping..." % size)
+            if end - beg < 10:
+                print("  - %s too short (%d bins), skipping..." % (crm, end - beg))
                 continue
+            jobs.append(crm)
+        # largest chromosomes first, the small ones fill the remaining CPUs
+        jobs.sort(key=lambda crm: hic_data.section_pos[crm][0] -
+                  hic_data.section_pos[crm][1])
+        # one process per chromosome, the CPUs left being shared among them;
+        # the matrix of each chromosome is only built by the worker using it
+        nprocs = max(1, min(opts.cpus, len(jobs)))
+        pool = Pool(nprocs, initializer=_init_segment_worker,
+                    initargs=(hic_data, ))
+        tasks = []
+        results = {}
+        for crm in jobs:
+            beg, end = hic_data.section_pos[crm]
+            size = end - beg
             # transform bad column in chromosome referential
             if hic_data.bads:
                 to_rm = tuple([1 if i in hic_data.bads else 0 for i in range(beg, end)])
@@ -156,19 +170,28 @@ def run(opts):
                 to_rm = None
             # maximum size of a TAD
             max_tad_size = (size - 1) if opts.max_tad_size is None else opts.max_tad_size
-            result = tadbit([matrix], remove=to_rm,
-                            n_cpus=opts.cpus, verbose=opts.verbose,
-                            max_tad_size=max_tad_size,
-                            no_heuristic=False)
-
-            # use normalization to compute height on TADs called
-            if opts.all_bins:
-                if opts.nosql:
-                    biases = load(open(biases, 'rb'))
-                else:
-                    biases = load(open(path.join(opts.workdir, biases), 'rb'))
-                hic_data.bads = biases['badcol']
-                hic_data.bias = biases['biases']
+            tasks.append((crm, {'remove': to_rm,
+                                'n_cpus': max(1, opts.cpus // nprocs),
+                                'verbose': opts.verbose,
+                                'max_tad_size': max_tad_size,
+                                'no_heuristic': False}))
+        procs = pool.imap_unordered(_segment_chromosome, tasks)
+        pool.close()
+
+        # use normalization to compute height on TADs called
+        if opts.all_bins and jobs:
+            if opts.nosql:
+                biases = load(open(biases, 'rb'))
+            else:
+                biases = load(open(path.join(opts.workdir, biases), 'rb'))
+            hic_data.bads = biases['badcol']
+            hic_data.bias = biases['biases']
+
+        # write the TADs of each chromosome as soon as they are found
+        for crm, result in procs:
+            print('  - %s' % crm)
+            beg, end = hic_data.section_pos[crm]
+            size = end - beg
             tads = load_tad_height(result, size, beg, end, hic_data)
             table = ''
             table += '%s\t%s\t%s\t%s\t%s\n' % ('#', 'start', 'end', 'score', 'density')
@@ -181,8 +204,12 @@ def run(opts):
             out = open(out_tad, 'w')
             out.write(table)
             out.close()
-            tad_result[crm] = {'path' : out_tad,
-                               'num': len(tads)}
+            results[crm] = {'path' : out_tad,
+                            'num': len(tads)}
+        pool.join()
+        # keep the chromosome order for the database
+        tad_result = OrderedDict((crm, results[crm]) for crm in hic_data.chromosomes
+                                 if crm in results)
 
     finish_time = time.localtime()
 
@@ -599,6 +626,29 @@ def check_options(opts):
         exit('WARNING: exact same job already computed, see JOBs table above')
 
 
+_WORKER_DATA = {}
+
+
+def _init_segment_worker(hic_data):
+    """
+    Initializer of the worker processes calling TADs: keeps the Hi-C data,
+    shared with the parent process, to extract the matrix of each chromosome.
+    """
+    _WORKER_DATA['hic_data'] = hic_data
+
+
+def _segment_chromosome(args):
+    """
+    Calls the TADs of one chromosome, building its matrix only here, and
+    releasing it once done.
+    """
+    crm, kwargs = args
+    matrix = _WORKER_DATA['hic_data'].get_matrix(focus=crm)
+    result = tadbit([matrix], **kwargs)
+    del matrix
+    return crm, result
+
+
 def nice(reso):
     if reso >= 1000000:
         return '%dMb' % (reso / 1000000)
@@ -1,207 +1,256 @@
+"""
+Hidden Markov models with gaussian emissions, used to refine compartments.
+
+Emission probabilities are computed in log space and rescaled at each
+position before the forward/backward recursions (themselves scaled at each
+position), so that observations far from all the states do not underflow.
+The training processes all the observation sequences (e.g. one per
+chromosome) at once, as arrays of shape (positions, sequences, states).
+"""
 from __future__ import print_function
-from numpy import log, pi as pi_num, exp
 import sys
 
+from numpy import log, exp, pi as pi_num, asarray, zeros, empty
+from numpy import arange, argmax, dot, einsum, errstate, int64, float64
+
+
 def best_path(probs, pi, T):
     """
     Viterbi algorithm with backpointers
-    """
-    n = len(T)
-    m = len(probs[0])
-    log_V     = [[0. for _ in range(m)] for _ in range(n)]
-    backpt    = [[0  for _ in range(m)] for _ in range(n)]
-    states    =  [0  for _ in range(m)]
-    log_pi    =  [float('-inf') if pi[i] < 0. else log(pi[i]) for i in range(len(pi))]
-    log_T     =  [float('-inf') if T [i] < 0. else log(T[i]) for i in range(len(T))]
-    log_probs = [[float('-inf') if probs[i][j] < 0. else log(probs[i][j])
-                  for j in range(m)]
-                 for i in range(n)]
-    for i in range(n):
-        log_V[i][0] = log_probs[i][0] + log_pi[i]
-    for k in range(1, m):
-        for stat in range(n):
-            log_V[stat][k] = float('-inf')
-            for prev in range(n):
-                # original state prob times transition prob
-                prob = log_V[prev][k-1] + log_T[prev][stat]
-                if prob > log_V[stat][k]:
-                    log_V[stat][k] = prob
-                    backpt[stat][k-1] = prev
-            log_V[stat][k] += log_probs[stat][k]
-    # get the likelihood of the most probable path
-    prob = log_V[0][-1]
-    for i in range(1, n):
-        if log_V[i][-1] > prob:
-            prob = log_V[i][-1]
-            states[-1] = i
-    # Follow the backtrack: get the path which maximize the path prob.
-    for i in range(m - 2, -1, -1):
-        states[i] = backpt[states[i + 1]][i]
-    return states, prob
 
-def baum_welch_optimization(xh, T, E, new_pi, new_T, corrector,
-                            new_E, etas, gammas):
-    """
-    implementation of the baum-welch algorithm
+    :param probs: emission probabilities, one row per state (see
+       :func:`gaussian_prob`)
+    :param pi: initial probabilities of each state
+    :param T: transition probabilities, one row per state
+
+    :returns: the list of most probable states and the log likelihood of
+       this path
     """
-    n = len(T)
-    m = len(gammas[0])
-    for i in range(n):
-        for j in range(n):
-            new_pi[i] += etas[i][j][0]
-    for i in range(n):
-        for j in range(n):
-            new_T[i][j] += sum(etas[i][j][k] for k in range(m - 1))
+    with errstate(divide='ignore'):
+        log_probs = log(asarray(probs, dtype=float64)).T
+    return log_best_path(log_probs, pi, T)
 
-    for k in range(m):
-        for i in range(n):
-            gik = gammas[i][k]
-            corrector[i] += gik
-            new_E[i][0] += gik * xh[k]
-            new_E[i][1] += gik * (xh[k] - E[i][0])**2
 
-def update_parameters(corrector, pi, new_pi, T, new_T, E, new_E):
-    """
-    final round of the baum-welch
+def log_best_path(log_probs, pi, T):
     """
-    ### update initial probabilities
-    n = len(T)
-    total = 0.
-    delta = 0.
-    for i in range(n):
-        total += new_pi[i]
-    for i in range(n):
-        new_pi[i] /= total
-        delta = max(delta, abs(new_pi[i] - pi[i]))
-        pi[i] = new_pi[i]
-    ### update transitions
-    for i in range(n):
-        total = 0.
-        for j in range(n):
-            total += new_T[i][j]
-        for j in range(n):
-            new_T[i][j] /= total
-            delta = max(delta, abs(new_T[i][j] - T[i][j]))
-            T[i][j] = new_T[i][j]
-    ### update emissions
-    for i in range(n):
-        # update the means
-        if corrector[i] > 0.:
-            new_E[i][0] /= corrector[i]
-            new_E[i][1] /= corrector[i]
-            # corrector[i] = 1.
-            delta = max(delta, abs(new_E[i][0] - E[i][0]))
-            E[i][0] = new_E[i][0]
-            # update the stdevs
-            delta = max(delta, abs(new_E[i][1] - E[i][1]))
-            E[i][1] = new_E[i][1]
-    return delta
+    Viterbi algorithm with backpointers, from emission probabilities given
+    in log space, that do not underflow for observations far from all the
+    states
 
-def train(pi, T, E, observations, verbose=False, threshold=1e-6, n_iter=1000):
-    delta = float('inf')
-    for it in range(n_iter):
-        # reset for new iteration
-        new_pi = [0. for _ in pi]
-        new_T  = [[0. for _ in i] for i in T]
-        new_E  = [[0. for _ in i] for i in E]
-        corrector = [0. for _ in range(len(T))]
-        for h in range(len(observations)):
-            probs  = gaussian_prob(observations[h], E)
-            alphas, scalars = get_alpha(probs, pi, T)
-            betas  = get_beta(probs, T, scalars)
-            etas   = get_eta(probs, T, alphas, betas)
-            gammas = get_gamma(T, alphas, betas)
-            baum_welch_optimization(observations[h], T, E, new_pi, new_T, corrector,
-                                    new_E, etas, gammas)
-        delta = update_parameters(corrector, pi, new_pi, T, new_T, E, new_E)
-        if verbose:
-            print("\rTraining: %03i/%04i (diff: %.8f)" % (it, n_iter, delta), end=' ')
-            sys.stdout.flush()
-        if delta <= threshold:
-            break
-    if verbose:
-        print("\n")
+    :param log_probs: log of the emission probabilities, one row per
+       position (see :func:`log_gaussian_prob`)
+    :param pi: initial probabilities of each state
+    :param T: transition probabilities, one row per state
 
-def get_eta(probs, T, alphas, betas):
+    :returns: the list of most probable states and the log likelihood of
+       this path
     """
-    for Baum-Welch: probability of being in states i and j at times t and t+1
-    """
-    n = len(T)
-    m = len(probs[0])
-    etas = [[[0.  for _ in range(m - 1)] for _ in range(n)] for _ in range(n)]
-    for k in range(m - 1):
-        tot = 0.
-        for i in range(n):
-            for j in range(n):
-                etas[i][j][k] += alphas[i][k] * T[i][j] * probs[j][k+1] * betas[j][k+1]
-                tot += etas[i][j][k]
-        for i in range(n):
-            for j in range(n):
-                etas[i][j][k] /= tot
-    return etas
+    log_probs = asarray(log_probs, dtype=float64)
+    with errstate(divide='ignore'):
+        log_pi    = log(asarray(pi   , dtype=float64))
+        log_T     = log(asarray(T    , dtype=float64))
+    m, n = log_probs.shape
+    states = arange(n)
+    backpt = zeros((m, n), dtype=int64)
+    log_V  = log_probs[0] + log_pi
+    for k in range(1, m):
+        # original state prob times transition prob, best previous state
+        prob = log_V[:, None] + log_T
+        prev = argmax(prob, axis=0)
+        backpt[k] = prev
+        log_V = prob[prev, states] + log_probs[k]
+    # Follow the backtrack: get the path which maximize the path prob.
+    path = empty(m, dtype=int64)
+    path[-1] = argmax(log_V)
+    for k in range(m - 1, 0, -1):
+        path[k - 1] = backpt[k, path[k]]
+    return path.tolist(), float(log_V[path[-1]])
 
-def get_gamma(T, alphas, betas):
+
+def log_gaussian_prob(x, E):
     """
-    for Baum-Welch: probability of being in state i at time t
+    log probability of x to follow the gaussian with given E
+    https://en.wikipedia.org/wiki/Normal_distribution
+
+    :param x: array of observations (of any shape)
+    :param E: mean and variance of each state
+
+    :returns: an array with the shape of x plus one last dimension for the
+       states
     """
-    n = len(T)
-    m = len(alphas[0])
-    return [[alphas[i][k] * betas[i][k]  for k in range(m)] for i in range(n)]
+    E = asarray(E, dtype=float64)
+    x = asarray(x, dtype=float64)[..., None]
+    return -0.5 * log(2. * pi_num * E[:, 1]) - (x - E[:, 0])**2 / (2. * E[:, 1])
+
 
 def gaussian_prob(x, E):
     """
     of x to follow the gaussian with given E
     https://en.wikipedia.org/wiki/Normal_distribution
+
+    :returns: an array of probabilities, one row per state
     """
-    probs = []
-    for d, (mu, sd) in enumerate(E):
-        pi2sd = (2. * pi_num * sd)**-0.5
-        inv2sd = 1. / (2. * sd)
-        probs.append([])
-        for obs in x:
-            p = pi2sd * exp(-(obs - mu)**2 * inv2sd)
-            probs[d].append(p)
-    return probs
+    return exp(log_gaussian_prob(x, E)).T
+
 
 def get_alpha(probs, pi, T):
     """
     computes alphas using forward algorithm
-    """
-    n = len(T)
-    m = len(probs[0])
-    alphas = [[0. for _ in range(m)] for _ in range(n)]
-    scalars = [0. for _ in range(m)]
 
+    :param probs: (rescaled) emission probabilities, of shape (positions,
+       sequences, states)
+
+    :returns: alphas, normalized at each position, and the scalars used for
+       this normalization (shape (positions, sequences))
+    """
+    m = len(probs)
+    alphas  = empty(probs.shape)
+    scalars = empty(probs.shape[:-1])
     # initialize alpha for each state
-    for i in range(n):
-        alphas[i][0] = pi[i] * probs[i][0]
-        scalars[0] += alphas[i][0]
-    for i in range(n):
-        alphas[i][0] /= scalars[0]
-    for k in range(1, m):
-        for i in range(n):
-            for j in range(n):
-                # all transition probabilities to become "i" times previous alpha
-                alphas[i][k] += alphas[j][k-1] * T[j][i]
-            # times probablity to belong to this states
-            alphas[i][k] *= probs[i][k]
-            scalars[k] += alphas[i][k]
-        for i in range(n):
-            alphas[i][k] /= scalars[k]
+    alpha = probs[0] * pi
+    for k in range(m):
+        if k:
+            # all transition probabilities to become "i" times previous alpha,
+            # times probability to belong to this states
+            alpha = dot(alphas[k - 1], T) * probs[k]
+        scalars[k] = alpha.sum(axis=-1)
+        alphas[k] = alpha / scalars[k][..., None]
     return alphas, scalars
 
+
 def get_beta(probs, T, scalars):
     """
     computes betas using backward algorithm
+
+    :param probs: (rescaled) emission probabilities, of shape (positions,
+       sequences, states)
+    :param scalars: as returned by :func:`get_alpha`
     """
-    n = len(T)
-    m = len(probs[0])
-    # intialize beta at 1.0
-    betas = [[0. for _ in range(m - 1)] + [1.0] for _ in range(n)]
-    for k in range(-2, -m - 1, -1):
-        for i in range(n):
-            for j in range(n):
-                betas[i][k] += betas[j][k + 1] * probs[j][k + 1] * T[i][j]
-            betas[i][k] /= scalars[k + 1]
+    m = len(probs)
+    # initialize beta at 1.0
+    betas = empty(probs.shape)
+    betas[-1] = 1.
+    for k in range(m - 2, -1, -1):
+        betas[k] = (dot(betas[k + 1] * probs[k + 1], T.T) /
+                    scalars[k + 1][..., None])
     return betas
 
+
+def get_gamma(T, alphas, betas):
+    """
+    for Baum-Welch: probability of being in state i at time t
+    """
+    return alphas * betas
+
+
+def get_eta(probs, T, alphas, betas, scalars, mask):
+    """
+    for Baum-Welch: probability of being in states i and j at times t and t+1,
+    summed over all the (unmasked) positions t
+    """
+    nexts = betas[1:] * probs[1:] / scalars[1:][..., None]
+    return T * einsum('ksi,ksj->ij', alphas[:-1] * mask[1:][..., None], nexts)
+
+
+def baum_welch_optimization(x, E, gammas, etas, new_pi, new_T, corrector,
+                            new_E):
+    """
+    implementation of the baum-welch algorithm, accumulating the new
+    parameters
+
+    :param x: observations of shape (positions, sequences)
+    :param gammas: as returned by :func:`get_gamma`, masked
+    :param etas: as returned by :func:`get_eta`
+    """
+    new_pi += gammas[0].sum(axis=0)
+    new_T  += etas
+    corrector += gammas.sum(axis=(0, 1))
+    new_E[:, 0] += einsum('ks,ksi->i', x, gammas)
+    new_E[:, 1] += einsum('ksi,ksi->i', (x[..., None] - E[:, 0])**2, gammas)
+
+
+def update_parameters(corrector, pi, new_pi, T, new_T, E, new_E):
+    """
+    final round of the baum-welch
+    """
+    ### update initial probabilities
+    new_pi /= new_pi.sum()
+    delta = abs(new_pi - pi).max()
+    pi[:] = new_pi
+    ### update transitions
+    new_T /= new_T.sum(axis=1)[:, None]
+    delta = max(delta, abs(new_T - T).max())
+    T[:] = new_T
+    ### update emissions (means and variances)
+    seen = corrector > 0.
+    if seen.any():
+        new_E = new_E[seen] / corrector[seen][:, None]
+        delta = max(delta, abs(new_E - E[seen]).max())
+        E[seen] = new_E
+    return delta
+
+
+def _rescaled_emissions(x, E, mask):
+    """
+    emission probabilities divided by their maximum at each position, 1 for
+    all states outside the sequences
+    """
+    log_probs = log_gaussian_prob(x, E)
+    log_probs -= log_probs.max(axis=-1)[..., None]
+    probs = exp(log_probs)
+    probs[~mask] = 1.
+    return probs
+
+
+def train(pi, T, E, observations, verbose=False, threshold=1e-6, n_iter=1000):
+    """
+    Baum-Welch training of the HMM, the parameters are updated in place.
+
+    :param pi: initial probabilities of each state
+    :param T: transition probabilities, one row per state
+    :param E: mean and variance of the gaussian emission of each state
+    :param observations: list of sequences of observations
+    :param False verbose:
+    :param 1e-6 threshold: stop when parameters do not change more than this
+    :param 1000 n_iter: maximum number of iterations
+    """
+    # observations as one array of (positions, sequences), shorter
+    # sequences being padded
+    m = max(len(obs) for obs in observations)
+    x    = zeros((m, len(observations)))
+    mask = zeros((m, len(observations)), dtype=bool)
+    for h, obs in enumerate(observations):
+        x   [:len(obs), h] = obs
+        mask[:len(obs), h] = True
+    arr_pi = asarray(pi, dtype=float64).copy()
+    arr_T  = asarray(T , dtype=float64).copy()
+    arr_E  = asarray(E , dtype=float64).copy()
+    for it in range(n_iter):
+        # reset for new iteration
+        new_pi = zeros(arr_pi.shape)
+        new_T  = zeros(arr_T.shape)
+        new_E  = zeros(arr_E.shape)
+        corrector = zeros(len(arr_T))
+        probs  = _rescaled_emissions(x, arr_E, mask)
+        alphas, scalars = get_alpha(probs, arr_pi, arr_T)
+        betas  = get_beta(probs, arr_T, scalars)
+        etas   = get_eta(probs, arr_T, alphas, betas, scalars, mask)
+        gammas = get_gamma(arr_T, alphas, betas) * mask[..., None]
+        baum_welch_optimization(x, arr_E, gammas, etas, new_pi, new_T,
+                                corrector, new_E)
+        delta = update_parameters(corrector, arr_pi, new_pi, arr_T, new_T,
+                                  arr_E, new_E)
+        if verbose:
+            print("\rTraining: %03i/%04i (diff: %.8f)" % (it, n_iter, delta), end=' ')
+            sys.stdout.flush()
+        if delta <= threshold:
+            break
+    if verbose:
+        print("\n")
+    # parameters updated in place
+    for i in range(len(arr_T)):
+        pi[i] = float(arr_pi[i])
+        for j in range(len(arr_T)):
+            T[i][j] = float(arr_T[i][j])
+        for j in range(2):
+            E[i][j] = float(arr_E[i][j])
@@ -68,7 +68,10 @@ from __future__ import print_function
 from subprocess import Popen, PIPE
 from os import path
 
-from numpy import genfromtxt
+from numpy import genfromtxt, ones, zeros, where, arange, array, asarray
+from numpy import concatenate, cumsum, searchsorted, bincount, flatnonzero
+from numpy import int64, float64
+from scipy.sparse import csr_matrix
 
 from pytadbit.utils.file_handling import which
 
@@ -231,20 +234,211 @@ def iterative(hic_data, bads=None, iterations=0, max_dev=0.00001,
     return B
 
 
-def expected(hic_data, bads=None, signal_to_noise=0.05, inter_chrom=False, **kwargs):
+def iterative_sparse(hic_data, bads=None, iterations=0, max_dev=0.00001,
+                     verbose=False, **kwargs):
+    """
+    Implementation of iterative correction Imakaev 2012, vectorized on the
+    sparse (CSR) representation of the matrix.
+
+    Same algorithm as :func:`iterative`, but the matrix is not copied nor
+    updated at each iteration: the corrected row sums are computed as
+    sparse matrix-vector products using the cumulated biases.
+
+    :param hic_data: HiC_data object containing the interaction data
+    :param None bads: dictionary with column not to be considered
+    :param 0 iterations: number of iterations to do (99 if a fully smoothed
+       matrix with no visibility differences between columns is desired)
+    :param 0.00001 max_dev: maximum difference allowed between a row and the
+       mean value of all raws
+    :returns: a vector of biases (length equal to the size of the matrix)
+    """
+    if verbose:
+        print('iterative correction (sparse)')
+    size = len(hic_data)
+    if verbose:
+        print("  - getting sparse matrix")
+    W = hic_data.get_hic_data_as_csr()
+    mask = ones(size)
+    if bads:
+        mask[list(bads)] = 0.
+    # rows having at least one interaction with a valid column
+    present = csr_matrix((ones(len(W.data)), W.indices, W.indptr),
+                         shape=W.shape).dot(mask) > 0
+    return iterative_dot(W.dot, size, bads=bads, iterations=iterations,
+                         max_dev=max_dev, verbose=verbose, present=present)
+
+
+def iterative_dot(dot, size, bads=None, iterations=0, max_dev=0.00001,
+                  verbose=False, present=None):
+    """
+    Implementation of iterative correction Imakaev 2012, where the matrix is
+    only accessed through its product with a vector. Used by
+    :func:`iterative_sparse`, and to normalize matrices that do not fit in
+    memory.
+
+    :param dot: function returning the product of the (symmetric) matrix by
+       a vector of length size, as a numpy array
+    :param size: size of the matrix
+    :param None bads: dictionary with column not to be considered
+    :param 0 iterations: number of iterations to do
+    :param 0.00001 max_dev: maximum difference allowed between a row and the
+       mean value of all raws
+    :param None present: boolean array marking rows having at least one
+       interaction with a valid column. By default, rows with a positive sum.
+    :returns: a vector of biases (length equal to the size of the matrix)
+    """
+    mask = ones(size)
+    if bads:
+        mask[list(bads)] = 0.
+    if verbose:
+        print("  - computing biases")
+    inv = mask.copy()
+    S = inv * dot(inv)
+    if present is None:
+        present = S > 0
+    present = present & (mask > 0)
+    nrows = present.sum()
+    if nrows == 0:
+        raise ZeroDivisionError('ERROR: normalization failed, all bad columns')
+    B = ones(size)
+    for it in range(iterations + 1):
+        if it:
+            S = inv * dot(inv)
+        meanS = S[present].sum() / nrows
+        DB = S / meanS
+        B[present] *= DB[present]
+        if iterations == 0: # exit before, we do not need to update W
+            break
+        inv = where(present & (B != 0), mask / where(B != 0, B, 1.), 0.)
+        Smin = S[present].min()
+        Smax = S[present].max()
+        dev = max(abs(Smin / meanS - 1), abs(Smax / meanS - 1))
+        if verbose:
+            print('   %15.3f %15.3f %15.3f %4s %9.5f' % (Smin, meanS, Smax, it, dev))
+        if dev < max_dev:
+            break
+    B = where(present & (B != 0), B * meanS**.5, 1.)
+    return dict((i, b) for i, b in enumerate(B.tolist()))
+
+
+def sum_diagonals(rows, cols, values, section_pos, bads=None, bias=None,
+                  both=True):
+    """
+    Sum interactions by diagonal (genomic distance), within each chromosome.
+
+    :param rows: numpy array with the row of each interaction
+    :param cols: numpy array with the column of each interaction. Only
+       interactions with row <= col are summed
+    :param values: numpy array with the value of each interaction
+    :param section_pos: dictionary with, for each chromosome, the first bin
+       and the last bin (not included)
+    :param None bads: boolean numpy array, True for bins not to be considered
+    :param None bias: numpy array of biases, to sum normalized interactions
+    :param True both: skip interactions with a bad row or a bad column,
+       otherwise only interactions with a bad row are skipped
+
+    :returns: two dictionaries with, for each chromosome, a numpy array of the
+       sum of interactions at each distance (as long as the chromosome), and a
+       numpy array with the number of interactions summed at each distance
+    """
+    crms = sorted(section_pos, key=lambda c: section_pos[c][0])
+    begs = array([section_pos[c][0] for c in crms], dtype=int64)
+    ends = array([section_pos[c][1] for c in crms], dtype=int64)
+    lens = ends - begs
+    offsets = concatenate(([0], cumsum(lens)))
+    rows = asarray(rows, dtype=int64)
+    cols = asarray(cols, dtype=int64)
+    values = asarray(values, dtype=float64)
+    sec = searchsorted(begs, rows, side='right') - 1
+    valid = (rows <= cols) & (sec >= 0)
+    valid[valid] &= cols[valid] < ends[sec[valid]]
+    if bads is not None:
+        valid &= ~bads[rows]
+        if both:
+            valid &= ~bads[cols]
+    rows = rows[valid]
+    cols = cols[valid]
+    values = values[valid]
+    if bias is not None:
+        values = values / bias[rows] / bias[cols]
+    idx = offsets[sec[valid]] + cols - rows
+    sums = bincount(idx, weights=values, minlength=offsets[-1])
+    nums = bincount(idx, minlength=offsets[-1])
+    return (dict((c, sums[offsets[i]:offsets[i + 1]]) for i, c in enumerate(crms)),
+            dict((c, nums[offsets[i]:offsets[i + 1]]) for i, c in enumerate(crms)))
+
+
+def count_diagonal_cells(section_pos, bads=None, both=True):
+    """
+    Count the cells of each diagonal, within each chromosome, skipping the ones
+    in bad rows (or columns).
+
+    :param section_pos: dictionary with, for each chromosome, the first bin
+       and the last bin (not included)
+    :param None bads: boolean numpy array, True for bins not to be considered
+    :param True both: skip cells with a bad row or a bad column, otherwise
+       only cells with a bad row are skipped
+
+    :returns: a dictionary with, for each chromosome, a numpy array with the
+       number of cells at each distance (as long as the chromosome)
+    """
+    ndiags = {}
+    for crm, (beg, end) in section_pos.items():
+        size = end - beg
+        if bads is None:
+            ndiags[crm] = arange(size, 0, -1)
+            continue
+        crm_bads = bads[beg:end]
+        # number of bad bins before each position
+        cum_bads = concatenate(([0], cumsum(crm_bads)))
+        # bad rows in [beg, end - dist)
+        ndiag = arange(size, 0, -1) - cum_bads[size:0:-1]
+        if both:
+            # bad columns in [beg + dist, end), minus cells with both bad
+            ndiag -= cum_bads[-1] - cum_bads[:size]
+            badpos = flatnonzero(crm_bads)
+            both_bad = zeros(size, dtype=int64)
+            for i in range(0, len(badpos), 1000):
+                dists = badpos[None, :] - badpos[i:i + 1000, None]
+                both_bad += bincount(dists[dists >= 0], minlength=size)
+            ndiag += both_bad
+        ndiags[crm] = ndiag
+    return ndiags
+
+
+def _bias_key(bias):
+    if not bias:
+        return None
+    return tuple(sorted(bias.items()))
+
+
+def expected(hic_data, bads=None, signal_to_noise=0.05, inter_chrom=False,
+             bias=None, **kwargs):
     """
     Computes the expected values by averaging observed interactions at a given
     distance in a given HiC matrix.
 
+    The result is cached in the HiC_data object, for a given set of bad
+    columns, biases and signal to noise ratio, until the matrix is modified.
+
     :param hic_data: dictionary containing the interaction data
     :param None bads: dictionary with column not to be considered
     :param 0.05 signal_to_noise: to calculate expected interaction counts,
        if not enough reads are observed at a given distance the observations
        of the distance+1 are summed. a signal to noise ratio of < 0.05
        corresponds to > 400 reads.
+    :param None bias: dictionary of biases, to compute the expected values of
+       the normalized matrix
 
     :returns: a vector of biases (length equal to the size of the matrix)
     """
+    cache = getattr(hic_data, '_expected_cache', None)
+    if cache is not None:
+        key = (tuple(sorted(bads or ())), _bias_key(bias), signal_to_noise,
+               inter_chrom)
+        if key in cache:
+            return dict(cache[key])
+
     min_n = signal_to_noise ** -2. # equals 400 when default
 
     size = len(hic_data)
@@ -254,38 +448,48 @@ def expected(hic_data, bads=None, signal_to_noise=0.05, inter_chrom=False, **kwa
     except AttributeError:
         pass
 
-    if size > 1200:
-        import sys
-        sys.setrecursionlimit(size + 100)
-
+    section_pos = hic_data.section_pos or {None: (0, len(hic_data))}
+    bad_mask = zeros(len(hic_data), dtype=bool)
+    if bads:
+        bad_mask[list(bads)] = True
+    bias_array = None
+    if bias:
+        bias_array = ones(len(hic_data))
+        for k, v in bias.items():
+            bias_array[k] = v
+
+    # sum of interactions, and number of (good) rows, at each distance
+    matrix = hic_data.get_hic_data_as_csr().tocoo()
+    sums, _ = sum_diagonals(matrix.row, matrix.col, matrix.data, section_pos,
+                            bads=bad_mask, bias=bias_array, both=False)
+    ndiags = count_diagonal_cells(section_pos, bads=bad_mask, both=False)
+    sum_diag = zeros(size + 1)
+    num_diag = zeros(size + 1, dtype=int64)
+    for crm in section_pos:
+        crm_size = min(len(sums[crm]), size)
+        sum_diag[:crm_size] += sums[crm][:crm_size]
+        num_diag[:crm_size] += ndiags[crm][:crm_size]
+    sum_diag = sum_diag.tolist()
+    num_diag = num_diag.tolist()
+
+    # consecutive diagonals are merged until enough interactions are observed
     expc = {}
     dist = 0
     while dist < size:
-        diag = []
-        new_dist, val = _meandiag(hic_data, dist, diag, min_n, size, bads)
-        for dist in range(dist, new_dist + 1):
+        first = dist
+        total = count = 0
+        while True:
+            total += sum_diag[dist]
+            count += num_diag[dist]
+            if not count:
+                val = 0.
+                break
+            if total > min_n or dist >= size:
+                val = float(total) / count
+                break
+            dist += 1
+        for dist in range(first, dist + 2):
             expc[dist] = val
+    if cache is not None:
+        cache[key] = dict(expc)
     return expc
-
-
-def _meandiag(hic_data, dist, diag, min_n, size, bads):
-    if hic_data.section_pos:
-        for crm in hic_data.section_pos:
-            for i in range(hic_data.section_pos[crm][0],
-                            hic_data.section_pos[crm][1] - dist):
-                if i in bads:
-                    continue
-                diag.append(hic_data[i, i + dist])
-    else:
-        for i in range(size - dist):
-            if i in bads:
-                continue
-            diag.append(hic_data[i, i + dist])
-    sum_diag = sum(diag)
-    if not diag:
-        return dist + 1, 0.
-    if sum_diag > min_n:
-        return dist + 1, float(sum_diag) / len(diag)
-    if dist >= size:
-        return dist + 1, float(sum_diag) / len(diag)
-    return _meandiag(hic_data, dist + 1, diag, min_n, size, bads)
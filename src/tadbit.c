@@ -3,8 +3,8 @@
 
 // Global variables. //
 
-int *_cache_index;
 int _max_cache_index;
+int _lgamma_size;             // Number of cached log-gamma terms.
 int n_processed;              // Number of slices processed so far.
 int n_to_process;             // Total number of slices to process.
 int taskQ_i;                  // Index used for task queue.
@@ -72,6 +72,32 @@ double fastlog(double x)
     return M_LN2 * (double) exp + fastlog_lookup[man];
 }
 
+double
+log_factorial(
+  const int k,
+  const double *lg
+){
+// SYNOPSIS:
+//   Log-gamma term 'log(k!)' of a count, read from the cache 'lg' for
+//   the counts lower than '_lgamma_size'.
+
+   return (k >= 0 && k < _lgamma_size) ? lg[k] : lgamma(k+1);
+}
+
+
+int
+in_band(
+  const int i,
+  const int j,
+  const int n,
+  const int band
+){
+// SYNOPSIS:
+//   Whether slice ('i','j') is stored in a banded matrix (see 'BAND').
+
+   return (i >= 0) && (j < n) && (i < j) && (j-i <= band);
+}
+
 // Convenience function to erase tadbit_output data structure //
 void
 destroy_tadbit_output(
@@ -154,7 +180,7 @@ fg(
       i_high = diag ? j : _i+1;
       for (i = i_low ; i < i_high ; i++) {
          // Retrieve value of the exponential from cache.
-         index = _cache_index[i+j*n];
+         index = abs(dp[i]-dp[j]);
          if (c[index] != c[index]) {
             //c[index] = exp(a+da+(b+db)*d[i+j*n]);
         	//c[index] = exp(a+da+(b+db)*log(abs(dp[i]-dp[j])));
@@ -205,7 +231,7 @@ ll(
 //   'k': raw hiC counts.                                               
 //   'dp': array with the index of columns that are not removed.
 //   'w': array of row and column (by symmetry) sums. Weights measuring hiC bias are w[i]*w[j]
-//   'lg': log-gamma terms.                                             
+//   'lg': cached log-gamma terms (see 'log_factorial').                
 //   'c': address of an array of double for caching.                    
 //                                                                      
 // RETURN:                                                              
@@ -263,7 +289,7 @@ ll(
       for (j = j_low ; j < j_high ; j++) {
          i_high = diag ? j : _i+1;
          for (i = i_low ; i < i_high ; i++) {
-            index = _cache_index[i+j*n];
+            index = abs(dp[i]-dp[j]);
             // Retrieve value of the exponential from cache.
             if (c[index] != c[index]) { // ERROR.
                //c[index] = exp(a+b*d[i+j*n]);
@@ -321,11 +347,12 @@ ll(
    for (j = j_low ; j < j_high ; j++) {
       i_high = diag ? j : _i+1;
       for (i = i_low ; i < i_high ; i++) {
-         index = _cache_index[i+j*n];
+         index = abs(dp[i]-dp[j]);
          // Retrieve value of the exponential from cache.
          //llik += c[index] + k[i+j*n]*(a+b*d[i+j*n]) - lg[i+j*n];
          //llik += c[index] + k[i+j*n]*(a+b*log(abs(dp[i]-dp[j]))) - lg[i+j*n];
-         llik += c[index] + k[i+j*n]*(a+b*fastlog(abs(dp[i]-dp[j]))) - lg[i+j*n];
+         llik += c[index] + k[i+j*n]*(a+b*fastlog(abs(dp[i]-dp[j]))) -
+            log_factorial(k[i+j*n], lg);
 
       }
    }
@@ -349,17 +376,17 @@ fill_DP(
 //   'void *'                                                           
 //                                                                      
 // SIDE-EFFECTS:                                                        
-//   Update 'old_llik', 'new_llik' and 'new_bkpt_list' in place.        
+//   Update 'new_llik' and 'back' in place.                             
 //                                                                      
 
    dpworker_arg *myargs = (dpworker_arg *) arg;
    const int n = myargs->n;
+   const int band = myargs->band;
    const double *llikmat = (const double *) myargs->llikmat;
    double *old_llik = (double *) myargs->old_llik;
    double *new_llik = (double *) myargs->new_llik;
    const int nbreaks = myargs->nbreaks;
-   int *new_bkpt_list = (int *) myargs->new_bkpt_list;
-   const int *old_bkpt_list = (const int *) myargs->old_bkpt_list;
+   int *back = (int *) myargs->back;
 
    int i;
 
@@ -378,25 +405,21 @@ fill_DP(
       new_llik[j] = -INFINITY;
       int new_bkpt = -1;
 
-      // Cycle over start point 'i'.
-      for (i = 3 * nbreaks ; i < j-3 ; i++) {
+      // Cycle over start point 'i' (only slices stored in the band).
+      int i_low = j-band > 3 * nbreaks ? j-band : 3 * nbreaks;
+      for (i = i_low ; i < j-3 ; i++) {
 
          // If NAN the following condition evaluates to false.
-         double tmp = old_llik[i-1] + llikmat[i+j*n];
+         double tmp = old_llik[i-1] + llikmat[BAND(i, j, band)];
          if (tmp > new_llik[j]) {
             new_llik[j] = tmp;
             new_bkpt = i-1;
          }
       }
 
-      // Update breakpoint list (skip if log-lik is undefined).
+      // Store the last breakpoint (skip if log-lik is undefined).
       // No need to use mutex because 'j' is different for every thread.
-      if (new_llik[j] > -INFINITY) {
-         for (i = 0 ; i < n ; i++) {
-            new_bkpt_list[j+i*n] = old_bkpt_list[new_bkpt+i*n];
-         }
-         new_bkpt_list[j+new_bkpt*n] = 1;
-      }
+      if (new_llik[j] > -INFINITY) back[j+nbreaks*n] = new_bkpt;
    }
 
    return NULL;
@@ -408,6 +431,7 @@ DPwalk(
   // input //
   const double *llikmat,
   const int n,
+  const int band,
   const int MAXBREAKS,
   int n_threads,
   // output //
@@ -419,8 +443,9 @@ DPwalk(
 //   of breakpoints given a matrix of slice maximum log-likelihood.     
 //                                                                      
 // PARAMETERS:                                                          
-//   '*llikmat': matrix of maximum log-likelihood values.               
+//   '*llikmat': banded matrix of maximum log-likelihood values.        
 //   'n': row/col number of 'llikmat'.                                  
+//   'band': maximum length (j-i) of the slices stored in 'llikmat'.    
 //   'MAXBREAKS': The maximum number of breakpoints.                    
 //        -- output arguments --                                        
 //   '*mllik': maximum log-likelihood of the segmentations.             
@@ -434,26 +459,26 @@ DPwalk(
 //                                                                      
 
    int i;
+   int j;
+   int b;
    int nbreaks;
 
    double new_llik[n];
    double old_llik[n];
 
-   // Breakpoint lists. The first index (row) is the end of the slice,
-   // the second is 1 if this position is an end (breakpoint).
-   // These must be allocated from the heap because 'n' can be large.
-   int *new_bkpt_list = (int *) malloc(n*n * sizeof(int));
-   int *old_bkpt_list = (int *) malloc(n*n * sizeof(int));
+   // Back pointers. 'back[j+nbreaks*n]' is the last breakpoint of the
+   // best segmentation ending at 'j' with 'nbreaks' breaks, or -1 if
+   // there is none (the segmentation is then the one with 'nbreaks'-1
+   // breaks). They replace the full lists of breakpoints per end point.
+   int *back = (int *) malloc(n*MAXBREAKS * sizeof(int));
 
    // Initializations.
    // 'breakpoints' is a 'n' x 'MAXBREAKS' array. The first index (row)
    // is 1 if there is a breakpoint at that location, the second index
    // (column) is the number of breakpoints.
-   for (i = 0 ; i < n*MAXBREAKS ; i++) breakpoints[i] = 0;
-
-   for (i = 0 ; i < n*n ; i++) {
-      new_bkpt_list[i] = 0;
-      old_bkpt_list[i] = 0;
+   for (i = 0 ; i < n*MAXBREAKS ; i++) {
+      breakpoints[i] = 0;
+      back[i] = -1;
    }
 
    for (i = 0 ; i < MAXBREAKS ; i++) {
@@ -463,24 +488,25 @@ DPwalk(
    // Initialize 'old_llik' to the first line of 'llikmat' containing
    // the log-likelihood of segments starting at index 0.
    for (i = 0 ; i < n ; i++) {
-      old_llik[i] = llikmat[i*n];
+      old_llik[i] = i > 0 && i <= band ? llikmat[BAND(0, i, band)] : NAN;
       new_llik[i] = -INFINITY;
    }
 
    int err = pthread_mutex_init(&tadbit_lock, NULL);
    if (err) {
       fprintf(stderr, "error initializing mutex (%d)\n", err);
+      free(back);
       return;
    }
 
    dpworker_arg arg = {
       .n = n,
+      .band = band,
       .llikmat = llikmat,
       .old_llik = old_llik,
       .new_llik = new_llik,
       .nbreaks = 1,
-      .new_bkpt_list = new_bkpt_list,
-      .old_bkpt_list = old_bkpt_list,
+      .back = back,
    };
 
    pthread_t *tid = (pthread_t *) malloc(n_threads * sizeof(pthread_t));
@@ -489,10 +515,6 @@ DPwalk(
    for (nbreaks = 1 ; nbreaks < MAXBREAKS ; nbreaks++) {
 
       arg.nbreaks = nbreaks;
-      // Update breakpoint lists.
-      for (i = 0 ; i < n*n ; i++) {
-         old_bkpt_list[i] = new_bkpt_list[i];
-      }
       taskQ_i = 3 * nbreaks + 2;
 
       for (i = 0 ; i < n_threads ; i++) tid[i] = 0;
@@ -500,6 +522,7 @@ DPwalk(
          err = pthread_create(&(tid[i]), NULL, &fill_DP, &arg);
          if (err) {
             fprintf(stderr, "error creating thread (%d)\n", err);
+            free(back);
             return;
          }
       }
@@ -512,17 +535,20 @@ DPwalk(
       // Update full log-likelihoods.
       mllik[nbreaks] = new_llik[n-1];
 
-      // Record breakpoints.
+      // Record breakpoints, following the back pointers from the end.
+      for (j = n-1, b = nbreaks ; b > 0 ; b--) {
+         if (back[j+b*n] < 0) continue;
+         j = back[j+b*n];
+         breakpoints[j+nbreaks*n] = 1;
+      }
       for (i = 0 ; i < n ; i++) {
          old_llik[i] = new_llik[i];
-         breakpoints[i+nbreaks*n] = new_bkpt_list[n-1+i*n];
       }
 
    }
 
    free(tid);
-   free(new_bkpt_list);
-   free(old_bkpt_list);
+   free(back);
 
    return;
 
@@ -536,8 +562,9 @@ fill_llikmat(
 //   Compute the log-likelihood of the slices. The element (i,j) of     
 //   the matrix 'llikmat' will contain the log-likelihood  of the       
 //   slice starting at i and ending at j. the matrix is initialized     
-//   with nan because not all elements will be computed. The lower      
-//   triangular part is left out.                                       
+//   with nan because not all elements will be computed. The matrix is  
+//   banded: the lower triangular part and the slices longer than       
+//   'band' are left out (see 'BAND').                                  
 //                                                                      
 // PARAMETERS:                                                          
 //   'arg': thread arguments (see header file for definition).          
@@ -556,17 +583,18 @@ fill_llikmat(
    //const double *d = (const double*) myargs->d;
    const int *dp = (const int*) myargs->dp;
    const double **w = (const double **) myargs->w;
-   const double **lg= (const double **) myargs->lg;
+   const double *lg = (const double *) myargs->lg;
    const char *skip = (const char *) myargs->skip;
    double *llikmat = myargs->llikmat;
+   const int band = myargs->band;
    const int verbose = myargs->verbose;
 
    int i;
    int j;
    int l;
 
-   // Cache to speed up computation. Get the max of '_cache_index'
-   // in order to allocate the right size.
+   // Cache to speed up computation, indexed by the distance between
+   // rows and columns.
    double *c= (double *) malloc(_max_cache_index * sizeof(double));
    for (i = 0 ; i < _max_cache_index ; i++) c[i] = 0.0;
 
@@ -576,11 +604,11 @@ fill_llikmat(
    while (1) {
 
       pthread_mutex_lock(&tadbit_lock);
-      while ((taskQ_i < n*n) && (skip[taskQ_i] > 0)) {
+      while ((taskQ_i < n*(band+1)) && (skip[taskQ_i] > 0)) {
          // Fast forward to the next job.
          taskQ_i++;
       }
-      if (taskQ_i >= n*n) {
+      if (taskQ_i >= n*(band+1)) {
          // Task queue is empty. Exit loop and return
          pthread_mutex_unlock(&tadbit_lock);
          break;
@@ -590,8 +618,8 @@ fill_llikmat(
       pthread_mutex_unlock(&tadbit_lock);
 
       // Compute the log-likelihood of slice '(i,j)'.
-      i = job_index % n;
-      j = job_index / n;
+      j = job_index / (band+1);
+      i = j - job_index % (band+1);
 
       // Make sure that slices have minimum width 3.
       int cornered = (i == 1) || (i == 2) || (j == n-2) || (j == n-3);
@@ -599,13 +627,13 @@ fill_llikmat(
       if (cornered || slice_too_thin) continue;
 
       // Distinct parts of the array, no lock needed.
-      llikmat[i+j*n] = 0.0;
+      llikmat[job_index] = 0.0;
       for (l = 0 ; l < m ; l++) {
          // LABEL: slice ll summation.
-         llikmat[i+j*n] +=
-            ll(n,   0, i-1, i, j, 0, k[l], dp, w[l], lg[l], c) / 2 +
-        	ll(n,   i,   j, i, j, 1, k[l], dp, w[l], lg[l], c) +
-        	ll(n, j+1, n-1, i, j, 0, k[l], dp, w[l], lg[l], c) / 2;
+         llikmat[job_index] +=
+            ll(n,   0, i-1, i, j, 0, k[l], dp, w[l], lg, c) / 2 +
+        	ll(n,   i,   j, i, j, 1, k[l], dp, w[l], lg, c) +
+        	ll(n, j+1, n-1, i, j, 0, k[l], dp, w[l], lg, c) / 2;
             //ll(n,   0, i-1, i, j, 0, k[l], d, w[l], lg[l], c) / 2 +
             //ll(n,   i,   j, i, j, 1, k[l], d, w[l], lg[l], c) +
             //ll(n, j+1, n-1, i, j, 0, k[l], d, w[l], lg[l], c) / 2;
@@ -630,16 +658,18 @@ allocate_heur_job(
   char *skip,
   const int i0,
   const int j0,
-  const int n
+  const int n,
+  const int band
 ){
 // SYNOPSIS:                                                            
 //   Create or update thread jobs (used in pre-heuristic).
 //                                                                      
 // PARAMETERS:                                                          
-//   'skip': the job matrix to update in place.                         
+//   'skip': the banded job matrix to update in place.                  
 //   'i0': start position of the approximate TAD.                       
 //   'j0': end position of the approximate TAD.                         
 //   'n': number of rows/columns of the hiC matrix (or 'skip').         
+//   'band': maximum length of the slices.                              
 //                                                                      
 // RETURN:                                                              
 //   'void'                                                             
@@ -653,7 +683,7 @@ allocate_heur_job(
 
    for (j = j0-2 ; j < j0+3 ; j++)
    for (i = i0-2 ; i < i0+3 ; i++)
-      if ((i+j*n > 0) && (i+j*n < n*n)) skip[i+j*n] = 0;
+      if (in_band(i, j, n, band)) skip[BAND(i, j, band)] = 0;
 
 }
 
@@ -663,7 +693,8 @@ allocate_new_jobs(
   const int *bkpts,
   const int MAXBREAKS,
   const int nbreaks_opt,
-  const int n
+  const int n,
+  const int band
 ){
 // SYNOPSIS:                                                            
 //   Create or update thread jobs. For an approximate TAD defined by    
@@ -672,8 +703,9 @@ allocate_new_jobs(
 //                                                                      
 // PARAMETERS:                                                          
 // TODO Update parameters
-//   'skip': the job matrix to update in place.                         
+//   'skip': the banded job matrix to update in place.                  
 //   'n': number of rows/columns of the hiC matrix (or 'skip').         
+//   'band': maximum length of the slices.                              
 //                                                                      
 // RETURN:                                                              
 //   'void'                                                             
@@ -702,9 +734,9 @@ allocate_new_jobs(
 
             // Jobs for splitting the TAD.
             for (j = i0 ; j < j0 ; j++)
-               skip[i0+j*n] = 0;
+               if (in_band(i0, j, n, band)) skip[BAND(i0, j, band)] = 0;
             for (i = i0 ; i < j0 ; i++)
-               skip[i+j0*n] = 0;
+               if (in_band(i, j0, n, band)) skip[BAND(i, j0, band)] = 0;
 
             starts[i0] = 1;
             ends[j0] = 1;
@@ -715,9 +747,9 @@ allocate_new_jobs(
 
    // Jobs for merging the TADs.
    for (i = 0 ; i < n ; i++)
-   for (j = 0 ; j < n ; j++)
-      if (starts[i] && ends[j] && (j-i < 500) && (i < j))
-         skip[i+j*n] = 0;
+   for (j = i+1 ; j < n && j-i < 500 ; j++)
+      if (starts[i] && ends[j] && in_band(i, j, n, band))
+         skip[BAND(i, j, band)] = 0;
 
    free(starts);
    free(ends);
@@ -866,16 +898,20 @@ tadbit
 
    const int MAXBREAKS = n/5;
 
-   _cache_index = (int *) malloc(n*n * sizeof(int));
+   // Slices longer than 'max_tad_size' are neither computed nor
+   // stored: the matrices indexed by slice are banded (see 'BAND'),
+   // which takes n*('band'+1) values instead of n*n.
+   const int band = (max_tad_size > 0) && (max_tad_size < n-1) ?
+      max_tad_size : n-1;
+   const int nband = n*(band+1);
+
    _max_cache_index = N+1;
    // Allocate and copy.
-   double **log_gamma  = (double **) malloc(m * sizeof(double *));
    int    **new_obs    = (int **) malloc(m * sizeof(int *));
    //double *dist = (double *) malloc(n*n * sizeof(double));
    int *dp = (int *) malloc(n * sizeof(int));
    for (k = 0 ; k < m ; k++) {
       l = i0 = 0;
-      log_gamma[k] = (double *) malloc(n*n * sizeof(double));
       new_obs[k] = (int *) malloc(n*n * sizeof(int));
       for (j = 0 ; j < N ; j++) {
     	  if (!remove[j]) {
@@ -884,8 +920,6 @@ tadbit
     	  }
 		  for (i = 0 ; i < N ; i++) {
 			 if (remove[i] || remove[j]) continue;
-			 _cache_index[l] = i > j ? i-j : j-i;
-			 log_gamma [k][l] = lgamma(obs[k][i+j*N]+1);
 			 new_obs[k][l]    = obs[k][i+j*N];
 			 //dist[l] = init_dist[i+j*N];
 			 l++;
@@ -904,6 +938,15 @@ tadbit
    // Make sure the data is symmetric.
    enforce_symmetry(obs, n, m);
 
+   // Cache the log-gamma terms of the counts (up to 2^20).
+   int maxcount = 0;
+   for (k = 0 ; k < m ; k++)
+   for (i = 0 ; i < n*n ; i++)
+      if (obs[k][i] > maxcount) maxcount = obs[k][i];
+   _lgamma_size = maxcount < (1 << 20) ? maxcount+1 : (1 << 20);
+   double *log_gamma = (double *) malloc(_lgamma_size * sizeof(double));
+   for (i = 0 ; i < _lgamma_size ; i++) log_gamma[i] = lgamma(i+1);
+
 
    // Compute row/column sums (identical by symmetry).
    double **rowsums = (double **) malloc(m * sizeof(double *));
@@ -936,98 +979,87 @@ tadbit
 
    double *mllik = (double *) malloc(MAXBREAKS * sizeof(double));
    int *bkpts = (int *) malloc(MAXBREAKS*n * sizeof(int));
-   double *llikmat = (double *) malloc(n*n * sizeof(double));
-   for (i = 0 ; i < n*n ; i++)
+   double *llikmat = (double *) malloc(nband * sizeof(double));
+   for (i = 0 ; i < nband ; i++)
       llikmat[i] = NAN;
 
    // 'skip' will contain only 0 or 1 and can be stored as 'char'.
-   char *skip = (char *) malloc(n*n * sizeof(char));
+   // Slices outside the upper triangular part are always skipped.
+   char *skip = (char *) malloc(nband * sizeof(char));
+   for (i = 0 ; i < nband ; i++) skip[i] = 1;
 
    // Use the heuristic by default (hence the name of the parameter).
-   // The parameter 'max_tad_size' is needed only in case the heuristic
-   // is not used.
+   // Without the heuristic, all slices up to 'max_tad_size' are
+   // computed.
    if (do_not_use_heuristic) {
       for (j = 0 ; j < n ; j++)
-      for (i = 0 ; i < n ; i++)
-         // Also sets the lower triangular part of 'skip'.
-         skip[i+j*n] = (i >= j) || ((j-i) > max_tad_size) ? 1 : 0;
+      for (i = j-band > 0 ? j-band : 0 ; i < j ; i++)
+         skip[BAND(i, j, band)] = 0;
    }
    else {
       if (verbose) {
          fprintf(stderr, "running pre-heuristic\n");
       }
 
-      for (i = 0 ; i < n*n ; i++) skip[i] = 1;
-
-      // 'S[i+j*n]' is the weighted sum of reads within the triangle
-      // defined by ('i','j') in the upper triangular matrix of
+      // 'S[BAND(i,j,band)]' is the weighted sum of reads within the
+      // triangle defined by ('i','j') in the upper triangular matrix of
       // observations.
-      double *S = (double *) malloc(n*n * sizeof(double));
-      for (i = 0 ; i < n*n ; i++) S[i] = 0.0;
-      for (j = 1 ; j < n ; j++) {
+      double *S = (double *) malloc(nband * sizeof(double));
+      for (i = 0 ; i < nband ; i++) S[i] = 0.0;
+      for (j = 1 ; j <= band ; j++) {
       for (i = 0 ; i < n-j ; i++) {
          double weighted_value = 0.0;
          for (l = 0 ; l < m ; l++) {
         	weighted_value += obs[l][i+(i+j)*n]/(rowsums[l][i]*rowsums[l][(i+j)]);
             //weighted_value += obs[l][i+(i+j)*n]/weights[l][i+(i+j)*n];
          }
-         S[i+(i+j)*n] = S[i+(i+j-1)*n] + S[i+1+(i+j)*n] -
-            S[i+1+(i+j-1)*n] + weighted_value;
+         S[BAND(i, i+j, band)] = S[BAND(i, i+j-1, band)] +
+            S[BAND(i+1, i+j, band)] -
+            (j > 1 ? S[BAND(i+1, i+j-1, band)] : 0.0) + weighted_value;
       }
       }
 
-      double *heur_score = (double *) malloc(n*n * sizeof(double));
-      for (i = 0 ; i < n*n ; i++) heur_score[i] = NAN;
-      for (j = 1 ; j < n ; j++)
-      for (i = 0 ; i < j ; i++)
-    	  heur_score[i+j*n] = log(S[i+j*n]);
+      // The heuristic score (log of 'S') replaces 'S' in place.
+      double *heur_score = S;
+      for (j = 0 ; j < n ; j++)
+      for (k = 0 ; k <= band ; k++)
+         heur_score[k+j*(band+1)] = (k > 0) && (k <= j) ?
+            log(S[k+j*(band+1)]) : NAN;
 
       // Use dynamic programming to find approximate break points.
       // The matrix 'mllik' is used only to make the function call valid
       // (it is updated in place, but the value is disregarded), and
       // the heuristic score 'heur_score' plays the role of the
       // log-likelihood 'llikmat'.
-      DPwalk(heur_score, n, MAXBREAKS, n_threads, mllik, bkpts);
+      DPwalk(heur_score, n, band, MAXBREAKS, n_threads, mllik, bkpts);
 
-      free(heur_score);
       free(S);
 
       // Create a thread job for each approximate TAD.
-      for (i = 0 ; i < n*n ; i++) skip[i] = 1;
       for (j = 1 ; j < MAXBREAKS ; j++) {
          i0 = 0;
          for (i = 0 ; i < n ; i++) {
             if (bkpts[i+j*n]) {
-               allocate_heur_job(skip, i0, i, n);
+               allocate_heur_job(skip, i0, i, n, band);
                i0 = i+1;
             }
          }
       }
 
-      // Erase the lower triangular part of 'skip'.
-      for (j = 0 ; j < n ; j++)
-      for (i = j ; i < n ; i++)
-         skip[i+j*n] = 1;
-
       // Allocate estimation of the log likelihood for all small
       // TADs (less than 3 bins).
       for (j = 6 ; j < n ; j++)
       for (i = j-6 ; i < j-3 ; i++)
-         skip[i+j*n] = 0;
+         if (in_band(i, j, n, band)) skip[BAND(i, j, band)] = 0;
 
       // Allocate jobs at the ends of the chromosomes/units because
       // these regions are a bit noisier.
       for (j = 1 ; j < 51 ; j++)
       for (i = 0 ; i < j-3 ; i++)
-         if (i < n && j < n) skip[i+j*n] = 0;
+         if (in_band(i, j, n, band)) skip[BAND(i, j, band)] = 0;
       for (j = n-51 ; j < n ; j++)
       for (i = n-51 ; i < j-3 ; i++)
-         if (i > 0 && j > 0) skip[i+j*n] = 0;
-
-      // Reset lower triangular part of 'skip'.
-      for (j = 0 ; j < n ; j++)
-      for (i = j ; i < n ; i++)
-         skip[i+j*n] = 1;
+         if (i > 0 && in_band(i, j, n, band)) skip[BAND(i, j, band)] = 0;
 
    } // End of pre-heuristic.
 
@@ -1043,9 +1075,10 @@ tadbit
 	  .dp = dp,
       //.w = (const double **) weights,
 	  .w = (const double *) rowsums,
-      .lg = (const double **) log_gamma,
+      .lg = (const double *) log_gamma,
       .skip = skip,
       .llikmat = llikmat,
+      .band = band,
       .verbose = verbose,
    };
 
@@ -1073,7 +1106,7 @@ tadbit
 
       // Initialize task queue.
       n_to_process = 0;
-      for (i = 0 ; i < n*n ; i++) {
+      for (i = 0 ; i < nband ; i++) {
          // Skip all computation done in previous cycles.
          if (!isnan(llikmat[i])) skip[i] = 1;
          n_to_process += (1-skip[i]);
@@ -1105,7 +1138,7 @@ tadbit
       // segments. The breakpoints are found by dynamic programming.
       int maxbreaks = nbreaks_opt ? nbreaks_opt + 11 : MAXBREAKS;
       if (maxbreaks > MAXBREAKS) maxbreaks = MAXBREAKS;
-      DPwalk(llikmat, n, maxbreaks, n_threads, mllik, bkpts);
+      DPwalk(llikmat, n, band, maxbreaks, n_threads, mllik, bkpts);
 
       // Get optimal number of breaks by AIC.
       newAIC = -INFINITY;
@@ -1116,7 +1149,7 @@ tadbit
       }
       nbreaks_opt -= 1;
 
-      allocate_new_jobs(skip, bkpts, MAXBREAKS, nbreaks_opt, n);
+      allocate_new_jobs(skip, bkpts, MAXBREAKS, nbreaks_opt, n, band);
 
    }
 
@@ -1125,17 +1158,16 @@ tadbit
    pthread_mutex_destroy(&tadbit_lock);
    free(skip);
    free(tid);
-   free(_cache_index);
 
    nbreaks_opt = nbrks ? (int) nbrks - 1 : nbreaks_opt;
 
    // Compute breakpoint confidence by penalized dynamic progamming.
-   double *llikmatcpy = (double *) malloc (n*n * sizeof(double));
+   double *llikmatcpy = (double *) malloc (nband * sizeof(double));
    double *mllikcpy = (double *) malloc(MAXBREAKS * sizeof(double));
    int *bkptscpy = (int *) malloc(n*MAXBREAKS * sizeof(int));
    int *passages = (int *) malloc(n * sizeof(int));
    for (i = 0 ; i < n*MAXBREAKS ; i++) bkptscpy[i] = bkpts[i];
-   for (i = 0 ; i < n*n ; i++) llikmatcpy[i] = llikmat[i];
+   for (i = 0 ; i < nband ; i++) llikmatcpy[i] = llikmat[i];
    for (i = 0 ; i < n ; i++) passages[i] = 0;
 
    for (l = 0 ; l < 10 ; l++) {
@@ -1146,13 +1178,13 @@ tadbit
             // in the final decomposition. The penalty is set to
             // 'm*6' because it is the expected log-likelihood gain
             // for adding a new TAD around the optimum log-likelihood.
-            llikmatcpy[i+j*n] -= m*6;
+            if (in_band(i, j, n, band)) llikmatcpy[BAND(i, j, band)] -= m*6;
             passages[j] += bkpts[j+nbreaks_opt*n];
             i = j+1;
          }
       }
-      if (i < n) llikmatcpy[i+(n-1)*n] -= m*6;
-      DPwalk(llikmatcpy, n, nbreaks_opt+1, n_threads, mllikcpy, bkptscpy);
+      if (in_band(i, n-1, n, band)) llikmatcpy[BAND(i, n-1, band)] -= m*6;
+      DPwalk(llikmatcpy, n, band, nbreaks_opt+1, n_threads, mllikcpy, bkptscpy);
    }
    free(llikmatcpy);
    free(mllikcpy);
@@ -1194,25 +1226,8 @@ tadbit
    free(passages);
    free(bkpts);
 
-   double *resized_llikmat = (double *) malloc(N*N * sizeof(double));
-   for (i = 0 ; i < N*N ; i++) {
-      resized_llikmat[i] = NAN;
-   }
-
-   for (l = 0, i = 0 ; i < N ; i++) {
-      if (remove[i]) continue;
-      for (k = 0, j = 0 ; j < N ; j++) {
-         if (remove[j]) continue;
-         resized_llikmat[i+j*N] = llikmat[l+k*n];
-         k++;
-      }
-      l++;
-   }
-   free(llikmat);
-
    for (k = 0 ; k < m ; k++) {
       free(new_obs[k]);
-      free(log_gamma[k]);
    }
    free(new_obs);
    free(log_gamma);
@@ -1223,10 +1238,12 @@ tadbit
 
    // Update output struct.
    seg->m = m;
+   seg->n = n;
+   seg->band = band;
    seg->maxbreaks = MAXBREAKS;
    seg->nbreaks_opt = nbreaks_opt;
    seg->passages = resized_passages;
-   seg->llikmat = resized_llikmat;
+   seg->llikmat = llikmat;
    seg->mllik = mllik;
    seg->bkpts = resized_bkpts;
 
@@ -14,6 +14,10 @@
 #define TOLERANCE 1e-6
 #define MAXITER 10000
 
+// Position of slice ('i','j') in a banded matrix, where only the slices
+// with 0 <= j-i <= 'w' are stored (column 'j' holds 'w'+1 values).
+#define BAND(i, j, w) ((j)-(i) + (j)*((w)+1))
+
 typedef struct {
    const int n;
    const int m;
@@ -22,27 +26,32 @@ typedef struct {
    const int *dp;
    //const double **w;
    const double *w;
-   const double **lg;
+   const double *lg;
    const char *skip;
    double *llikmat;
+   const int band;
    const int verbose;
 } llworker_arg;
 
 typedef struct {
    const int n;
+   const int band;
    const double *llikmat;
    double *old_llik;
    double *new_llik;
    int nbreaks;
-   int *new_bkpt_list;
-   const int *old_bkpt_list;
+   int *back;
 } dpworker_arg;
 
 
 
-// 'tadbit' output struct.
+// 'tadbit' output struct. 'llikmat' is banded (see 'BAND'): it holds
+// the log-likelihood of the 'n' x ('band'+1) slices of the matrix
+// without the removed rows/columns.
 typedef struct {
    int m;
+   int n;
+   int band;
    int maxbreaks;
    int nbreaks_opt;
    int *passages;
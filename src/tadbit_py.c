@@ -3,6 +3,7 @@
 // gcc -shared tadbit_py.c -I/usr/include/python2.7 -lm -lpthread -std=gnu99 -fPIC -g -O3 -Wall -o tadbit_py.so
 
 #include "Python.h"
+#include <string.h>
 #include "tadbit.c"
 
 #if PY_MAJOR_VERSION >= 3
@@ -31,46 +32,78 @@ PyDoc_STRVAR(tadbit_py__doc__,
 /* The function doc string */
 PyDoc_STRVAR(_tadbit_wrapper__doc__,
 "Run tadbit function in tadbit.c.\n\
-    :argument obs: a python list of lists of int, representing a list of linearized matrices.\n\
-    :argument weights: a python list of lists of floats, representing a list of linearized matrices.\n\
-    :argument remove: a python list of lists of booleans mapping positively columns to remove.\n\
+    :argument obs: a python list of linearized matrices (obs[i+j*n] being the\n\
+       count in row i and column j), either as tuples of int or as C-contiguous\n\
+       buffers of C int (e.g. numpy arrays of dtype intc), that are used\n\
+       without copy.\n\
+    :argument remove: a python tuple of booleans mapping positively columns to remove.\n\
     :argument 0 n: number of rows or columns in the matrix\n\
     :argument 0 m: number of matrices\n\
     :argument 0 n_threads: number of threads to use\n\
     :argument 0 verbose: whether to display more/less information about process\n\
     :argument 0 max_tad_size: an integer defining maximum size of TAD. Default defines it to the number of rows/columns.\n\
+       Only slices up to this size are computed and stored.\n\
+    :argument 0 nbks: number of breaks to use (0 for the optimal number)\n\
     :argument 1 do_not_use_heuristic: whether to use or not some heuristics\n\
-    :returns: a python list with each\n");
+    :returns: a python list with the maximum number of breaks, the number of\n\
+       breaks used, the confidence of each break, None (in place of the\n\
+       log-likelihood of each slice), the log-likelihood of each\n\
+       segmentation and the list of positions marked as breaks (1) or not (0)\n");
 
 
 /* The wrapper to the underlying C function */
 static PyObject *_tadbit_wrapper (PyObject *self, PyObject *args){
-  PyObject **py_obs;
+  PyObject *py_obs;
   PyObject *py_remove;
   int n;
   int m;
   int n_threads;
-  const int verbose = 0;
-  const int max_tad_size = 0;
-  const int nbks = 0;
-  const int do_not_use_heuristic = 0;
-  /* output */
-  tadbit_output *seg = (tadbit_output *) malloc(sizeof(tadbit_output));
+  int verbose = 0;
+  int max_tad_size = 0;
+  int nbks = 0;
+  int do_not_use_heuristic = 0;
 
   if (!PyArg_ParseTuple(args, "OOiiiiiii:tadbit", &py_obs, &py_remove,
 			&n, &m, &n_threads,
 			&verbose, &max_tad_size, &nbks, &do_not_use_heuristic))
     return NULL;
-  // convert list of lists to pointer o pointers
-  // if something goes wrong, it is probably from there :S
+  // convert list of matrices to pointer of pointers. Buffers (numpy
+  // arrays) are used in place, tuples are copied.
   int i, j;
-  int **obs;
-  obs = malloc(m * sizeof(int*));
-  for (i = 0 ; i < m ; i++ )
-    obs[i] = malloc(n*n * sizeof(int));
-  for (i = 0 ; i < m ; i++)
-    for (j = 0 ; j < n*n ; j++)
-      obs[i][j] = PyInt_AS_LONG(PyTuple_GET_ITEM(PyList_GET_ITEM(py_obs, i), j));
+  int **obs = malloc(m * sizeof(int*));
+  Py_buffer *views = calloc(m, sizeof(Py_buffer));
+  for (i = 0 ; i < m ; i++){
+    PyObject *py_matrix = PyList_GET_ITEM(py_obs, i);
+    if (PyObject_CheckBuffer(py_matrix)) {
+      if (PyObject_GetBuffer(py_matrix, &views[i],
+                             PyBUF_C_CONTIGUOUS | PyBUF_FORMAT) < 0)
+        break;
+      if (views[i].itemsize != sizeof(int) || views[i].len != (Py_ssize_t) (n*n*sizeof(int)) ||
+          !views[i].format || (strcmp(views[i].format, "i") &&
+                               strcmp(views[i].format, "=i") &&
+                               strcmp(views[i].format, "<i"))) {
+        PyBuffer_Release(&views[i]);
+        PyErr_SetString(PyExc_ValueError,
+                        "ERROR: matrices should hold n*n C int values");
+        break;
+      }
+      obs[i] = (int *) views[i].buf;
+    }
+    else {
+      obs[i] = malloc(n*n * sizeof(int));
+      for (j = 0 ; j < n*n ; j++)
+        obs[i][j] = PyInt_AS_LONG(PyTuple_GET_ITEM(py_matrix, j));
+    }
+  }
+  if (i < m) {
+    for (j = 0 ; j < i ; j++){
+      if (views[j].obj) PyBuffer_Release(&views[j]);
+      else free(obs[j]);
+    }
+    free(obs);
+    free(views);
+    return NULL;
+  }
 
   char *remove = (char *) malloc (n * sizeof(char));
   for (j = 0 ; j < n ; j++){
@@ -78,33 +111,43 @@ static PyObject *_tadbit_wrapper (PyObject *self, PyObject *args){
   }
 
   // run tadbit
+  tadbit_output *seg = (tadbit_output *) malloc(sizeof(tadbit_output));
   tadbit(obs, remove, n, m, n_threads, verbose, max_tad_size, nbks, do_not_use_heuristic, seg);
 
+  // release input matrices
+  for (i = 0 ; i < m ; i++){
+    if (views[i].obj) PyBuffer_Release(&views[i]);
+    else free(obs[i]);
+  }
+  free(obs);
+  free(views);
+
+  if (seg->maxbreaks == -1) {
+    free(seg);
+    PyErr_SetString(PyExc_ValueError,
+                    "ERROR: too few rows/columns left to find TADs");
+    return NULL;
+  }
+
   // store each tadbit output
 
   // declare python objects to store lists
   PyObject * py_bkpts;
-  PyObject * py_llikmat;
   PyObject * py_mllik;
   PyObject * py_result;
   PyObject * py_passages;
 
-  // get bkpts
-  int dim = seg->maxbreaks * n;
-  py_bkpts = PyList_New(dim);
-  for(i = 0 ; i < dim; i++)
-    PyList_SetItem(py_bkpts, i, PyInt_FromLong(seg->bkpts[i]));
+  // get bkpts of the segmentation retained
+  py_bkpts = PyList_New(n);
+  for(i = 0 ; i < n; i++)
+    PyList_SetItem(py_bkpts, i,
+                   PyInt_FromLong(seg->bkpts[i + seg->nbreaks_opt * n]));
 
   // get passages
   py_passages = PyList_New(n);
   for(i = 0 ; i < n; i++)
     PyList_SetItem(py_passages, i, PyFloat_FromDouble(seg->passages[i]));
 
-  // get llikmat
-  py_llikmat = PyList_New(n*n);
-  for(i = 0 ; i < n*n; i++)
-    PyList_SetItem(py_llikmat, i, PyFloat_FromDouble(seg->llikmat[i]));
-
   // get mllik
   py_mllik = PyList_New(seg->maxbreaks);
   for(i = 0 ; i < seg->maxbreaks ; i++)
@@ -113,19 +156,15 @@ static PyObject *_tadbit_wrapper (PyObject *self, PyObject *args){
   // group results into a python list
   py_result = PyList_New(6);
 
+  Py_INCREF(Py_None);
   PyList_SetItem(py_result, 0, PyInt_FromLong(seg->maxbreaks));
   PyList_SetItem(py_result, 1, PyInt_FromLong(seg->nbreaks_opt));
   PyList_SetItem(py_result, 2, py_passages);
-  PyList_SetItem(py_result, 3, py_llikmat);
+  PyList_SetItem(py_result, 3, Py_None);
   PyList_SetItem(py_result, 4, py_mllik);
   PyList_SetItem(py_result, 5, py_bkpts);
 
   // free many things... no leaks here!!
-  for (i = 0 ; i < m ; i++){
-    free(obs[i]);
-  }
-  free(obs);
-
   destroy_tadbit_output(seg);
 
   return py_result;
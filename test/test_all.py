@@ -24,12 +24,14 @@ from pytadbit.mapping.analyze             import hic_map, plot_distance_vs_inter
 from pytadbit.mapping.analyze             import insert_sizes, plot_iterative_mapping
 from pytadbit.mapping.analyze             import correlate_matrices, eig_correlate_matrices
 from pytadbit.mapping.filter              import filter_reads, apply_filter
+from pytadbit.hic_data                    import HiC_data, HiC_data_array
 
 from random                               import random, seed
 from os                                   import system, path, chdir
 from re                                   import finditer
 from warnings                             import warn, catch_warnings, simplefilter
 from distutils.spawn                      import find_executable
+from numpy.random                         import RandomState
 
 import sys
 
@@ -847,6 +849,822 @@ class TestTadbit(unittest.TestCase):
             self.assertEqual(True, True)
             print("20", time() - t0)
 
+    def test_21_hic_data_array(self):
+        """
+        array-backed storage behaves as the dictionary one
+        """
+        if ONLY and not "21" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        cells = {0: 3, 1: 2, 5: 2, 12: 7, 7: 4, 13: 1, 15: 9}
+        hic_dict  = HiC_data(dict(cells), 4)
+        hic_array = HiC_data_array(dict(cells), 4)
+        self.assertEqual(hic_dict.copy(), hic_array.copy())
+        self.assertEqual(sorted(hic_dict.items()), sorted(hic_array.items()))
+        self.assertEqual(sorted(hic_dict.keys()), list(hic_array))
+        self.assertEqual(sorted(hic_dict.values()), sorted(hic_array.values()))
+        self.assertEqual(hic_array, hic_dict)
+        for pos in range(16):
+            self.assertEqual(hic_dict.get(pos), hic_array.get(pos))
+            self.assertEqual(hic_dict.get(pos, -1), hic_array.get(pos, -1))
+            self.assertEqual(hic_dict[pos], hic_array[pos])
+            self.assertEqual(pos in hic_dict, pos in hic_array)
+        self.assertEqual(hic_dict.sum(), hic_array.sum())
+        # buffered and bulk updates
+        hic_dict.update({2: 5, 8: 1})
+        hic_array.update({2: 5, 8: 1})
+        hic_dict[3, 3] = 6
+        hic_array[3, 3] = 6
+        self.assertEqual(hic_dict.get(15), hic_array.get(15))
+        self.assertEqual(hic_dict.copy(), hic_array.copy())
+        other = HiC_data_array({4: 8, 15: 1}, 4)
+        hic_dict.update(other)
+        hic_array.update(other)
+        self.assertEqual(hic_dict.copy(), hic_array.copy())
+        self.assertEqual(hic_dict.pop(4), hic_array.pop(4))
+        self.assertEqual(hic_dict.pop(4, None), hic_array.pop(4, None))
+        self.assertEqual(hic_dict.setdefault(10, 2),
+                         hic_array.setdefault(10, 2))
+        del hic_dict[0]
+        del hic_array[0]
+        self.assertRaises(KeyError, hic_array.__delitem__, 0)
+        self.assertEqual(hic_dict.copy(), hic_array.copy())
+        self.assertNotEqual(hic_array, HiC_data_array(dict(cells), 4))
+        hic_array.clear()
+        self.assertEqual(hic_array.copy(), {})
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print("21", time() - t0)
+
+
+    def test_22_filter_bitmask(self):
+        """
+        bitmask of the filters, saved next to the reads and reused
+        """
+        if ONLY and not "22" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        from os import utime
+        from numpy import load as npload
+        from pytadbit.mapping.filter import get_bitmask, bitmask_path
+        from pytadbit.mapping.binary_pairs import tsv_to_binary
+        reads = ["r%02d" % i for i in range(10)]
+        with open("lala-pairs~", "w") as out:
+            out.write("# CRM chr1\t100000\n")
+            for i, read in enumerate(reads):
+                out.write("%s\tchr1\t%d\t1\t75\t%d\t%d\tchr1\t%d\t0\t75\t%d\t%d\n" % (
+                    read, 100 + i * 1000, i * 1000, i * 1000 + 900,
+                    5000 + i * 1000, 5000 + i * 1000, 5900 + i * 1000))
+        filtered = {1: ["r01", "r04"], 2: ["r04", "r07", "r09"], 9: ["r00"]}
+        masked = {}
+        for k, ids in filtered.items():
+            masked[k] = {"name": "filter%d" % k, "reads": len(ids),
+                         "fnam": "lala-pairs~_filter%d.tsv" % k}
+            with open(masked[k]["fnam"], "w") as out:
+                out.write("".join(r + "\n" for r in ids))
+        for fnam in ["lala-pairs~", "lala-pairs-bin~"]:
+            if fnam == "lala-pairs-bin~":
+                tsv_to_binary("lala-pairs~", fnam)
+            self.assertEqual(apply_filter(fnam, "lala-valid~", masked,
+                                          filters=[1, 2], verbose=False), 6)
+            self.assertEqual(apply_filter(fnam, "lala-valid~", masked,
+                                          filters=[1, 9], reverse=True,
+                                          verbose=False), 3)
+            bitmask = get_bitmask(fnam, masked)
+            self.assertEqual(bitmask, bitmask_path(fnam))
+            self.assertEqual(npload(bitmask).tolist(),
+                             [512, 2, 0, 0, 6, 0, 0, 4, 0, 4])
+        # not rebuilt while the reads and the filter files do not change
+        utime(bitmask, (0, 0))
+        apply_filter(fnam, "lala-valid~", masked, filters=[2], verbose=False)
+        self.assertEqual(path.getmtime(bitmask), 0)
+        # rebuilt otherwise
+        with open(masked[2]["fnam"], "w") as out:
+            out.write("r02\nr03\n")
+        self.assertEqual(apply_filter(fnam, "lala-valid~", masked,
+                                      filters=[2], reverse=True,
+                                      verbose=False), 2)
+        self.assertEqual(npload(bitmask).tolist(),
+                         [512, 2, 4, 4, 2, 0, 0, 0, 0, 0])
+        system("rm -rf lala*")
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print("22", time() - t0)
+
+
+    def test_23_mapped_genome(self):
+        """
+        memory-mapped genome cache, and its index
+        """
+        if ONLY and not "23" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        from os import utime
+        from pickle import dumps, loads
+        from pytadbit.parsers.genome_parser import MappedGenome
+        seqs = OrderedDict([("chr1", "ACGTTGCA" * 10), ("chr2", "GGATCC" * 7)])
+        with open("lala.fa~", "w") as out:
+            for crm in seqs:
+                out.write(">%s\n" % crm)
+                for p in range(0, len(seqs[crm]), 60):
+                    out.write(seqs[crm][p:p + 60] + "\n")
+        genome = parse_fasta("lala.fa~", mapped=True, verbose=False)
+        self.assertTrue(isinstance(genome, MappedGenome))
+        self.assertEqual(list(genome.keys()), ["chr1", "chr2"])
+        self.assertEqual(genome.lengths(), OrderedDict([("chr1", 80), ("chr2", 42)]))
+        self.assertEqual(genome["chr2"], seqs["chr2"])
+        self.assertEqual(genome.region("chr1", 5, 12), seqs["chr1"][5:12])
+        self.assertEqual(loads(dumps(genome))["chr1"], seqs["chr1"])
+        # a samtools index of the cache does not interfere
+        with open("lala.fa~_genome.TADbit.fai", "w") as out:
+            out.write("chr1\t80\t6\t80\t81\nchr2\t42\t93\t42\t43\n")
+        self.assertTrue(path.exists("lala.fa~_genome.TADbit.tdbidx"))
+        self.assertEqual(MappedGenome("lala.fa~_genome.TADbit")["chr2"], seqs["chr2"])
+        self.assertEqual(parse_fasta("lala.fa~", verbose=False), seqs)
+        self.assertEqual(parse_fasta("lala.fa~", verbose=False,
+                                     only_length=True),
+                         genome.lengths())
+        # an index built again (the cache was touched) keeps the stamps of
+        # the FASTA, and the cache is still used
+        utime("lala.fa~_genome.TADbit", (2, 2))
+        self.assertEqual(MappedGenome("lala.fa~_genome.TADbit")["chr2"], seqs["chr2"])
+        stamp = path.getmtime("lala.fa~_genome.TADbit")
+        self.assertEqual(parse_fasta("lala.fa~", mapped=True, verbose=False)["chr1"],
+                         seqs["chr1"])
+        self.assertEqual(path.getmtime("lala.fa~_genome.TADbit"), stamp)
+        # the cache is built again if the FASTA changed
+        with open("lala.fa~", "w") as out:
+            out.write(">chr1\nAAAACCCC\n")
+        utime("lala.fa~", (1, 1))
+        self.assertEqual(parse_fasta("lala.fa~", verbose=False),
+                         OrderedDict([("chr1", "AAAACCCC")]))
+        self.assertEqual(parse_fasta("lala.fa~", mapped=True, verbose=False)["chr1"],
+                         "AAAACCCC")
+        system("rm -rf lala*")
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print("23", time() - t0)
+
+
+    def test_24_topdom_mannwhitneyu(self):
+        """
+        grouped Mann-Whitney U tests of TopDom, against scipy
+        """
+        if ONLY and not "24" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        import numpy as np
+        from scipy.stats import mannwhitneyu
+        from pytadbit.tadbit import _mannwhitneyu_less
+        rnd = np.random.RandomState(1)
+        xs = []
+        ys = []
+        for k in range(300):
+            n1, n2 = rnd.randint(1, 20), rnd.randint(1, 30)
+            if k % 3:
+                # ties
+                xs.append(rnd.randint(0, 5, n1).astype(float))
+                ys.append(rnd.randint(0, 7, n2).astype(float))
+            else:
+                xs.append(rnd.normal(size=n1))
+                ys.append(rnd.normal(0.5, size=n2))
+        ys[10][0] = np.nan
+        # same sizes, grouped
+        xs.extend(rnd.normal(size=(20, 12)))
+        ys.extend(rnd.randint(0, 3, size=(20, 15)).astype(float))
+        with catch_warnings():
+            simplefilter("ignore")
+            pvalues = _mannwhitneyu_less(xs, ys)
+            expected = [mannwhitneyu(x=x, y=y, use_continuity=True,
+                                     alternative='less').pvalue
+                        for x, y in zip(xs, ys)]
+        self.assertTrue(np.isnan(pvalues[10]))
+        self.assertTrue(np.allclose(pvalues, expected, rtol=1e-10,
+                                    equal_nan=True))
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print("24", time() - t0)
+
+    def test_25_tadbit_options(self):
+        if ONLY and not "25" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        hic = read_matrix(PATH + '/40Kb/chrT/chrT_A.tsv')
+        size = len(hic)
+        # forced number of TADs
+        for ntads in [1, 3, 5]:
+            result = tadbit(hic, verbose=False, ntads=ntads)
+            self.assertEqual(len(result['start']), ntads)
+            self.assertEqual(result['end'][-1], size - 1)
+        # no TAD longer than max_tad_size, with or without heuristic
+        default = tadbit(hic, verbose=False)
+        self.assertTrue(max(e - s for s, e in zip(default['start'],
+                                                  default['end'])) > 5)
+        for no_heuristic in [False, True]:
+            result = tadbit(hic, verbose=False, max_tad_size=5,
+                            no_heuristic=no_heuristic)
+            self.assertTrue(max(e - s for s, e in zip(result['start'],
+                                                      result['end'])) <= 5)
+        # normalized data is not silently truncated
+        norm = [[hic[i, j] / 3. for j in range(size)] for i in range(size)]
+        self.assertRaises(Exception, tadbit, [norm], verbose=False)
+        # counts stored as floats are fine
+        counts = [[float(hic[i, j]) for j in range(size)] for i in range(size)]
+        self.assertEqual(tadbit([counts], verbose=False)['start'],
+                         default['start'])
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print("25", time() - t0)
+
+    def test_26_hmm(self):
+        if ONLY and not "26" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        import numpy as np
+        from itertools import product
+        from pytadbit.utils.hmm import best_path, log_best_path, train
+        from pytadbit.utils.hmm import gaussian_prob, log_gaussian_prob
+        pi = [0.6, 0.4]
+        T  = [[0.8, 0.2], [0.3, 0.7]]
+        E  = [[-1., 0.5], [1., 0.8]]
+        x  = [-1.2, -0.3, 0.4, 1.5, 0.9, -0.8, 1.1]
+        # Viterbi against all the possible paths
+        lgp = log_gaussian_prob(x, E)
+        best = max((np.log(pi[p[0]]) + lgp[0, p[0]] +
+                    sum(np.log(T[p[k - 1]][p[k]]) + lgp[k, p[k]]
+                        for k in range(1, len(x))), list(p))
+                   for p in product(range(2), repeat=len(x)))
+        path, llk = log_best_path(lgp, pi, T)
+        self.assertEqual(path, best[1])
+        self.assertAlmostEqual(llk, best[0], places=10)
+        path2, llk2 = best_path(gaussian_prob(x, E), pi, T)
+        self.assertEqual(path2, path)
+        self.assertAlmostEqual(llk2, llk, places=10)
+        # observations far from all the states do not underflow
+        far = [v * 1e3 for v in x]
+        E_far = [[-1., 0.5], [1., 0.5]]
+        self.assertFalse(gaussian_prob(far, E_far).any())
+        path, llk = log_best_path(log_gaussian_prob(far, E_far), pi, T)
+        self.assertEqual(path, [0 if v < 0 else 1 for v in x])
+        self.assertTrue(np.isfinite(llk))
+        # training recovers the parameters of a simulated sequence
+        rng = np.random.RandomState(1)
+        states = [0]
+        for _ in range(4999):
+            states.append(rng.choice(2, p=T[states[-1]]))
+        obs = [rng.normal(E[s][0], E[s][1] ** 0.5) for s in states]
+        pi2 = [0.5, 0.5]
+        T2  = [[0.5, 0.5], [0.5, 0.5]]
+        E2  = [[-0.5, 1.], [0.5, 1.]]
+        train(pi2, T2, E2, [obs[:2500], obs[2500:]], n_iter=200)
+        self.assertTrue(np.allclose(T2, T, atol=0.05))
+        self.assertTrue(np.allclose(E2, E, atol=0.1))
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print("26", time() - t0)
+
+    def test_27_bam_matrix(self):
+        if ONLY and not "27" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        from pytadbit.parsers.hic_bam_parser import bed2D_to_BAMhic, get_matrix
+        sections, pairs = generate_random_pairs('lala-pairs~')
+        bed2D_to_BAMhic('lala-pairs~', True, 2, 'lala-bam', 'long')
+        system('mkdir -p lala-tmp')
+        resolution = 5000
+        # the BAM is read in chunks, that should not count twice the read-ends
+        # at their borders
+        for ncpus, nchunks in [(1, 100), (2, 7)]:
+            for region in [{},
+                           {'region1': 'chrB'},
+                           {'region1': 'chrC', 'start1': 12000, 'end1': 88000}]:
+                matrix = get_matrix('lala-bam.bam', resolution, ncpus=ncpus,
+                                    nchunks=nchunks, tmpdir='lala-tmp',
+                                    clean=True, verbose=False, **region)
+                expected = count_random_pairs(pairs, sections, resolution,
+                                              **region)
+                self.assertEqual(matrix, expected)
+                # same cells in an array-backed HiC data object
+                hic = HiC_data_array((), 100)
+                get_matrix('lala-bam.bam', resolution, ncpus=ncpus,
+                           nchunks=nchunks, tmpdir='lala-tmp', clean=True,
+                           verbose=False, dico=hic, **region)
+                self.assertEqual(dict(hic.items()),
+                                 dict((a * 100 + b, v)
+                                      for (a, b), v in expected.items()))
+        system('rm -rf lala*')
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print("27", time() - t0)
+
+    def test_28_multires_cooler(self):
+        if ONLY and not "28" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        try:
+            import h5py
+        except ImportError:
+            warn('h5py not found, skipping test of cooler output')
+            return
+        from pytadbit.parsers.hic_bam_parser import bed2D_to_BAMhic
+        from pytadbit.parsers.hic_bam_parser import write_multires_cooler
+        sections, pairs = generate_random_pairs('lala-pairs~')
+        bed2D_to_BAMhic('lala-pairs~', True, 2, 'lala-bam', 'long')
+        system('mkdir -p lala-tmp')
+        import numpy as np
+        resolutions = [5000, 10000, 25000]
+        fnam = write_multires_cooler('lala-bam.bam', 5000, 'lala-tmp',
+                                     resolutions=resolutions[1:], ncpus=2,
+                                     nchunks=7, tmpdir='lala-tmp',
+                                     verbose=False)['RAW']
+        with h5py.File(fnam, 'r') as h5:
+            for reso in resolutions:
+                grp = h5['resolutions'][str(reso)]
+                # direct count, on the upper half matrix of cooler bins
+                offsets = {}
+                total = 0
+                for crm in sections:
+                    offsets[crm] = (total, -(-sections[crm] // reso))
+                    total += offsets[crm][1]
+                self.assertEqual(len(grp['bins']['start']), total)
+                expected = {}
+                for crm1, pos1, crm2, pos2 in pairs:
+                    a = offsets[crm1][0] + min(pos1 // reso, offsets[crm1][1] - 1)
+                    b = offsets[crm2][0] + min(pos2 // reso, offsets[crm2][1] - 1)
+                    expected[min(a, b), max(a, b)] = expected.get(
+                        (min(a, b), max(a, b)), 0) + 1
+                bin1 = grp['pixels']['bin1_id'][:]
+                bin2 = grp['pixels']['bin2_id'][:]
+                count = grp['pixels']['count'][:]
+                self.assertEqual(dict(zip(zip(bin1.tolist(), bin2.tolist()),
+                                          count.tolist())), expected)
+                # pixels sorted, each one once, and indexed by row
+                keys = bin1 * total + bin2
+                self.assertTrue((keys[1:] > keys[:-1]).all())
+                self.assertEqual(grp['indexes']['bin1_offset'][:].tolist(),
+                                 np.searchsorted(bin1, np.arange(total + 1)).tolist())
+                self.assertEqual(grp.attrs['nnz'], len(expected))
+                self.assertEqual(grp.attrs['sum'], len(pairs))
+        system('rm -rf lala*')
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print("28", time() - t0)
+
+    def test_29_cooler_pixels(self):
+        if ONLY and not "29" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        try:
+            import h5py
+        except ImportError:
+            warn('h5py not found, skipping test of cooler output')
+            return
+        import numpy as np
+        from pytadbit.parsers.cooler_parser import cooler_file
+        from pytadbit.parsers.hic_bam_parser import bed2D_to_BAMhic, write_matrix
+        # pixels written by chunks, each one sorted before being written
+        sections = OrderedDict([('chrA', 1000), ('chrB', 500)])
+        out = cooler_file('lala.mcool', 100, sections, list(sections))
+        out.create_bins()
+        out.prepare_matrix()
+        out.write_pixels([3, 0, 0, 2], [4, 9, 0, 2], [5, 1, 2, 3])
+        out.write_pixels([], [], [])
+        out.write_pixels(np.array([14, 5, 5]), np.array([14, 12, 6]),
+                         np.array([7, 1, 4]))
+        out.close()
+        with h5py.File('lala.mcool', 'r') as h5:
+            grp = h5['resolutions']['100']
+            self.assertEqual(grp['pixels']['bin1_id'][:].tolist(),
+                             [0, 0, 2, 3, 5, 5, 14])
+            self.assertEqual(grp['pixels']['bin2_id'][:].tolist(),
+                             [0, 9, 2, 4, 6, 12, 14])
+            self.assertEqual(grp['pixels']['count'][:].tolist(),
+                             [2, 1, 3, 5, 4, 1, 7])
+            self.assertEqual(grp['indexes']['bin1_offset'][:].tolist(),
+                             [0, 2, 2, 3, 4, 4, 6, 6, 6, 6, 6, 6, 6, 6, 6, 7])
+            self.assertEqual((grp.attrs['nnz'], grp.attrs['sum']), (7, 23))
+        # matrices from a BAM file
+        sections, pairs = generate_random_pairs('lala-pairs~')
+        bed2D_to_BAMhic('lala-pairs~', True, 2, 'lala-bam', 'long')
+        system('mkdir -p lala-tmp')
+        resolution = 7000
+        for region, offset in [({}, 0),
+                               ({'region1': 'chrC', 'start1': 12000,
+                                 'end1': 88000}, 1)]:
+            fnam = write_matrix('lala-bam.bam', resolution, None, 'lala-tmp',
+                                normalizations=('raw', ), cooler=True,
+                                nchunks=7, ncpus=2, tmpdir='lala-tmp',
+                                verbose=False, **region)['RAW']
+            expected = dict(((i + offset, j + offset), v) for (i, j), v in
+                            count_random_pairs(pairs, sections, resolution,
+                                               **region).items() if i <= j)
+            with h5py.File(fnam, 'r') as h5:
+                grp = h5['resolutions'][str(resolution)]
+                bin1 = grp['pixels']['bin1_id'][:].tolist()
+                bin2 = grp['pixels']['bin2_id'][:].tolist()
+                count = grp['pixels']['count'][:].tolist()
+            self.assertEqual(list(zip(bin1, bin2)), sorted(expected))
+            self.assertEqual(dict(zip(zip(bin1, bin2), count)), expected)
+        system('rm -rf lala*')
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print("29", time() - t0)
+
+    def test_30_bam_filter_flags(self):
+        if ONLY and not "30" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        from pysam import AlignmentFile
+        from copy import deepcopy
+        from glob import glob
+        from pytadbit.mapping.filter import MASKED, get_bitmask
+        from pytadbit.parsers.hic_bam_parser import bed2D_to_BAMhic, get_matrix
+        sections, pairs = generate_random_pairs('lala-pairs~')
+        # read IDs of two filters, in the order of the file of pairs
+        filtered = {1: [i for i in range(len(pairs)) if not i % 11],
+                    9: [i for i in range(len(pairs)) if not i % 7]}
+        masked = {}
+        for k in filtered:
+            fnam = 'lala-pairs~_%s.tsv' % MASKED[k]['name'].replace(' ', '_')
+            out = open(fnam, 'w')
+            out.write(''.join('R%06d\n' % i for i in filtered[k]))
+            out.close()
+            masked[k] = {'name': MASKED[k]['name'], 'fnam': fnam}
+        # filter files given or found next to the file of pairs, or bitmask
+        # saved by the filtering. Nothing is written next to the file of
+        # pairs, and the dictionary of filters given is not modified
+        for msk in [masked, None, 'saved']:
+            system('rm -f lala-bam*')
+            if msk == 'saved':
+                msk = dict((k, dict(masked[k])) for k in masked)
+                get_bitmask('lala-pairs~', msk)
+            given = deepcopy(msk)
+            written = sorted(glob('lala-pairs~*'))
+            bed2D_to_BAMhic('lala-pairs~', False, 2, 'lala-bam', 'long',
+                            masked=msk)
+            self.assertEqual(msk, given)
+            self.assertEqual(sorted(glob('lala-pairs~*')), written)
+            self.assertEqual(sorted(glob('lala-bam*')),
+                             ['lala-bam.bam', 'lala-bam.bam.bai'])
+            for r in AlignmentFile('lala-bam.bam'):
+                i = int(r.query_name[1:])
+                self.assertEqual(r.flag & ~1024,
+                                 sum(2**(k - 1) for k in filtered
+                                     if i in filtered[k]))
+                self.assertEqual(bool(r.flag & 1024), pairs[i][0] != pairs[i][2])
+        system('mkdir -p lala-tmp')
+        for filter_exclude in [(1, ), (9, ), (1, 9)]:
+            valid = [p for i, p in enumerate(pairs)
+                     if not any(i in filtered[k] for k in filter_exclude)]
+            self.assertEqual(get_matrix('lala-bam.bam', 5000, ncpus=1,
+                                        filter_exclude=filter_exclude,
+                                        tmpdir='lala-tmp', clean=True,
+                                        verbose=False),
+                             count_random_pairs(valid, sections, 5000))
+        system('rm -rf lala*')
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print("30", time() - t0)
+
+    def test_31_bin_index(self):
+        if ONLY and not "31" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        from pytadbit.parsers.hic_bam_parser import bed2D_to_BAMhic, get_matrix
+        from os import stat, utime
+        from pytadbit.parsers import hic_bam_parser
+        from pytadbit.parsers.hic_bam_parser import build_bin_index
+        from pytadbit.parsers.bin_index import BinIndex, bin_index_path
+        from pytadbit.parsers.bin_index import open_bin_index
+        sections, pairs = generate_random_pairs('lala-pairs~')
+        bed2D_to_BAMhic('lala-pairs~', True, 2, 'lala-bam', 'long')
+        system('mkdir -p lala-tmp')
+        # the index stores the upper half matrix, read by rows or blocks
+        index = BinIndex(build_bin_index('lala-bam.bam', 5000, ncpus=1,
+                                         tmpdir='lala-tmp', verbose=False))
+        counts = count_random_pairs(pairs, sections, 5000)
+        bin1, bin2, count = index.rows(0, index.nbins)
+        self.assertEqual(dict(zip(zip(bin1.tolist(), bin2.tolist()),
+                                  count.tolist())),
+                         dict((k, v) for k, v in counts.items() if k[0] <= k[1]))
+        bin1, bin2, count = index.block(10, 30, 20, 50)
+        self.assertEqual(dict(zip(zip(bin1.tolist(), bin2.tolist()),
+                                  count.tolist())),
+                         dict((k, v) for k, v in counts.items()
+                              if 10 <= k[0] < 30 and 20 <= k[1] < 50 and
+                              k[0] <= k[1]))
+        # same matrices as from the BAM file, intra, inter and between two
+        # regions
+        regions = [{},
+                   {'region1': 'chrB'},
+                   {'region1': 'chrC', 'start1': 12000, 'end1': 88000},
+                   {'region1': 'chrA', 'region2': 'chrC'},
+                   {'region1': 'chrC', 'region2': 'chrA'},
+                   {'region1': 'chrC', 'start1': 12000, 'end1': 60000,
+                    'region2': 'chrC', 'start2': 40000, 'end2': 100000},
+                   {'region1': 'chrC', 'start1': 50000, 'end1': 100000,
+                    'region2': 'chrC', 'start2': 0, 'end2': 30000},
+                   {'region1': 'chrB', 'start1': 10000, 'end1': 40000,
+                    'region2': 'chrA', 'start2': 20000, 'end2': 70000}]
+        for resolution in [1000, 5000]:
+            for region in regions:
+                expected = count_random_pairs(pairs, sections, resolution,
+                                              **region)
+                for bin_index in [None, True]:
+                    self.assertEqual(get_matrix(
+                        'lala-bam.bam', resolution, ncpus=2, nchunks=7,
+                        tmpdir='lala-tmp', clean=True, verbose=False,
+                        bin_index=bin_index, **region), expected)
+        # the index is stale as soon as the BAM file changes, even within the
+        # same second
+        fnam = bin_index_path('lala-bam.bam', 5000, index.filter_exclude)
+        self.assertTrue(open_bin_index(fnam, 'lala-bam.bam', 5000,
+                                       index.filter_exclude) is not None)
+        mtime = stat('lala-bam.bam').st_mtime_ns
+        utime('lala-bam.bam', ns=(mtime, mtime + 1))
+        self.assertTrue(open_bin_index(fnam, 'lala-bam.bam', 5000,
+                                       index.filter_exclude) is None)
+        # index in the directory given, or in tmpdir if the directory of
+        # the BAM file is not writable
+        expected = count_random_pairs(pairs, sections, 5000)
+        system('mkdir -p lala-idx')
+        self.assertEqual(get_matrix('lala-bam.bam', 5000, ncpus=1,
+                                    tmpdir='lala-tmp', verbose=False,
+                                    bin_index='lala-idx'), expected)
+        self.assertTrue(path.exists(path.join('lala-idx', path.basename(fnam))))
+        access = hic_bam_parser.os.access
+        hic_bam_parser.os.access = lambda *args: False
+        try:
+            self.assertEqual(get_matrix('lala-bam.bam', 5000, ncpus=1,
+                                        tmpdir='lala-tmp', verbose=False,
+                                        bin_index=True), expected)
+        finally:
+            hic_bam_parser.os.access = access
+        self.assertTrue(path.exists(path.join('lala-tmp', path.basename(fnam))))
+        self.assertTrue(open_bin_index(fnam, 'lala-bam.bam', 5000,
+                                       index.filter_exclude) is None)
+        system('rm -rf lala*')
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print("31", time() - t0)
+
+    def test_32_hicbased_restraints(self):
+        if ONLY and not "32" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        from pytadbit.modelling import restraints as rst
+        from pytadbit.modelling.restraints import HiCBasedRestraints
+        rnd = RandomState(32)
+        nloci = 60
+        # z-scores of the upper half matrix, with missing rows and cells
+        zscores = {}
+        for i in range(nloci):
+            if i in (0, 7, 8, 30, 59):
+                continue
+            for j in range(i + 1, nloci):
+                if rnd.rand() < 0.7 and j not in (13, 41):
+                    zscores.setdefault(str(i), {})[str(j)] = rnd.normal()
+        chromosomes = [{'crm': 'chrA', 'start': 1, 'end': 25},
+                       {'crm': 'chrB', 'start': 1, 'end': 35}]
+        for min_seqdist, remove_rstrn in [(0, []), (3, [4, 20, 33])]:
+            config = {'kforce': 5, 'maxdist': 600, 'upfreq': 0.3,
+                      'lowfreq': -0.5, 'scale': 0.01}
+            hicrst = HiCBasedRestraints(nloci, 50., config, 10000, zscores,
+                                        chromosomes, min_seqdist=min_seqdist,
+                                        remove_rstrn=remove_rstrn)
+            # same restraints computed pair by pair
+            ends = list(hicrst.chromosomes.values())
+            crm = lambda x: [k for k, v in enumerate(ends) if v > x][0]
+            expected = []
+            loci = [i for i in range(nloci) if i not in remove_rstrn]
+            for ni, i in enumerate(loci):
+                for j in loci[ni + 1:]:
+                    seqdist = j - i
+                    if seqdist <= min_seqdist:
+                        continue
+                    if seqdist == 1:
+                        if crm(i) != crm(j):
+                            continue
+                        rtype, dist = hicrst.get_nearest_neighbors_restraint_distance(
+                            50., i, j)
+                        kforce = 5
+                    elif seqdist == 2:
+                        if crm(i) != crm(j):
+                            continue
+                        rtype, dist = hicrst.get_second_nearest_neighbors_restraint_distance(
+                            50., i, j)
+                        kforce = 5
+                    else:
+                        rtype, kforce, dist = hicrst.get_long_range_restraints_kforce_and_distance(
+                            i, j)
+                        if rtype == 'None':
+                            continue
+                    expected.append((i, j, rtype, kforce, dist))
+            restraints = hicrst.get_hicbased_restraints()
+            self.assertEqual(restraints, expected)
+            # only the last restraints computed are kept
+            self.assertEqual(len(rst._RESTRAINTS_CACHE), 1)
+            self.assertEqual(list(rst._RESTRAINTS_CACHE.values())[0],
+                             restraints)
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print("32", time() - t0)
+
+    def test_33_parallel_imp_models(self):
+        if ONLY and not "33" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        try:
+            __import__("IMP")
+        except ImportError:
+            warn("IMP not found, skipping test\n")
+            return
+        from pytadbit.modelling import imp_modelling
+        from pytadbit.modelling.restraints import HiCBasedRestraints
+        rnd = RandomState(33)
+        nloci = 20
+        zscores = {}
+        for i in range(nloci):
+            for j in range(i + 1, nloci):
+                if rnd.rand() < 0.8:
+                    zscores.setdefault(str(i), {})[str(j)] = rnd.normal()
+        config = {'kforce': 5, 'maxdist': 500, 'upfreq': 0.2, 'lowfreq': -0.3,
+                  'scale': 0.01, 'kbending': 0.0, 'reference': ''}
+        models = imp_modelling.generate_3d_models(
+            zscores, 10000, nloci, n_models=6, n_keep=4, n_cpus=2,
+            keep_all=True, config=dict(config), first=0)
+        # each model is the one generated in this process with the same
+        # random seed, and the best ones are kept
+        hicrestraints = HiCBasedRestraints(
+            nloci, imp_modelling.RADIUS, imp_modelling.CONFIG, 10000,
+            zscores, chromosomes=None, first=0)
+        generated = dict(
+            (str(rand_init), imp_modelling.generate_IMPmodel(rand_init,
+                                                             hicrestraints))
+            for rand_init in range(1, 7))
+        self.assertEqual(len(models), 4)
+        self.assertEqual(len(models._bad_models), 2)
+        kept = [models[i] for i in range(4)]
+        kept += [models._bad_models[i] for i in range(4, 6)]
+        self.assertEqual(sorted(m['rand_init'] for m in kept),
+                         sorted(generated))
+        self.assertEqual([m['objfun'] for m in kept],
+                         sorted(m['objfun'] for m in generated.values()))
+        for model in kept:
+            expected = generated[model['rand_init']]
+            self.assertEqual(model['objfun'], expected['objfun'])
+            for axis in 'xyz':
+                self.assertEqual(model[axis], expected[axis])
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print("33", time() - t0)
+
+    def test_34_grid_search_resume(self):
+        if ONLY and not "34" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        try:
+            __import__("IMP")
+        except ImportError:
+            warn("IMP not found, skipping test\n")
+            return
+        import numpy as np
+        from pickle import load
+        from pytadbit.modelling import impoptimizer
+        from pytadbit.modelling.impoptimizer import IMPoptimizer, _load_models
+        from pytadbit.modelling.impmodel import IMPmodel
+        from pytadbit.modelling.structuralmodels import StructuralModels
+        test_chr = Chromosome(name="Test Chromosome", max_tad_size=260000)
+        test_chr.add_experiment("exp1", 20000,
+                                hic_data=PATH + "/20Kb/chrT/chrT_A.tsv",
+                                silent=True)
+        exp = test_chr.experiments[0]
+        exp.filter_columns(silent=True)
+        exp.normalize_hic(silent=True, factor=None)
+
+        # models of each set of parameters as random walks, the run being
+        # interrupted when modelling the set given
+        modelled = []
+        interrupt = []
+        def fake_models(config=None, nloci=None, resolution=None,
+                        values=None, zscores=None, zeros=None, **kwargs):
+            params = (config['maxdist'], config['upfreq'])
+            modelled.append(params)
+            if params in interrupt:
+                raise KeyboardInterrupt()
+            rnd = RandomState(int(config['maxdist'] + 100 * config['upfreq']))
+            models = {}
+            for i in range(5):
+                x, y, z = np.cumsum(rnd.normal(0, 150, (3, nloci)), axis=1)
+                models[i] = IMPmodel({'log_objfun': [], 'objfun': float(i),
+                                      'x': x.tolist(), 'y': y.tolist(),
+                                      'z': z.tolist(), 'radius': 100,
+                                      'cluster': 'Singleton',
+                                      'rand_init': str(i + 1)})
+            return StructuralModels(nloci, models, {}, resolution,
+                                    original_data=values, zscores=zscores,
+                                    config=config, zeros=zeros)
+
+        def grid_search(savedata=None, start=50, end=70):
+            optimizer = IMPoptimizer(exp, start, end, n_models=5, n_keep=5)
+            optimizer.run_grid_search(maxdist_range=(400, 600, 100),
+                                      upfreq_range=(0, 1, 0.5),
+                                      lowfreq_range=-0.6,
+                                      dcutoff_range=(1, 2, 1),
+                                      savedata=savedata, verbose=False)
+            return optimizer
+
+        generate_3d_models = impoptimizer.generate_3d_models
+        impoptimizer.generate_3d_models = fake_models
+        try:
+            expected = grid_search().results
+            every_set = sorted(modelled)
+            self.assertEqual(len(every_set), 9)
+            self.assertEqual(len(expected), 18)
+            # interrupted at the fifth set of parameters, then resumed
+            del modelled[:]
+            interrupt.append(every_set[4])
+            self.assertRaises(KeyboardInterrupt, grid_search, 'lala-grid')
+            self.assertEqual(len(modelled), 5)
+            del interrupt[:]
+            first_run = modelled[:4]
+            del modelled[:]
+            self.assertEqual(grid_search('lala-grid').results, expected)
+            self.assertEqual(sorted(first_run + modelled), every_set)
+            # nothing modelled once all are saved
+            del modelled[:]
+            self.assertEqual(grid_search('lala-grid').results, expected)
+            self.assertEqual(modelled, [])
+        finally:
+            impoptimizer.generate_3d_models = generate_3d_models
+        # one record per set of parameters, after the header
+        records = []
+        with open('lala-grid', 'rb') as inf:
+            while True:
+                try:
+                    records.append(load(inf))
+                except EOFError:
+                    break
+        self.assertEqual(list(records[0]), ['header'])
+        self.assertEqual(len(records), 10)
+        self.assertEqual(len(_load_models('lala-grid')), 9)
+        # the correlations saved are loaded as they are
+        optimizer = IMPoptimizer(exp, 50, 70, n_models=5, n_keep=5)
+        optimizer.load_grid_search('lala-grid', n_cpus=1, verbose=False)
+        self.assertEqual(optimizer.results, expected)
+        # models of another region are not resumed
+        self.assertRaises(Exception, grid_search, 'lala-grid', 50, 71)
+        system('rm -rf lala*')
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print("34", time() - t0)
+
+    def test_35_expected_cache(self):
+        if ONLY and not "35" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        from pytadbit.utils.normalize_hic import expected
+        for klass in (HiC_data, HiC_data_array):
+            size = 20
+            hic = klass([(i, 5) for i in range(size * size)], size)
+            self.assertEqual(set(expected(hic).values()), set([5.]))
+            # the expected values follow the modifications of the matrix
+            for i in range(size):
+                for j in range(size):
+                    hic[i, j] = 100
+            self.assertEqual(set(expected(hic).values()), set([100.]))
+            hic.update([(i, 20) for i in range(size * size)])
+            self.assertEqual(set(expected(hic).values()), set([20.]))
+            hic.clear()
+            for i in range(size * size):
+                hic.setdefault(i, 40)
+            self.assertEqual(set(expected(hic).values()), set([40.]))
+            del hic[0]
+            self.assertEqual(expected(hic)[0], 38.)
+            self.assertEqual(expected(hic), expected(klass(hic.copy(), size)))
+        hic = HiC_data_array((), size)
+        self.assertEqual(set(expected(hic).values()), set([0.]))
+        hic._update_from_arrays(list(range(size * size)), [7] * (size * size))
+        self.assertEqual(set(expected(hic).values()), set([7.]))
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print("35", time() - t0)
+
 
 def generate_random_ali(ali="map"):
     # VARIABLES
@@ -1090,6 +1908,69 @@ def generate_random_ali(ali="map"):
     return genome
 
 
+def generate_random_pairs(fnam, num_pairs=3000):
+    """
+    write a file of random pairs of read-ends (long format of the TADbit
+    filtered reads), returns the chromosome lengths and the pairs
+    """
+    rnd = RandomState(2)
+    sections = OrderedDict([('chrA', 95000), ('chrB', 60000), ('chrC', 121000)])
+    crms = list(sections)
+    pairs = []
+    out = open(fnam, 'w')
+    for crm in sections:
+        out.write('# CRM %s\t%d\n' % (crm, sections[crm]))
+    for i in range(num_pairs):
+        crm1, crm2 = crms[rnd.randint(3)], crms[rnd.randint(3)]
+        if rnd.random_sample() < 0.6:  # mostly cis
+            crm2 = crm1
+        while True:
+            pos1 = rnd.randint(1, sections[crm1] + 1)
+            if rnd.random_sample() < 0.2:  # next to the border of the bins
+                pos1 = max(1, pos1 // 1000 * 1000 - rnd.randint(3))
+            if crm1 == crm2 and rnd.random_sample() < 0.8:  # mostly close
+                pos2 = pos1 + rnd.randint(-30000, 30000)
+            else:
+                pos2 = rnd.randint(1, sections[crm2] + 1)
+            if 0 < pos2 <= sections[crm2] and (crm1, pos1) != (crm2, pos2):
+                break
+        pairs.append((crm1, pos1, crm2, pos2))
+        out.write('R%06d\t%s\t%d\t1\t50\t%d\t%d\t%s\t%d\t0\t50\t%d\t%d\n' % (
+            i, crm1, pos1, max(1, pos1 - 100), pos1 + 100,
+            crm2, pos2, max(1, pos2 - 100), pos2 + 100))
+    out.close()
+    return sections, pairs
+
+
+def count_random_pairs(pairs, sections, resolution,
+                       region1=None, start1=None, end1=None,
+                       region2=None, start2=None, end2=None):
+    """
+    count the pairs of read-ends in the bins of a matrix, as get_matrix
+    """
+    offsets = {}
+    total = 0
+    for crm in sections:
+        offsets[crm] = total
+        total += sections[crm] // resolution + 1
+    def _range(region, start, end):
+        if region is None:
+            return 0, total
+        return (offsets[region] + (start or 0) // resolution,
+                offsets[region] + (sections[region] // resolution + 1
+                                   if end is None else end // resolution))
+    beg1, end1 = _range(region1, start1, end1)
+    beg2, end2 = _range(region2, start2, end2) if region2 else (beg1, end1)
+    counts = {}
+    for crm1, pos1, crm2, pos2 in pairs:
+        a = offsets[crm1] + pos1 // resolution
+        b = offsets[crm2] + pos2 // resolution
+        for i, j in set([(a, b), (b, a)]):
+            if beg1 <= i < end1 and beg2 <= j < end2:
+                counts[i - beg1, j - beg2] = counts.get((i - beg1, j - beg2), 0) + 1
+    return counts
+
+
 if __name__ == "__main__":
     if len(sys.argv) > 1:
         CHKTIME = bool(int(sys.argv.pop()))